@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Benchmark harness for the heatmap pipeline.
+
+Generates a deterministic synthetic pair of image stacks and measures
+the throughput (slices/s) and peak memory of the full ``Heatmap`` run
+and of each stage method in isolation, reporting the results as JSON so
+that they can be compared across commits:
+
+    python -m heatmap.benchmark --slices 64 --height 512 --width 512  \\
+        --channels 1 --density 0.02 --output bench.json -- --workers 4
+
+Arguments after ``--`` are passed on to ``heatmap`` itself. Every
+measurement runs in a freshly spawned process so that peak memory
+figures are not polluted by earlier measurements. The startup time of
+the metadata calls (``--version``, ``--json``, ...) is reported too,
+with any heavy imaging modules that they imported.
+"""
+
+import  os
+import  sys
+import  time
+import  json
+import  shutil
+import  argparse
+import  tempfile
+import  contextlib
+import  subprocess
+import  multiprocessing
+from    concurrent.futures  import ProcessPoolExecutor
+from    importlib.metadata  import version, PackageNotFoundError
+
+import  numpy                               as np
+import  cv2
+
+from    heatmap.profiling   import rss_peak, cpu_time
+
+# The stage methods of Heatmap, in pipeline order.
+Gl_STAGES       :   list    = [
+    'imageFileNames_determine',
+    'imageSlices_populate',
+    'imageSlices_toGrayScale',
+    'grayScale_slicesProcess',
+    'outputs_generate'
+]
+
+# The metadata and help calls that ChRIS registration makes, and the
+# heavy modules that they should not need to import.
+Gl_STARTUP      :   list    = ['--version', '--json', '--meta', '--man']
+Gl_HEAVY        :   list    = ['numpy', 'cv2', 'skimage', 'scipy', 'imutils', 'matplotlib',
+                               'pydicom']
+
+# Run in a fresh interpreter to make one startup call.
+Gstr_startup    :   str     = '''
+import sys, json
+sys.argv = ['heatmap'] + sys.argv[1:]
+from heatmap.__main__ import main
+try:
+    main()
+except SystemExit:
+    pass
+print(json.dumps(sorted({m.split('.')[0] for m in sys.modules} & set(%r))), file = sys.stderr)
+''' % Gl_HEAVY
+
+
+def stacks_generate(str_inputdir, slices = 16, height = 256, width = 256,
+                    channels = 1, density = 0.05, seed = 0) -> dict:
+    """
+    Write a deterministic synthetic A/B pair of image stacks to the
+    ``dir1`` and ``dir2`` subdirectories of <str_inputdir>.
+
+    Set A is smooth random texture; set B is set A with rectangles of
+    new intensity pasted over roughly a <density> fraction of each
+    slice. A density of 0 makes the two sets identical.
+    """
+    rng         = np.random.default_rng(seed)
+    target      :   int     = int(density * height * width)
+
+    for str_dir in ['dir1', 'dir2']:
+        os.makedirs(os.path.join(str_inputdir, str_dir), exist_ok = True)
+    for i in range(slices):
+        imageA  = cv2.GaussianBlur(
+                    rng.integers(0, 256, (height, width), dtype = np.uint8),
+                    (0, 0), 3)
+        imageA  = cv2.normalize(imageA, None, 0, 255, cv2.NORM_MINMAX)
+        imageB  = imageA.copy()
+        mask    = np.zeros((height, width), bool)
+        while mask.sum() < target:
+            (h, w)  = rng.integers(4, max(5, min(height, width) // 8), 2)
+            y       = rng.integers(0, height - h + 1)
+            x       = rng.integers(0, width  - w + 1)
+            imageB[y : y + h, x : x + w]    = rng.integers(0, 256)
+            mask[y : y + h, x : x + w]      = True
+        if channels == 3:
+            imageA  = cv2.merge([imageA, imageA // 2 + 64, 255 - imageA])
+            imageB  = cv2.merge([imageB, imageB // 2 + 64, 255 - imageB])
+        cv2.imwrite(os.path.join(str_inputdir, 'dir1', 'slice-%04d.png' % i), imageA)
+        cv2.imwrite(os.path.join(str_inputdir, 'dir2', 'slice-%04d.png' % i), imageB)
+
+    return {
+        'slices':   slices,
+        'height':   height,
+        'width':    width,
+        'channels': channels,
+        'density':  density,
+        'seed':     seed
+    }
+
+def rss_current() -> float:
+    """
+    Current resident set size of this process in MiB (0 if unknown).
+    """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+def startup_measure(str_flag) -> dict:
+    """
+    Time a ``heatmap <str_flag>`` call, interpreter startup included,
+    and list the heavy modules it imported.
+    """
+    tic     = time.perf_counter()
+    result  = subprocess.run([sys.executable, '-c', Gstr_startup, str_flag],
+                             stdout = subprocess.DEVNULL, stderr = subprocess.PIPE,
+                             text = True, check = True)
+    return {
+        'wallTime':     time.perf_counter() - tic,
+        'heavyModules': json.loads(result.stderr.strip().splitlines()[-1])
+    }
+
+def case_measure(str_inputdir, str_stage, l_args) -> dict:
+    """
+    Run and measure one benchmark case: either the whole 'pipeline'
+    or the single stage <str_stage>, with the stages before it run
+    (unmeasured) to set it up. Meant to run in a fresh process.
+    """
+    from heatmap.heatmap    import Heatmap
+
+    # A spawned process inherits the 'spawn' start method; put back the
+    # platform default so that the pipeline's own pool starts as usual.
+    multiprocessing.set_start_method(None, force = True)
+    app             = Heatmap()
+    str_outputdir   = tempfile.mkdtemp(prefix = 'heatmap-bench-')
+    options         = app.parse_args([str_inputdir, str_outputdir,
+                                      '--inputSubDir1', 'dir1',
+                                      '--inputSubDir2', 'dir2'] + list(l_args))
+    d_case          :   dict    = {}
+
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if str_stage == 'pipeline':
+                rss     = rss_current()
+                tic     = time.perf_counter()
+                cpu     = cpu_time()
+                app.run(options)
+            else:
+                app.run_prepare(options)
+                d_prior = None
+                for str_method in Gl_STAGES:
+                    if str_method == str_stage:
+                        rss     = rss_current()
+                        tic     = time.perf_counter()
+                        cpu     = cpu_time()
+                    stage   = getattr(app, str_method)
+                    d_prior = stage(options) if d_prior is None else stage(options, d_prior)
+                    if str_method == str_stage:
+                        # Output counts as done once it is on disk.
+                        app.writer.drain()
+                        break
+            (wallTime, cpuTime) = (time.perf_counter() - tic, cpu_time() - cpu)
+            if str_stage != 'pipeline':
+                # The pool workers are not reaped (and so counted) until
+                # the run finishes: take the stage's own measure of them.
+                cpuTime    += app.d_timers[str_stage].workerCpuTime
+                app.run_finish(options)
+        d_case  = {
+            'slices':           app.sliceCount,
+            'wallTime':         wallTime,
+            'cpuTime':          cpuTime,
+            'slicesPerSecond':  app.sliceCount / wallTime if wallTime else 0.0,
+            'rssBefore':        rss,
+            # The stages reset the peak as they start: take theirs too.
+            'peakRSS':          max([rss_peak()] + [timer.peakRSS
+                                                    for timer in app.d_timers.values()])
+        }
+    finally:
+        shutil.rmtree(str_outputdir, ignore_errors = True)
+    return d_case
+
+def case_run(str_inputdir, str_stage, l_args) -> dict:
+    """
+    Measure one case in a freshly spawned process.
+    """
+    with ProcessPoolExecutor(max_workers = 1,
+            mp_context = multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(case_measure, str_inputdir, str_stage, l_args).result()
+
+def benchmark_run(d_config, l_args = (), lstr_stages = None, repeat = 1) -> dict:
+    """
+    Generate the synthetic stacks described by <d_config> and measure
+    the pipeline and each of <lstr_stages> (default all) on them, and
+    the startup time of the metadata calls, keeping the fastest of
+    <repeat> runs of each.
+    """
+    str_inputdir    = tempfile.mkdtemp(prefix = 'heatmap-bench-')
+    d_bench         :   dict    = {}
+
+    try:
+        version_heatmap = version('heatmap')
+    except PackageNotFoundError:
+        version_heatmap = ''
+    try:
+        str_commit  = subprocess.run(
+                        ['git', 'rev-parse', 'HEAD'],
+                        cwd = os.path.dirname(os.path.abspath(__file__)),
+                        capture_output = True, text = True).stdout.strip()
+    except OSError:
+        str_commit  = ''
+    try:
+        d_bench     = {
+            'version':  version_heatmap,
+            'commit':   str_commit,
+            'config':   stacks_generate(str_inputdir, **d_config),
+            'args':     list(l_args),
+            'startup':  {},
+            'stages':   {}
+        }
+        for str_flag in Gl_STARTUP:
+            l_runs  = [startup_measure(str_flag) for i in range(repeat)]
+            d_bench['startup'][str_flag]    = min(l_runs, key = lambda d: d['wallTime'])
+        for str_stage in ['pipeline'] + list(lstr_stages or Gl_STAGES):
+            l_runs  = [case_run(str_inputdir, str_stage, l_args) for i in range(repeat)]
+            d_best  = min(l_runs, key = lambda d: d['wallTime'])
+            if str_stage == 'pipeline':
+                d_bench['pipeline']             = d_best
+            else:
+                d_bench['stages'][str_stage]    = d_best
+    finally:
+        shutil.rmtree(str_inputdir, ignore_errors = True)
+    return d_bench
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark the heatmap pipeline on synthetic image stacks.'
+    )
+    parser.add_argument('--slices',     type = int,     default = 16)
+    parser.add_argument('--height',     type = int,     default = 256)
+    parser.add_argument('--width',      type = int,     default = 256)
+    parser.add_argument('--channels',   type = int,     default = 1, choices = [1, 3])
+    parser.add_argument('--density',    type = float,   default = 0.05,
+                        help = 'fraction of each slice that differs between A and B')
+    parser.add_argument('--seed',       type = int,     default = 0)
+    parser.add_argument('--stages',     type = str,     default = ','.join(Gl_STAGES),
+                        help = 'comma separated stage methods to measure in isolation')
+    parser.add_argument('--repeat',     type = int,     default = 1)
+    parser.add_argument('--output',     type = str,     default = '',
+                        help = 'JSON result file (default stdout)')
+    parser.add_argument('heatmapArgs',  nargs = argparse.REMAINDER,
+                        help = 'arguments passed on to heatmap, after --')
+    args    = parser.parse_args(argv)
+
+    l_args  = [a for a in args.heatmapArgs if a != '--']
+    d_bench = benchmark_run(
+        {k: getattr(args, k) for k in ['slices', 'height', 'width', 'channels', 'density', 'seed']},
+        l_args,
+        [str_stage for str_stage in args.stages.split(',') if str_stage],
+        args.repeat
+    )
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(d_bench, fp, indent = 4)
+    else:
+        json.dump(d_bench, sys.stdout, indent = 4)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Memory budgeting of a run.
+
+A run holds, for every slice pair in its current window, the grayscale
+slices and whatever intermediate results the selected products need,
+and in addition needs working memory for each comparison in progress
+and for its output: the images queued for writing and being written,
+box outlines and cache entries. These are estimated from the slice
+dimensions, and the largest window (and, failing that, the fewest
+workers) that keeps the estimate within a memory budget is chosen.
+
+The constants are rough measurements, on the generous side.
+"""
+
+MIB             :   int     = 1024 * 1024
+# Resident size of a process with the imaging stack loaded.
+PROCESS_BYTES   :   int     = 100 * MIB
+# Working memory of one scikit-image SSIM, per pixel (float64 maps).
+SSIM_BYTES      :   int     = 128
+# Working memory of the batched (float32) SSIM, per pixel of the window.
+STACK_BYTES     :   int     = 64
+# Contouring and pickling copies of a comparison's inputs and results.
+SEGMENT_BYTES   :   int     = 8
+# Connected component labels of a tile, and their relabelling.
+LABEL_BYTES     :   int     = 12
+# Chunk buffer of numpy writing an array into a (cache entry) .npz file.
+CHUNK_BYTES     :   int     = 16 * MIB
+
+
+def memory_limit() -> int:
+    """
+    The memory limit in bytes that the container runtime imposes on
+    this process through its cgroup, or 0 if there is none.
+    """
+    try:
+        with open('/sys/fs/cgroup/memory.max') as fp:
+            str_limit   = fp.read().strip()
+        return 0 if str_limit == 'max' else int(str_limit)
+    except (OSError, ValueError):
+        return 0
+
+def slice_footprint(pixels, channels, s_needs) -> int:
+    """
+    Bytes held for one slice pair of <pixels> pixels while it is in the
+    window: its grayscale slices, the colour slices if a product draws
+    on them, and the difference and threshold maps if needed. The
+    tiled path's memory-mapped maps are counted as if resident, as
+    their dirty pages are charged to the container until written back.
+    """
+    footprint   :   int     = 2 * pixels
+    if 'images' in s_needs and channels > 1:
+        footprint  += 2 * pixels * channels
+    for str_need in ['diff', 'thresh']:
+        if str_need in s_needs:
+            footprint  += pixels
+    return footprint
+
+def compare_footprint(pixels, str_engine = 'slice', tileSize = 0) -> int:
+    """
+    Working memory of one slice comparison in progress. The batched
+    engine's working memory grows with the window instead, see
+    memory_schedule().
+    """
+    if tileSize:
+        return (SSIM_BYTES + SEGMENT_BYTES + LABEL_BYTES) * (tileSize + 6) ** 2
+    if str_engine == 'stack':
+        return SEGMENT_BYTES * pixels
+    return (SSIM_BYTES + SEGMENT_BYTES) * pixels
+
+def output_footprint(pixels, s_needs, writeThreads, str_outputFormat = 'png',
+                     b_cache = False) -> int:
+    """
+    Bytes held for output of slices of <pixels> pixels: the colour
+    images queued for the <writeThreads> writer threads and, in 'npz'
+    format, each thread's serialised and deflated copy of the image it
+    is writing; the outline of many contour boxes, found all at once
+    over up to a whole slice; and the chunk buffer of a cache entry.
+    """
+    footprint   :   int     = 4 * writeThreads * 3 * pixels
+    if str_outputFormat == 'npz':
+        footprint  += writeThreads * 2 * 3 * pixels
+    if 'contours' in s_needs:
+        # int32 marks and a boolean mask
+        footprint  += 5 * pixels
+    if b_cache:
+        footprint  += CHUNK_BYTES
+    return footprint
+
+def memory_schedule(budget, sliceCount, perSlice, perCompare, fixed, workers) -> tuple:
+    """
+    The (window, workers) that fit into <budget> bytes: the largest
+    window of slice pairs (each holding <perSlice> bytes) with <workers>
+    workers (each needing <perCompare> bytes of working memory, and a
+    process of its own if there is more than one) on top of <fixed>
+    bytes, trading workers away for a window of at least one slice per
+    worker. If nothing fits, one slice at a time on one worker.
+    """
+    for count in range(workers, 0, -1):
+        workerBytes = perCompare if count == 1 else count * (PROCESS_BYTES + perCompare)
+        window      = (budget - fixed - workerBytes) // max(perSlice, 1)
+        if window >= min(sliceCount, count):
+            return (max(1, min(window, sliceCount)), count)
+    return (1, 1)
+
+def memory_estimate(window, workers, perSlice, perCompare, fixed) -> int:
+    """
+    The estimated peak memory, in bytes, of a run with <window> slice
+    pairs in memory and <workers> workers.
+    """
+    workerBytes = perCompare if workers == 1 else workers * (PROCESS_BYTES + perCompare)
+    return fixed + workerBytes + window * perSlice
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+A content-addressed, size limited, on-disk cache of per-slice results.
+
+Each entry is keyed by a hash of a grayscale slice pair's pixels and of
+the processing parameters, and holds the SSIM score, the difference
+image, its threshold and the bounding boxes of its contours. Entries are
+evicted least recently used first once the cache grows past its limit;
+recency is the file modification time, which a hit refreshes.
+"""
+
+import  os
+import  hashlib
+import  collections
+
+import  numpy                               as np
+
+# Bump whenever the cached results would change for the same inputs.
+CACHE_VERSION   :   str     = '1'
+
+
+class SliceCache:
+    """
+    Cache of (score, diff, threshold, boxes) slice results.
+    """
+
+    def __init__(self, str_dir, maxBytes):
+        self.str_dir    :   str     = str_dir
+        self.maxBytes   :   int     = maxBytes
+        self.size       :   int     = 0
+        self.hits       :   int     = 0
+        self.misses     :   int     = 0
+        # key -> size in bytes, least recently used first
+        self.d_entries              = collections.OrderedDict()
+
+        os.makedirs(self.str_dir, exist_ok = True)
+        l_entries = []
+        for entry in os.scandir(self.str_dir):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                l_entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for (mtime, key, size) in sorted(l_entries):
+            self.d_entries[key] = size
+            self.size          += size
+
+    def key(self, l_images, *params) -> str:
+        """
+        The cache key of the images <l_images> (a grayscale slice pair)
+        processed with <params>.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((CACHE_VERSION,) + params).encode())
+        for image in l_images:
+            digest.update(repr((image.shape, image.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def path(self, key) -> str:
+        return os.path.join(self.str_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        The cached (score, diff, threshold, boxes) for <key>, or None.
+        Parts that were not stored come back as None.
+        """
+        if key not in self.d_entries:
+            self.misses    += 1
+            return None
+        try:
+            with np.load(self.path(key)) as npz:
+                result  = ( float(npz['score']),
+                            npz['diff']     if 'diff'   in npz.files else None,
+                            npz['thresh']   if 'thresh' in npz.files else None,
+                            npz['boxes']    if 'boxes'  in npz.files else None)
+            os.utime(self.path(key))
+        except (OSError, KeyError, ValueError):
+            self.entry_remove(key)
+            self.misses    += 1
+            return None
+        self.d_entries.move_to_end(key)
+        self.hits      += 1
+        return result
+
+    def put(self, key, score, imageDiff, imageThresh, boxes):
+        """
+        Store a slice result under <key> and evict old entries as needed.
+        Parts of the result that are None are not stored.
+        """
+        str_path    = self.path(key)
+        str_tmp     = '%s.%d.tmp' % (str_path, os.getpid())
+        d_arrays    = { 'score': score, 'diff': imageDiff, 'thresh': imageThresh,
+                        'boxes': boxes}
+        with open(str_tmp, 'wb') as fp:
+            np.savez(fp, **{k: v for (k, v) in d_arrays.items() if v is not None})
+        os.replace(str_tmp, str_path)
+        if key in self.d_entries:
+            self.size  -= self.d_entries[key]
+        self.d_entries[key] = os.path.getsize(str_path)
+        self.d_entries.move_to_end(key)
+        self.size      += self.d_entries[key]
+        while self.size > self.maxBytes and len(self.d_entries) > 1:
+            self.entry_remove(next(iter(self.d_entries)))
+
+    def entry_remove(self, key):
+        self.size  -= self.d_entries.pop(key, 0)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Slice access to a DICOM series directory, as to a ``Volume``.
+
+The headers of the directory's files are read (without their pixel
+data) on a thread pool, and indexed by SeriesInstanceUID; a directory
+must hold a single series. Slices are ordered by their position along
+the slice normal (ImagePositionPatient projected onto the normal of
+ImageOrientationPatient), falling back to InstanceNumber and then to the
+file name where the geometry is missing. Pixel data is decoded, also on
+a thread pool, only when slices are asked for, rescaled to modality
+values and mapped through an intensity window -- the series' own
+WindowCenter/WindowWidth if it has one, its intensity range otherwise --
+into 8-bit grayscale. Nothing is written to disk.
+
+Reading DICOM needs the optional pydicom package, which is imported
+only once a series is opened: finding out whether a directory holds one
+reads no more than a file preamble.
+"""
+
+import  os
+import  importlib.util
+from    collections.abc     import Sequence
+from    concurrent.futures  import ThreadPoolExecutor
+
+import  numpy                               as np
+
+THREADS         :   int     = min(8, os.cpu_count() or 1)
+DICOM_MAGIC     :   bytes   = b'DICM'
+
+# Header elements read when indexing a series
+Gl_INDEX_TAGS   :   list    = [
+    'SeriesInstanceUID', 'InstanceNumber', 'ImagePositionPatient',
+    'ImageOrientationPatient', 'Rows', 'Columns', 'SamplesPerPixel',
+    'NumberOfFrames', 'RescaleSlope', 'RescaleIntercept',
+    'WindowCenter', 'WindowWidth',
+]
+
+
+def file_isDicom(str_file) -> bool:
+    """
+    Does <str_file> start with a DICOM file preamble?
+    """
+    try:
+        with open(str_file, 'rb') as fp:
+            fp.seek(128)
+            return fp.read(4) == DICOM_MAGIC
+    except OSError:
+        return False
+
+def dicom_check(str_path, lstr_names = None) -> bool:
+    """
+    Is <str_path> a directory of DICOM files? Only its first regular
+    file is looked at: the first of its (sorted) entry names
+    <lstr_names>, if given, as from a cached listing, and otherwise the
+    first the directory yields, so that it is neither read in full nor
+    sorted.
+    """
+    if not os.path.isdir(str_path):
+        return False
+    if lstr_names is None:
+        with os.scandir(str_path) as it:
+            for entry in it:
+                if entry.is_file():
+                    return file_isDicom(entry.path)
+        return False
+    for str_name in lstr_names:
+        str_file    = os.path.join(str_path, str_name)
+        if os.path.isfile(str_file):
+            return file_isDicom(str_file)
+    return False
+
+def header_value(value, default = None):
+    """
+    A header element's value, or the first of several, as a float.
+    """
+    if value is None or value == '':
+        return default
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        value   = value[0]
+    return float(value)
+
+
+class DicomSeries:
+    """
+    A DICOM series directory, sliced in geometric order.
+    """
+
+    def __init__(self, str_path, threads = THREADS):
+        if importlib.util.find_spec('pydicom') is None:
+            raise ValueError("Reading the DICOM series %s needs the pydicom package" % str_path)
+        self.str_path   :   str     = str_path
+        self.threads    :   int     = threads
+        self.window     :   tuple   = ()
+
+        lstr_files      = [ os.path.join(str_path, str_name)
+                            for str_name in sorted(os.listdir(str_path))]
+        with ThreadPoolExecutor(max_workers = self.threads) as pool:
+            l_headers   = [ (str_file, header) for (str_file, header) in
+                            zip(lstr_files, pool.map(self.header_read, lstr_files))
+                            if header is not None]
+        d_series        = {}
+        for (str_file, header) in l_headers:
+            d_series.setdefault(str(header.get('SeriesInstanceUID', '')), []).append(
+                                                                        (str_file, header))
+        if len(d_series) != 1:
+            raise ValueError("%s holds %d DICOM series (%s); give each its own directory" %
+                (str_path, len(d_series),
+                 ', '.join('%s: %d files' % (uid or '?', len(l)) for (uid, l) in d_series.items())))
+        (self.str_seriesUID, l_headers) = d_series.popitem()
+
+        for (str_file, header) in l_headers:
+            if int(header.get('SamplesPerPixel', 1)) != 1 or \
+                    int(header.get('NumberOfFrames', 1) or 1) != 1:
+                raise ValueError("%s is not a single frame grayscale image" % str_file)
+        self.l_slices   :   list    = sorted(l_headers, key = self.slice_order(l_headers))
+        self.lstr_files :   list    = [str_file for (str_file, header) in self.l_slices]
+
+        header          = self.l_slices[0][1]
+        center          = header_value(header.get('WindowCenter'))
+        width           = header_value(header.get('WindowWidth'))
+        # The series' own display window, in modality values, if it has one
+        self.headerWindow   = ()
+        if center is not None and width:
+            self.headerWindow   = (center - width / 2, center + width / 2)
+
+    @staticmethod
+    def header_read(str_file):
+        """
+        The indexing elements of the header of <str_file>, or None if it
+        is not a DICOM file.
+        """
+        import  pydicom
+        from    pydicom.errors      import InvalidDicomError
+
+        if not file_isDicom(str_file):
+            return None
+        try:
+            return pydicom.dcmread(str_file, stop_before_pixels = True,
+                                   specific_tags = Gl_INDEX_TAGS)
+        except (InvalidDicomError, OSError):
+            return None
+
+    @staticmethod
+    def slice_order(l_headers):
+        """
+        The sort key of the (file, header) slices <l_headers>: position
+        along the slice normal if every slice has the same orientation
+        and a position, then instance number, then file name.
+        """
+        l_orientation   = {tuple(header.get('ImageOrientationPatient') or ())
+                           for (str_file, header) in l_headers}
+        b_geometry      = len(l_orientation) == 1 and len(next(iter(l_orientation))) == 6 and \
+                          all(header.get('ImagePositionPatient') for (str_file, header) in l_headers)
+        normal          = None
+        if b_geometry:
+            orientation = np.array(next(iter(l_orientation)), dtype = np.float64)
+            normal      = np.cross(orientation[:3], orientation[3:])
+
+        def key(slice):
+            (str_file, header)  = slice
+            position    = 0.0
+            if normal is not None:
+                position    = float(np.dot(np.array(header.ImagePositionPatient, np.float64),
+                                           normal))
+            return (position, header_value(header.get('InstanceNumber'), 0.0), str_file)
+        return key
+
+    def values(self, i):
+        """
+        The modality (rescaled) values of slice <i>, as float32.
+        """
+        import  pydicom
+
+        (str_file, header)  = self.l_slices[i]
+        image       = pydicom.dcmread(str_file).pixel_array.astype(np.float32)
+        slope       = header_value(header.get('RescaleSlope'), 1.0)
+        intercept   = header_value(header.get('RescaleIntercept'), 0.0)
+        if slope != 1.0:
+            image  *= slope
+        if intercept:
+            image  += intercept
+        return image
+
+    def range(self) -> tuple:
+        """
+        The (min, max) intensity window of the series: its own display
+        window if it has one, otherwise the range of its modality
+        values, found by decoding every slice.
+        """
+        if self.headerWindow:
+            return self.headerWindow
+        with ThreadPoolExecutor(max_workers = self.threads) as pool:
+            l_range = list(pool.map(self.values_range, range(len(self))))
+        return (min(lo for (lo, hi) in l_range), max(hi for (lo, hi) in l_range))
+
+    def values_range(self, i) -> tuple:
+        image       = self.values(i)
+        return (float(image.min()), float(image.max()))
+
+    def __len__(self) -> int:
+        return len(self.l_slices)
+
+    def slice(self, i):
+        """
+        Slice <i> as an 8-bit grayscale image.
+        """
+        if not self.window:
+            self.window = self.range()
+        (lo, hi)    = self.window
+        image       = self.values(i)
+        image      -= lo
+        image      *= 255.0 / ((hi - lo) or 1.0)
+        return np.clip(image, 0, 255, out = image).astype(np.uint8)
+
+    def slices(self, l_index) -> list:
+        """
+        The slices <l_index>, decoded on the thread pool.
+        """
+        if not self.window:
+            self.window = self.range()
+        with ThreadPoolExecutor(max_workers = self.threads) as pool:
+            return list(pool.map(self.slice, l_index))
+
+    def close(self):
+        self.l_slices   = []
@@ -12,19 +12,44 @@
 from    chrisapp.base   import ChrisApp
 
 import  os
-import  glob
+import  shutil
 
-import  numpy                               as np
-from    matplotlib      import pyplot       as plt
-from    skimage.io      import imread
-from    skimage.metrics import structural_similarity    as ssim
-import  cv2
-import  imutils
+from    heatmap.profiling   import stage_timed, slice_timed, worker_timed, latency_summary
+from    heatmap             import budget, pairing
 
 import  inspect
+import  importlib
 import  json
+import  csv
+import  time
+import  cProfile
+from    functools           import partial
+from    concurrent.futures  import ProcessPoolExecutor
 
-import  pudb
+class LazyModule:
+    """
+    A module that is only imported when one of its attributes is first
+    used.
+    """
+
+    def __init__(self, str_name):
+        self.str_name   = str_name
+        self.module     = None
+
+    def __getattr__(self, str_attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.str_name)
+        return getattr(self.module, str_attr)
+
+# The imaging stack is only imported once there is image work to do:
+# registration and help calls (--json, --meta, --man, --version) then
+# load little more than chrisapp. The rest of this package's imaging
+# modules are imported where they are used.
+np                  = LazyModule('numpy')
+cv2                 = LazyModule('cv2')
+imutils             = LazyModule('imutils')
+metrics             = LazyModule('heatmap.metrics')
+preview             = LazyModule('heatmap.preview')
 
 Gstr_title = """
  _                _
@@ -57,6 +82,26 @@ Gstr_synopsis = """
             [--inputFilt1 <inputFilt1>]                                 \\
             [--inputSubDir2 <sample2Dir>]                               \\
             [--inputFilt2 <inputFilt2>]                                 \\
+            [--sliceWindow <N>]                                         \\
+            [--workers <N>]                                             \\
+            [--ssimEngine <engine>]                                     \\
+            [--sliceAxis <axis>]                                        \\
+            [--cacheDir <cacheDir>]                                     \\
+            [--cacheSize <MiB>]                                         \\
+            [--writeThreads <N>]                                        \\
+            [--pngCompression <level>]                                  \\
+            [--outputs <products>]                                      \\
+            [--profile]                                                 \\
+            [--tileSize <N>]                                            \\
+            [--shard <K/N>]                                             \\
+            [--merge]                                                   \\
+            [--metrics <metrics>]                                       \\
+            [--outputFormat <format>]                                   \\
+            [--memoryBudget <MiB>]                                      \\
+            [--pairKey <pairKey>]                                       \\
+            [--preview <factor>]                                        \\
+            [--previewTop <K>]                                          \\
+            [--previewThreshold <ssim>]                                 \\
             <inputDir>                                                  \\
             <outputDir>
 
@@ -82,8 +127,9 @@ Gstr_synopsis = """
         and measures.
 
         Output images are stored in a per-slice manner in the following
-        subdirectories of <outputDir>:
+        subdirectories of <outputDir> (see --outputs):
 
+            * naive         -   colour mapped absolute difference of A and B
             * heatmap       -   the actual heatmap difference
             * threshold     -   thresholded difference
             * contourA      -   difference rectangles on image A
@@ -92,6 +138,14 @@ Gstr_synopsis = """
         Output measure per image slice:
 
             * Structural Similarity Index, stored as JSON return.
+            * If a contour product is generated, the bounding boxes of
+              the difference regions, a list of [x, y, w, h] per slice
+              in boxes.json.
+
+        Slice pairs that are byte-identical (for example background
+        slices at either end of a volume) are not compared at all: they
+        are given a score of 1 and the constant outputs a comparison would
+        produce. run.json reports their number as 'identicalSlices'.
 
         The module assumes that each image set has the same number of
         constituent images (or slices) and that each constituent image
@@ -145,9 +199,406 @@ Gstr_synopsis = """
         [--imageFilt2 <imageFilt2>]
         The type of the images in <sample2Dir>.
 
+        [--sliceWindow <N>]
+        If specified and nonzero, stream the image sets through the
+        pipeline <N> slice pairs at a time: each window is read, compared,
+        written and then released before the next is read, so that peak
+        memory is bounded by the window and not by the size of the stack.
+        The default of 0 processes the whole stack in one pass.
+
+        [--workers <N>]
+        Number of processes used to compare slice pairs. Pairs are spread
+        over a process pool and gathered back in slice order, so that
+        SSIN.json is identical to a single process run. A value of 0 uses
+        every CPU available to the container. Default is 1.
+
+        [--ssimEngine <engine>]
+        The SSIM implementation to use. 'slice' (default) calls
+        scikit-image once per slice pair. 'stack' computes the scores and
+        difference maps of all slices in the current window in a single
+        vectorized float32 pass; scores agree with 'slice' to within 1e-4
+        and difference maps to within one grey level. Use with
+        --sliceWindow to bound its memory on large stacks.
+
+        [--sliceAxis <axis>]
+        Either <sample1Dir> or <sample2Dir> may instead name a NIfTI
+        (.nii, .nii.gz) or MGH (.mgh, .mgz) volume file, which is then
+        sliced along <axis> (default 2) directly into the comparison,
+        without writing intermediate image files. Uncompressed volumes
+        are memory-mapped; compressed ones are first decompressed in
+        chunks to a temporary file. Two volumes are scaled to 8 bits over
+        their common intensity range.
+
+        Either may also name a directory holding a DICOM series (which
+        needs the pydicom package). Its headers are indexed on a thread
+        pool, its slices ordered by ImagePositionPatient along the slice
+        normal (or else by InstanceNumber) rather than by file name, and
+        their pixel data decoded on a thread pool and mapped to 8 bits
+        through the series' WindowCenter/WindowWidth (or else its
+        intensity range), again without intermediate files. The
+        directory must hold a single series; <axis> does not apply.
+
+        [--cacheDir <cacheDir>]
+        If specified, keep a content-addressed cache of per-slice results
+        in <cacheDir>. Entries are keyed by a hash of each slice pair's
+        pixels and the processing parameters, and hold the SSIM score,
+        difference and threshold images and contour boxes, so that a rerun
+        only recomputes slices that changed. Output images of unchanged
+        slices already present in <outputDir> are not rewritten. Cache
+        hits and misses are reported in run.json. The (sorted) listings
+        of the image set directories are kept here as well, and reused
+        for as long as a directory's modification time is unchanged.
+
+        [--cacheSize <MiB>]
+        Size limit of the cache in MiB (default 4096). The least recently
+        used entries are evicted first.
+
+        [--writeThreads <N>]
+        Number of threads that encode and write output images (default
+        4). Images are queued to these threads through a bounded queue,
+        so that writing overlaps with the comparison of later slices.
+
+        [--pngCompression <level>]
+        PNG compression level of the output images, from 0 (fastest) to 9
+        (smallest). The default of -1 keeps the OpenCV default. With
+        --outputFormat npz it is the deflate level of the containers.
+
+        [--outputs <products>]
+        Comma separated list of the output products to generate, from
+        'naive', 'heatmap', 'threshold', 'contourA' and 'contourB' (the
+        default is all of them). Only the work the selected products
+        depend upon is done: 'scores' alone writes just SSIN.json and skips
+        the SSIM difference map, thresholding, contouring and all image
+        output, while e.g. 'heatmap' skips thresholding and contouring and
+        does not keep the input images once converted to grayscale.
+
+        [--profile]
+        If specified, profile the run with cProfile and save the profile
+        to <outputDir>/heatmap.prof, for viewing with e.g. snakeviz or
+        conversion to a flame graph with flameprof. Independently of this,
+        run.json reports for every stage its wall and CPU time, peak
+        resident memory and per-slice latency percentiles. CPU time
+        includes that of the --workers processes, which is also given
+        on its own, with their largest peak memory, as workerCpuTime and
+        workerPeakRSS; peakRSS is that of the main process over the stage.
+
+        [--tileSize <N>]
+        If specified and nonzero, compare each slice pair in tiles of <N>
+        by <N> pixels, for slices too large to process whole. Each tile
+        is padded by half the SSIM window from its neighbours, so that the
+        score and difference map match a whole-slice comparison (up to
+        floating point rounding); the Otsu threshold is computed from the
+        histogram of the whole difference map, and difference regions that
+        cross tile seams are merged into one box. Difference and threshold
+        images are held in temporary memory-mapped files, so that working
+        memory grows with the tile and not the slice size. Unlike whole
+        slice contouring, a region lying inside a hole of another region
+        gets its own box. Tiled slices are compared one at a time
+        (--workers and --ssimEngine do not apply).
+
+        [--shard <K/N>]
+        Process only the K-th of N contiguous, near equal parts of the
+        slice pairs (K counts from 1), so that a comparison can be fanned
+        out over N jobs. The range depends only on K, N and the number of
+        slices, and output images keep their global slice numbers. The
+        shard's SSIN.json holds its own scores only; run.json records its
+        slice range under 'shard'.
+
+        [--merge]
+        Merge the outputs of a set of --shard runs, each in its own
+        subdirectory of <inputDir>, into <outputDir> without recomputing
+        anything: scores (and slice keys and boxes) are concatenated in
+        slice order into one SSIN.json, images are hard linked (or
+        copied), npz containers are combined, and the run.json status
+        stacks are folded together, with each shard's range and timing
+        listed under 'shards'. The shards must cover every slice exactly
+        once. Preview scores are ranked again over the whole stack, and the
+        selection is the union of the shards' own (so --previewTop applies
+        per shard); the shards must all have been previewed alike.
+        --inputSubDir1/2 are still required but ignored.
+
+        [--metrics <metrics>]
+        Comma separated list of further per-slice similarity metrics to
+        compute, or 'all': 'mse' (mean squared error), 'psnr' (peak signal
+        to noise ratio, dB), 'ncc' (normalized cross-correlation),
+        'changed' (fraction of pixels over the difference threshold),
+        'contourCount', 'contourArea' and 'contourAreaMax' (bounding box
+        areas of the difference contours, in pixels). The metrics share
+        the grayscale slices and SSIM results already in memory, and are
+        written with the SSIM score as a table with one row per slice to
+        <outputDir>/metrics.csv. Metrics that need the threshold or the
+        contours have them computed even if no image product does.
+
+        [--outputFormat <format>]
+        Format of the output images. 'png' (default) writes a PNG file per
+        slice and product, in a directory per product. 'npz' instead writes
+        one file per product, <outputDir>/<product>.npz: a zip archive of
+        deflated per-slice arrays named after the slices, appended to as
+        slices complete, of which any one can be read on its own, e.g.
+        numpy.load('heatmap.npz')['slice-007']. With a cache, npz output
+        is always written in full.
+
+        [--memoryBudget <MiB>]
+        Memory to keep the run within, in MiB. The default of 0 uses the
+        container's (cgroup) memory limit, if there is one; -1 disables
+        budgeting. The memory held per slice pair, per comparison in
+        progress and for output (queued and in-flight images, box
+        outlines, cache entries) is estimated from the size of the first
+        slice pair, the products and the output format asked for, and
+        the stack is then streamed in the largest window (see
+        --sliceWindow, which it only ever narrows) that fits, dropping
+        workers if even a window of one slice per worker would not. The
+        plan and its estimate, which is approximate and on the generous
+        side, are reported under 'memory' in run.json.
+
+        [--pairKey <pairKey>]
+        How the files of the two image sets are paired: 'position' (the
+        default) pairs them in name order, so that a missing or stray
+        file shifts every later pair; 'stem' pairs the files whose names
+        are the same up to the extension; anything else is a regular
+        expression whose first group (or whole match) is the key, e.g.
+        '(\\d+)\\.png' -- keys made of digits pair in numeric order. Files
+        without a partner are left out and listed under 'unmatchedA'
+        and 'unmatchedB' in run.json. Volumes pair slices by position.
+
+        [--preview <factor>]
+        If nonzero, first run a quick triage pass: both stacks are
+        downsampled <factor> times in each direction and every slice
+        pair is scored at that resolution. Only the slices selected by
+        --previewTop and --previewThreshold are then compared (and
+        written) at full resolution; the others are null in SSIN.json.
+        run.json records the preview stage's scores, its ranking of the
+        slices from the most to the least dissimilar, and the selection,
+        as well as the full resolution stages. With neither selection
+        option, nothing is compared at full resolution.
+
+        [--previewTop <K>]
+        With --preview, compare the <K> most dissimilar slices at full
+        resolution.
+
+        [--previewThreshold <ssim>]
+        With --preview, compare the slices whose preview SSIM is below
+        <ssim> at full resolution (as well as any --previewTop slices).
+
 
 """
 
+def cpu_count() -> int:
+    """
+    Return the number of CPUs this process may actually use, honouring
+    both the CPU affinity mask and any cgroup CPU quota imposed by the
+    container runtime.
+    """
+    count       :   int     = len(os.sched_getaffinity(0))
+    l_quota     :   list    = []
+
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as fp:
+            l_quota = fp.read().split()
+        if l_quota[0] != 'max':
+            count   = min(count, max(1, int(l_quota[0]) // int(l_quota[1])))
+    except (OSError, IndexError, ValueError):
+        pass
+    return count
+
+# Output products, in the order they are written, and the intermediate
+# results each one depends upon. A run computes only the closure of the
+# products it is asked for.
+Gl_PRODUCTS     :   list    = ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']
+Gd_DEPENDS      :   dict    = {
+    'naive':        ['images'],
+    'heatmap':      ['diff'],
+    'threshold':    ['thresh'],
+    'contourA':     ['images', 'contours'],
+    'contourB':     ['images', 'contours'],
+    'contours':     ['thresh'],
+    'thresh':       ['diff'],
+    'diff':         [],
+    'images':       [],
+}
+
+# The imaging stack: numpy, OpenCV, scikit-image and the modules of
+# this package built on them.
+Gl_IMAGING      :   list    = [
+    'numpy', 'cv2', 'imutils', 'skimage.metrics',
+    'heatmap.stackssim', 'heatmap.tiled', 'heatmap.volume', 'heatmap.cache',
+    'heatmap.writer', 'heatmap.metrics', 'heatmap.preview',
+]
+
+def modules_load():
+    """
+    Import the imaging stack now, rather than on first use.
+    """
+    for str_module in Gl_IMAGING:
+        importlib.import_module(str_module)
+
+def products_resolve(lstr_products) -> frozenset:
+    """
+    Everything that must be computed to produce <lstr_products>.
+    """
+    s_needs     :   set     = set()
+    l_todo      :   list    = list(lstr_products)
+
+    while l_todo:
+        str_node    = l_todo.pop()
+        if str_node not in s_needs:
+            s_needs.add(str_node)
+            l_todo.extend(Gd_DEPENDS[str_node])
+    return frozenset(s_needs)
+
+def shard_parse(str_shard) -> tuple:
+    """
+    Parse a 'K/N' shard specification into (K, N), 1 <= K <= N.
+    """
+    try:
+        (index, count)  = (int(str_part) for str_part in str_shard.split('/'))
+    except ValueError:
+        raise ValueError("Shard '%s' is not of the form K/N" % str_shard)
+    if not 1 <= index <= count:
+        raise ValueError("Shard '%s' is not one of 1/N to N/N" % str_shard)
+    return (index, count)
+
+def shard_range(index, count, sliceCount) -> tuple:
+    """
+    The [start, stop) slice range of shard <index> of <count> over a
+    stack of <sliceCount> slices: contiguous, as equal as possible, and
+    depending on nothing else so that every node agrees on it.
+    """
+    return ((index - 1) * sliceCount // count, index * sliceCount // count)
+
+def image_isGray(str_file) -> bool:
+    """
+    Does <str_file> hold a single channel (grayscale, with or without
+    alpha) image? Only the PNG header is inspected; other formats are
+    reported as colour.
+    """
+    with open(str_file, 'rb') as fp:
+        header  = fp.read(26)
+    return len(header) == 26                        and \
+            header[:8]      == b'\x89PNG\r\n\x1a\n'   and \
+            header[12:16]   == b'IHDR'              and \
+            header[25] in (0, 4)
+
+def slice_compare(imageAgray, imageBgray, s_needs = frozenset(Gd_DEPENDS)) -> tuple:
+    """
+    Compare a single pair of grayscale slices, returning the SSIM
+    score, the difference image, its threshold and the bounding boxes
+    of its contours. Any of the latter three that are not in <s_needs>
+    are not computed and returned as None.
+
+    This is a module level function so that it can be shipped to the
+    workers of a process pool.
+    """
+    from    skimage.metrics import structural_similarity    as ssim
+
+    if 'diff' not in s_needs:
+        return (ssim(imageAgray, imageBgray), None, None, None)
+    (score, imdiff)         = ssim(imageAgray, imageBgray, full = True)
+    # convert normalized float imdiff to integer ranges
+    imageDiff               = (imdiff * 255).astype("uint8")
+    return (score, imageDiff) + slice_segment(imageDiff, s_needs)
+
+def slice_measure(func, lstr_metrics, imageAgray, imageBgray, *args) -> tuple:
+    """
+    Call <func> on <args>, or on the slice pair <imageAgray>,
+    <imageBgray> if there are none, and return its result with the
+    values (or None) of the metrics <lstr_metrics> of the pair. The
+    metrics are measured in the same call, on the same pool worker, as
+    the comparison; those that need them take its threshold and boxes
+    from the last two parts of its result.
+    """
+    result                  = func(*(args or (imageAgray, imageBgray)))
+    if not lstr_metrics:
+        return (result, None)
+    return (result, metrics.metrics_compute(lstr_metrics, imageAgray, imageBgray,
+                                            *result[-2:]))
+
+def contours_toBoxes(contours):
+    """
+    The (x, y, w, h) bounding boxes of <contours> as an (N, 4) array,
+    as cv2.boundingRect() gives them, found for all the contours at once.
+    """
+    if not len(contours):
+        return np.zeros((0, 4), np.int32)
+    points  = np.concatenate(contours).reshape(-1, 2)
+    starts  = np.cumsum([0] + [len(c) for c in contours[:-1]])
+    lo      = np.minimum.reduceat(points, starts)
+    hi      = np.maximum.reduceat(points, starts)
+    return np.concatenate([lo, hi - lo + 1], axis = 1).astype(np.int32)
+
+def slice_segment(imageDiff, s_needs = frozenset(Gd_DEPENDS)) -> tuple:
+    """
+    Otsu threshold a difference image and find the bounding boxes, as
+    an (N, 4) array of (x, y, w, h), of the external contours of the
+    thresholded regions, as far as <s_needs> asks for them.
+    """
+    imageThresh             = None
+    boxes                   = None
+    if 'thresh' in s_needs:
+        imageThresh         = cv2.threshold(
+            imageDiff, 0, 255,
+            cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
+    if 'contours' in s_needs:
+        contour             = cv2.findContours(
+            imageThresh.copy(),
+            cv2.RETR_EXTERNAL,
+            cv2.CHAIN_APPROX_SIMPLE
+        )
+        boxes               = contours_toBoxes(imutils.grab_contours(contour))
+    return (imageThresh, boxes)
+
+# Box outlines are drawn box by box, at a cost that grows with the
+# number of boxes, unless there are at least BOXES_BATCH of them packed
+# into no more than BOXES_AREA pixels each of their bounding area: then
+# they are found all at once, at a cost that grows with that area.
+BOXES_BATCH     :   int     = 1024
+BOXES_AREA      :   int     = 128
+
+def boxes_outline(boxes, shape) -> tuple:
+    """
+    The outlines of <boxes>, in an image of <shape>, exactly as
+    cv2.rectangle() draws them 2 pixels thick, found for all the boxes
+    at once: (top, left, mask), a boolean mask over just the bounding
+    area of the outlines, at (top, left) in the image.
+    """
+    (height, width)         = shape[:2]
+    (x0, y0)                = (boxes[:, 0].astype(np.int64), boxes[:, 1].astype(np.int64))
+    (x1, y1)                = (x0 + boxes[:, 2], y0 + boxes[:, 3])
+    # Such a rectangle is four 3 pixel wide bands: the horizontal edges
+    # spanning x0..x1 and the vertical edges spanning y0..y1.
+    top                     = np.concatenate([y0 - 1, y1 - 1, y0,     y0    ]).clip(0)
+    bottom                  = np.concatenate([y0 + 1, y1 + 1, y1,     y1    ]).clip(None, height - 1)
+    left                    = np.concatenate([x0,     x0,     x0 - 1, x1 - 1]).clip(0)
+    right                   = np.concatenate([x1,     x1,     x0 + 1, x1 + 1]).clip(None, width - 1)
+    keep                    = (top <= bottom) & (left <= right)
+    (top, bottom, left, right) = (top[keep], bottom[keep] + 1, left[keep], right[keep] + 1)
+    if not len(top):
+        return (0, 0, np.zeros((0, 0), bool))
+    (ya, xa)                = (top.min(), left.min())
+    (top, bottom, left, right) = (top - ya, bottom - ya, left - xa, right - xa)
+    # The bands are painted together by marking their corners +/-1 and
+    # summing the marks up, in place, over rows and columns.
+    marks                   = np.zeros((bottom.max() + 1, right.max() + 1), np.int32)
+    for (rows, cols, sign) in [ (top, left, 1), (top, right, -1),
+                                (bottom, left, -1), (bottom, right, 1)]:
+        np.add.at(marks, (rows, cols), sign)
+    np.cumsum(marks, 0, out = marks)
+    np.cumsum(marks, 1, out = marks)
+    return (int(ya), int(xa), marks[:-1, :-1] > 0)
+
+def boxes_draw(image, boxes, outline = None):
+    """
+    Draw <boxes> in red, 2 pixels thick, on the BGR <image>: box by box,
+    or by the <outline> of them all from boxes_outline().
+    """
+    if outline is None:
+        for (x, y, w, h) in boxes.tolist():
+            cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
+        return image
+    (top, left, mask)       = outline
+    image[top : top + mask.shape[0], left : left + mask.shape[1]][mask] = (0, 0, 255)
+    return image
+
 class Heatmap(ChrisApp):
     """
     A ChRIS DS plugin that compares two different image sets and
@@ -160,10 +611,10 @@ class Heatmap(ChrisApp):
     ICON                    = '' # url of an icon image
     MAX_NUMBER_OF_WORKERS   = 1  # Override with integer value
     MIN_NUMBER_OF_WORKERS   = 1  # Override with integer value
-    MAX_CPU_LIMIT           = '' # Override with millicore value as string, e.g. '2000m'
-    MIN_CPU_LIMIT           = '' # Override with millicore value as string, e.g. '2000m'
-    MAX_MEMORY_LIMIT        = '' # Override with string, e.g. '1Gi', '2000Mi'
-    MIN_MEMORY_LIMIT        = '' # Override with string, e.g. '1Gi', '2000Mi'
+    MAX_CPU_LIMIT           = '32000m' # Override with millicore value as string, e.g. '2000m'
+    MIN_CPU_LIMIT           = '1000m'  # Override with millicore value as string, e.g. '2000m'
+    MAX_MEMORY_LIMIT        = '32000Mi' # Override with string, e.g. '1Gi', '2000Mi'
+    MIN_MEMORY_LIMIT        = '500Mi'   # Override with string, e.g. '1Gi', '2000Mi'
     MIN_GPU_LIMIT           = 0  # Override with the minimum number of GPUs, as an integer, for your plugin
     MAX_GPU_LIMIT           = 0  # Override with the maximum number of GPUs, as an integer, for your plugin
 
@@ -180,6 +631,11 @@ class Heatmap(ChrisApp):
     # output directory.
     OUTPUT_META_DICT = {}
 
+    # Process pools kept across runs, by worker count, when a server
+    # sets this to a dict; otherwise each run starts and shuts down its
+    # own.
+    d_pools                 = None
+
     def method_name(self):
         return inspect.stack()[1][3]
 
@@ -218,7 +674,148 @@ class Heatmap(ChrisApp):
             default     = "png",
             help        = "Some string filter on the second image file"
         )
+        self.add_argument('--pairKey',
+            dest        = 'str_pairKey',
+            type        = str,
+            optional    = True,
+            default     = "position",
+            help        = "Pair image files by 'position', 'stem' or a regular expression key"
+        )
+        self.add_argument('--sliceWindow',
+            dest        = 'sliceWindow',
+            type        = int,
+            optional    = True,
+            default     = 0,
+            help        = 'If nonzero, stream the stacks in windows of this many slices'
+        )
+        self.add_argument('--workers',
+            dest        = 'workers',
+            type        = int,
+            optional    = True,
+            default     = 1,
+            help        = 'Number of processes comparing slices (0 for all CPUs)'
+        )
+        self.add_argument('--ssimEngine',
+            dest        = 'str_ssimEngine',
+            type        = str,
+            optional    = True,
+            default     = "slice",
+            help        = "SSIM engine: 'slice' (per slice pair) or 'stack' (batched)"
+        )
+        self.add_argument('--sliceAxis',
+            dest        = 'sliceAxis',
+            type        = int,
+            optional    = True,
+            default     = 2,
+            help        = 'Axis along which volume inputs are sliced'
+        )
+        self.add_argument('--tileSize',
+            dest        = 'tileSize',
+            type        = int,
+            optional    = True,
+            default     = 0,
+            help        = 'If nonzero, compare each slice in tiles of this many pixels square'
+        )
+        self.add_argument('--cacheDir',
+            dest        = 'str_cacheDir',
+            type        = str,
+            optional    = True,
+            default     = "",
+            help        = 'Directory of a per-slice result cache (disabled if empty)'
+        )
+        self.add_argument('--cacheSize',
+            dest        = 'cacheSize',
+            type        = int,
+            optional    = True,
+            default     = 4096,
+            help        = 'Size limit of the result cache in MiB'
+        )
+        self.add_argument('--writeThreads',
+            dest        = 'writeThreads',
+            type        = int,
+            optional    = True,
+            default     = 4,
+            help        = 'Number of threads encoding and writing output images'
+        )
+        self.add_argument('--pngCompression',
+            dest        = 'pngCompression',
+            type        = int,
+            optional    = True,
+            default     = -1,
+            help        = 'PNG compression level 0-9 (-1 for the OpenCV default)'
+        )
+        self.add_argument('--outputs',
+            dest        = 'str_outputs',
+            type        = str,
+            optional    = True,
+            default     = ','.join(Gl_PRODUCTS),
+            help        = "Comma separated output products, or 'scores' for SSIN.json only"
+        )
+        self.add_argument('--profile',
+            dest        = 'b_profile',
+            type        = bool,
+            optional    = True,
+            default     = False,
+            help        = 'Write a cProfile dump of the run to <outputDir>/heatmap.prof'
+        )
+        self.add_argument('--outputFormat',
+            dest        = 'str_outputFormat',
+            type        = str,
+            optional    = True,
+            default     = "png",
+            help        = "Output image format: 'png' (a file per slice) or 'npz' (a file per product)"
+        )
+        self.add_argument('--metrics',
+            dest        = 'str_metrics',
+            type        = str,
+            optional    = True,
+            default     = "",
+            help        = "Comma separated per-slice metrics for metrics.csv, or 'all'"
+        )
+        self.add_argument('--preview',
+            dest        = 'preview',
+            type        = int,
+            optional    = True,
+            default     = 0,
+            help        = 'If nonzero, first score the slices downsampled by this factor'
+        )
+        self.add_argument('--previewTop',
+            dest        = 'previewTop',
+            type        = int,
+            optional    = True,
+            default     = 0,
+            help        = 'Compare the K most dissimilar preview slices at full resolution'
+        )
+        self.add_argument('--previewThreshold',
+            dest        = 'previewThreshold',
+            type        = float,
+            optional    = True,
+            default     = 0.0,
+            help        = 'Compare slices with a preview SSIM below this at full resolution'
+        )
+        self.add_argument('--memoryBudget',
+            dest        = 'memoryBudget',
+            type        = int,
+            optional    = True,
+            default     = 0,
+            help        = 'Memory budget in MiB (0 for the container limit, if any; -1 for none)'
+        )
+        self.add_argument('--shard',
+            dest        = 'str_shard',
+            type        = str,
+            optional    = True,
+            default     = "",
+            help        = "Process only shard K of N ('K/N') of the slice pairs"
+        )
+        self.add_argument('--merge',
+            dest        = 'b_merge',
+            type        = bool,
+            optional    = True,
+            default     = False,
+            help        = 'Merge the shard outputs found under <inputDir> into <outputDir>'
+        )
 
+    @stage_timed
     def imageFileNames_determine(self, options) -> dict:
         """
         Simply just determines the names of files to load
@@ -227,34 +824,106 @@ class Heatmap(ChrisApp):
         b_status    :   bool    = False
         imageAcount :   int     = 0
         imageBcount :   int     = 0
+        lstr_namesA :   list    = []
+        lstr_namesB :   list    = []
+
+        from    heatmap.volume      import Volume, volume_check
+        from    heatmap.dicom       import DicomSeries, dicom_check
 
         print("\n--->Determining list of image filenames<---")
 
         print("%-75s" % ("Image set A (%s)... " % options.str_inputSubDir1), end = "")
-        for entry in sorted(os.scandir(
-           os.path.join(options.inputdir, options.str_inputSubDir1)
-            ), key=lambda e: e.name):
-            if options.str_imageFilt1 in entry.name:
-                str_fileA = entry.path
-                self.lstr_imageAfiles.append(str_fileA)
-                # print("Adding %s" % str_fileA)
-                imageAcount += 1
-        print("%d images"  % imageAcount)
+        str_pathA   = os.path.join(options.inputdir, options.str_inputSubDir1)
+        if volume_check(str_pathA):
+            self.vol_A  = Volume(str_pathA, options.sliceAxis)
+            imageAcount = len(self.vol_A)
+            print("%d volume slices" % imageAcount)
+        else:
+            # Listed once, through the listing cache, both to look for a
+            # DICOM series and for the image files.
+            lstr_listing    = pairing.listing_read(str_pathA, options.str_cacheDir)
+            if dicom_check(str_pathA, lstr_listing):
+                self.vol_A  = DicomSeries(str_pathA)
+                imageAcount = len(self.vol_A)
+                print("%d DICOM slices" % imageAcount)
+            else:
+                lstr_namesA = [ str_name for str_name in lstr_listing
+                                if options.str_imageFilt1 in str_name]
+                imageAcount = len(lstr_namesA)
+                print("%d images"  % imageAcount)
 
         print("%-75s" % ("Image set B (%s)... " % options.str_inputSubDir2), end = "")
-        for entry in sorted(os.scandir(
-           os.path.join(options.inputdir, options.str_inputSubDir2)
-            ), key=lambda e: e.name):
-            if options.str_imageFilt2 in entry.name:
-                str_fileB = entry.path
-                self.lstr_imageBfiles.append(str_fileB)
-                # print("Adding %s" % str_fileB)
-                imageBcount += 1
-        print("%d images"  % imageBcount)
+        str_pathB   = os.path.join(options.inputdir, options.str_inputSubDir2)
+        if volume_check(str_pathB):
+            self.vol_B  = Volume(str_pathB, options.sliceAxis)
+            imageBcount = len(self.vol_B)
+            print("%d volume slices" % imageBcount)
+        else:
+            # Listed once, through the listing cache, both to look for a
+            # DICOM series and for the image files.
+            lstr_listing    = pairing.listing_read(str_pathB, options.str_cacheDir)
+            if dicom_check(str_pathB, lstr_listing):
+                self.vol_B  = DicomSeries(str_pathB)
+                imageBcount = len(self.vol_B)
+                print("%d DICOM slices" % imageBcount)
+            else:
+                lstr_namesB = [ str_name for str_name in lstr_listing
+                                if options.str_imageFilt2 in str_name]
+                imageBcount = len(lstr_namesB)
+                print("%d images"  % imageBcount)
+
+        # Image files are paired by position or by a key of their names;
+        # volume slices always by position.
+        str_pairKey = options.str_pairKey
+        if self.vol_A or self.vol_B:
+            str_pairKey = 'position'
+        (l_pairs, lstr_unmatchedA, lstr_unmatchedB) = pairing.pairs_index(
+                                            lstr_namesA, lstr_namesB, str_pairKey)
+        if str_pairKey == 'position':
+            self.lstr_imageAfiles   = [os.path.join(str_pathA, str_name) for str_name in lstr_namesA]
+            self.lstr_imageBfiles   = [os.path.join(str_pathB, str_name) for str_name in lstr_namesB]
+        else:
+            self.lstr_imageAfiles   = [os.path.join(str_pathA, a) for (a, b) in l_pairs]
+            self.lstr_imageBfiles   = [os.path.join(str_pathB, b) for (a, b) in l_pairs]
+            print("%-75s%d pairs" % ("Pairing by %s... " % str_pairKey, len(l_pairs)))
+            for (str_set, lstr_unmatched) in [('A', lstr_unmatchedA), ('B', lstr_unmatchedB)]:
+                if lstr_unmatched:
+                    print("%d unmatched in image set %s: %s%s" % (
+                        len(lstr_unmatched), str_set, ', '.join(lstr_unmatched[:5]),
+                        ', ...' if len(lstr_unmatched) > 5 else ''))
+
+        # Two volumes are scaled to 8 bits over their common intensity
+        # range so that their slices remain comparable.
+        if self.vol_A and self.vol_B:
+            (loA, hiA)  = self.vol_A.range()
+            (loB, hiB)  = self.vol_B.range()
+            self.vol_A.window = self.vol_B.window = (min(loA, loB), max(hiA, hiB))
+
+        # Slices are compared pairwise, up to the shorter of the two sets,
+        # or only over this run's part of them if sharded.
+        self.sliceCount = min(imageAcount, imageBcount)
+        if str_pairKey != 'position':
+            self.sliceCount = len(l_pairs)
+        self.shardStop  = self.sliceCount
+        if options.str_shard:
+            (index, count)  = shard_parse(options.str_shard)
+            if count > self.sliceCount:
+                raise ValueError("Cannot split %d slices into %d shards" %
+                                    (self.sliceCount, count))
+            (self.shardStart, self.shardStop)   = shard_range(index, count, self.sliceCount)
+            # Slice keys are indexed by global slice number.
+            self.l_sliceKeys    = [None] * self.shardStart
+        self.sliceStart = self.shardStart
+        self.sliceStop  = self.shardStop
 
         # This remainder is just for return message status and reporting
         if imageAcount and imageBcount:
-            if imageAcount == imageBcount:
+            if str_pairKey != 'position':
+                b_status = bool(l_pairs)
+                str_message  = \
+                "Paired %d images by %s, %d and %d left unmatched" % \
+                    (len(l_pairs), str_pairKey, len(lstr_unmatchedA), len(lstr_unmatchedB))
+            elif imageAcount == imageBcount:
                 b_status = True
                 str_message  = \
                 "Successfully determined image files to load and checks pass"
@@ -272,15 +941,86 @@ class Heatmap(ChrisApp):
             'method':   self.method_name(),
             'message':  str_message,
             'sizeSetA': imageAcount,
-            'sizeSetB': imageBcount
+            'sizeSetB': imageBcount,
+            'pairKey':      str_pairKey,
+            'pairCount':    self.sliceCount,
+            'unmatchedA':   lstr_unmatchedA,
+            'unmatchedB':   lstr_unmatchedB
         }
 
-    def imageSlices_populate(self, options, d_prior)  -> dict:
+    @stage_timed
+    def slices_preview(self, options, d_prior) -> dict:
         """
-        Populate each image slice with a cv2 "image"/"matrix".
+        Triage the slice pairs at reduced resolution: each pair is read,
+        converted to grayscale and downsampled by ``--preview``, and
+        scored, and the slices to compare at full resolution are then
+        selected from the ranking of the scores by ``--previewTop`` and
+        ``--previewThreshold``.
+        """
+        b_status    :   bool    = False
+        l_previewA  :   list    = []
+        l_previewB  :   list    = []
+        l_latency   :   list    = []
+        l_scores    :   list    = []
+        l_ranking   :   list    = []
+        l_selected  :   list    = []
+
+        print("\n--->Previewing slices at 1/%d resolution<---" % options.preview)
+        if d_prior['status']:
+            b_status    = True
+            print("%-75s" % "reading and downsampling... ", end = "")
+            # Slices are read a window at a time, volume slices decoded
+            # together (on threads, for DICOM) as imageSlices_populate()
+            # does; the time of a window is shared out evenly over it.
+            window      = self.sliceWindow or (self.shardStop - self.shardStart)
+            for start in range(self.shardStart, self.shardStop, window):
+                l_index         = list(range(start, min(start + window, self.shardStop)))
+                tic             = time.perf_counter()
+                for (volume, lstr_files, l_preview) in [
+                        (self.vol_A, self.lstr_imageAfiles, l_previewA),
+                        (self.vol_B, self.lstr_imageBfiles, l_previewB)]:
+                    l_image     = volume.slices(l_index) if volume else \
+                                  (self.image_read(lstr_files[i]) for i in l_index)
+                    l_preview.extend(preview.slice_downsample(self.image_toGrayScale(image),
+                                                              options.preview)
+                                     for image in l_image)
+                l_latency.extend([(time.perf_counter() - tic) / len(l_index)] * len(l_index))
+            print("%d slice pairs." % len(l_latency))
+            print("%-75s" % "scoring... ", end = "")
+            for (i, (seconds, result)) in enumerate(self.slices_map(
+                    partial(slice_timed, partial(slice_compare, s_needs = frozenset())),
+                    l_previewA, l_previewB)):
+                l_scores.append(result[0])
+                l_latency[i]   += seconds
+            self.timer.slices_add(l_latency)
+            # Positions in the shard, reported as slice numbers
+            l_ranking   = [self.shardStart + i for i in preview.slices_rank(l_scores)]
+            l_selected  = [self.shardStart + i for i in preview.slices_select(
+                            l_scores, options.previewTop, options.previewThreshold)]
+            self.l_selected = [False] * self.sliceCount
+            for i in l_selected:
+                self.l_selected[i]  = True
+            print("%d of %d selected." % (len(l_selected), len(l_scores)))
+
+        return {
+            'status':       b_status,
+            'method':       self.method_name(),
+            'factor':       options.preview,
+            'top':          options.previewTop,
+            'threshold':    options.previewThreshold,
+            'scores':       l_scores,
+            'ranking':      l_ranking,
+            'selected':     l_selected,
+            'd_stack':      d_prior
+        }
 
-        This method is probably what needs to be factored for
-        reading mgz vol slices into the image list.
+    @stage_timed
+    def imageSlices_populate(self, options, d_prior)  -> dict:
+        """
+        Populate each image slice with a cv2 "image"/"matrix", either
+        read from an image file or taken from a volume. Slices are BGR
+        only if they are colour and a colour product needs them, and
+        single channel grayscale otherwise.
         """
 
         fileCount   :   int     = 0
@@ -288,12 +1028,29 @@ class Heatmap(ChrisApp):
 
         print("\n--->Reading actual image files<---")
         if d_prior['status']:
+            b_status                            = True
             print("%-75s" % "loading image set A and set B... ", end = "")
-            for (str_fileA, str_fileB) in zip(  self.lstr_imageAfiles,
-                                                self.lstr_imageBfiles):
-                b_status                        = True
-                self.l_imageA.append(cv2.imread(str_fileA))
-                self.l_imageB.append(cv2.imread(str_fileB))
+            # The slices of the window, less any a preview left out:
+            self.l_sliceIndex   = [ i for i in range(self.sliceStart, self.sliceStop)
+                                    if self.l_selected is None or self.l_selected[i]]
+            # Volume slices go straight in as 8-bit grayscale, decoded
+            # for the whole window at once (on threads, for DICOM); their
+            # time is shared out evenly over the slices.
+            tic             = time.perf_counter()
+            l_volumeA       = self.vol_A.slices(self.l_sliceIndex) if self.vol_A else None
+            l_volumeB       = self.vol_B.slices(self.l_sliceIndex) if self.vol_B else None
+            seconds         = (time.perf_counter() - tic) / max(1, len(self.l_sliceIndex))
+            for (k, i) in enumerate(self.l_sliceIndex):
+                tic         = time.perf_counter()
+                if l_volumeA:
+                    self.l_imageA.append(l_volumeA[k])
+                else:
+                    self.l_imageA.append(self.image_read(self.lstr_imageAfiles[i]))
+                if l_volumeB:
+                    self.l_imageB.append(l_volumeB[k])
+                else:
+                    self.l_imageB.append(self.image_read(self.lstr_imageBfiles[i]))
+                self.timer.slices_add([seconds + time.perf_counter() - tic])
                 fileCount += 1
             print("%d files read." % fileCount)
 
@@ -304,6 +1061,39 @@ class Heatmap(ChrisApp):
             'd_stack':      d_prior
         }
 
+    def image_read(self, str_file):
+        """
+        Read an image file. Single channel images are decoded directly
+        as grayscale; colour images are decoded as BGR but only kept as
+        such if a product drawn on the input images was requested.
+        Colour versions of grayscale images are made when written.
+        """
+        if image_isGray(str_file):
+            return cv2.imread(str_file, cv2.IMREAD_GRAYSCALE)
+        image   = cv2.imread(str_file)
+        if 'images' not in self.s_needs:
+            image   = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+    def image_toGrayScale(self, image):
+        """
+        A grayscale version of <image>, which is returned as is if it
+        already has a single channel.
+        """
+        if image.ndim == 2:
+            return image
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    def image_toColour(self, image):
+        """
+        A BGR version of <image>, so that coloured annotations can be
+        drawn on it.
+        """
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return image
+
+    @stage_timed
     def imageSlices_toGrayScale(self, options, d_prior)  -> dict:
         """
         Convert each image slice to gray scale.
@@ -315,17 +1105,17 @@ class Heatmap(ChrisApp):
 
         print("\n--->Converting to grayScale<---")
         if d_prior['status']:
+            b_status                    = True
             print("%-75s" % "converting image set A and set B... ", end = "")
             for i in range(0, len(self.l_imageA)):
-                b_status                = True
-                self.l_imageAgray.append(
-                    cv2.cvtColor(   self.l_imageA[i],
-                                    cv2.COLOR_BGR2GRAY)
-                )
-                self.l_imageBgray.append(
-                    cv2.cvtColor( self.l_imageB[i],
-                                  cv2.COLOR_BGR2GRAY)
-                )
+                with self.timer.slice():
+                    self.l_imageAgray.append(self.image_toGrayScale(self.l_imageA[i]))
+                    self.l_imageBgray.append(self.image_toGrayScale(self.l_imageB[i]))
+                # Only the naive and contour products need the images
+                # as read; otherwise let them go as soon as possible.
+                if 'images' not in self.s_needs:
+                    self.l_imageA[i]    = None
+                    self.l_imageB[i]    = None
             print("%d images converted." % i)
 
         return {
@@ -334,139 +1124,689 @@ class Heatmap(ChrisApp):
             'd_stack':  d_prior
         }
 
+    def slices_compare(self, options, l_index):
+        """
+        Compare the grayscale slice pairs at positions <l_index> of the
+        current window, yielding (seconds, ((score, diff, threshold,
+        boxes), values)) for each in order, where <seconds> is the time
+        spent on that slice and <values> those of its metrics, measured
+        alongside the comparison, or None if they were not.
+        """
+        from    heatmap.stackssim   import ssim_stack
+        from    heatmap.tiled       import slice_compareTiled
+
+        l_imageAgray    = [self.l_imageAgray[i] for i in l_index]
+        l_imageBgray    = [self.l_imageBgray[i] for i in l_index]
+
+        if options.tileSize:
+            # Slices this large are compared one at a time, here: the
+            # memory-mapped results should not be pickled back from a pool.
+            return map(partial(slice_timed, partial(slice_measure,
+                                partial(slice_compareTiled, tileSize    = options.tileSize,
+                                                            s_needs     = self.s_needs),
+                                self.lstr_metrics)),
+                       l_imageAgray, l_imageBgray)
+        if options.str_ssimEngine == 'stack' and \
+                self.slices_stackable(l_imageAgray + l_imageBgray):
+            # The batched SSIM time is shared out evenly over the slices.
+            tic         = time.perf_counter()
+            if 'diff' not in self.s_needs:
+                scores  = ssim_stack(np.stack(l_imageAgray),
+                                     np.stack(l_imageBgray), full = False)
+                seconds = (time.perf_counter() - tic) / len(scores)
+                return ((seconds, ((score, None, None, None), None)) for score in scores)
+            (scores, S) = ssim_stack(np.stack(l_imageAgray),
+                                     np.stack(l_imageBgray))
+            # convert normalized float S to integer ranges
+            l_diff      = list((S * 255).astype("uint8"))
+            del S
+            seconds     = (time.perf_counter() - tic) / len(scores)
+            # The slice pairs only go to the workers to be measured.
+            if not self.lstr_metrics:
+                l_imageAgray    = l_imageBgray  = [None] * len(l_diff)
+            return (
+                (seconds + segmentSeconds, ((score, imageDiff) + segment, values))
+                for (score, imageDiff, (segmentSeconds, (segment, values))) in zip(
+                    scores, l_diff,
+                    self.slices_map(partial(slice_timed, partial(slice_measure,
+                                        partial(slice_segment, s_needs = self.s_needs),
+                                        self.lstr_metrics)),
+                                    l_imageAgray, l_imageBgray, l_diff)
+                )
+            )
+        return self.slices_map(partial(slice_timed, partial(slice_measure,
+                                    partial(slice_compare, s_needs = self.s_needs),
+                                    self.lstr_metrics)),
+                               l_imageAgray, l_imageBgray)
+
+    @stage_timed
     def grayScale_slicesProcess(self, options, d_prior):
         """
         The core of this plugin.
         """
         b_status    :   bool    = False
-        i           :   int     = 0
+        l_results   :   list    = [None] * len(self.l_imageAgray)
+        l_latency   :   list    = [0.0] * len(self.l_imageAgray)
+        l_values    :   list    = [None] * len(self.l_imageAgray)
+        l_keys      :   list    = []
+        l_todo      :   list    = []
+        hits        :   int     = 0
 
         print("\n--->Processing grayScale slices<---")
         if d_prior['status']:
+            b_status    = True
             print("%-75s" % "calculating... ", end = "")
-            for i in range(0, len(self.l_imageA)):
-                b_status                = True
-                # print("Calculating difference for slice  %3d..." % i)
-                (score, imdiff)         = ssim(
-                                                self.l_imageAgray[i],
-                                                self.l_imageBgray[i],
-                                                full = True
-                                        )
-                # convert normalized float imdiff to integer ranges
-                self.l_imageDiff.append((imdiff * 255).astype("uint8"))
+            # Byte-identical pairs need no comparison at all.
+            for i in range(len(self.l_imageAgray)):
+                tic             = time.perf_counter()
+                self.l_sliceSame.append(self.slice_same(i))
+                if self.l_sliceSame[i]:
+                    l_results[i]    = self.slice_sameResult(self.l_imageAgray[i].shape)
+                l_latency[i]    = time.perf_counter() - tic
+            if self.cache:
+                hits        = self.cache.hits
+                for (i, (imageAgray, imageBgray)) in enumerate(
+                        zip(self.l_imageAgray, self.l_imageBgray)):
+                    tic             = time.perf_counter()
+                    l_keys.append(self.cache.key([imageAgray, imageBgray],
+                                                 options.str_ssimEngine,
+                                                 options.tileSize,
+                                                 sorted(self.s_needs - {'images'})))
+                    if l_results[i] is None:
+                        l_results[i]    = self.cache.get(l_keys[i])
+                    l_latency[i]   += time.perf_counter() - tic
+                hits        = self.cache.hits - hits
+            l_todo      = [i for (i, result) in enumerate(l_results) if result is None]
+            # Results are gathered in slice order regardless of which
+            # worker computed them.
+            for (i, (seconds, (result, values))) in zip(l_todo,
+                                                        self.slices_compare(options, l_todo)):
+                l_results[i]    = result
+                l_values[i]     = values
+                l_latency[i]   += seconds
+                if self.cache:
+                    self.cache.put(l_keys[i], *result)
+            # Slices that were not measured as they were compared --
+            # identical pairs, cache hits, batched scores -- are measured
+            # now, on the pool.
+            l_measure   = [i for (i, values) in enumerate(l_values) if values is None]
+            if self.lstr_metrics and l_measure:
+                for (i, (seconds, values)) in zip(l_measure, self.slices_map(
+                        partial(slice_timed, partial(metrics.metrics_compute, self.lstr_metrics)),
+                        [self.l_imageAgray[i]   for i in l_measure],
+                        [self.l_imageBgray[i]   for i in l_measure],
+                        [l_results[i][2]        for i in l_measure],
+                        [l_results[i][3]        for i in l_measure])):
+                    l_values[i]     = values
+                    l_latency[i]   += seconds
+            for (i, (score, imageDiff, imageThresh, boxes)) in enumerate(l_results):
+                self.slices_pad(self.l_sliceIndex[i])
+                if self.cache:
+                    self.l_sliceKeys.append(self.slice_key(options, i, l_keys[i]))
+                if self.lstr_metrics:
+                    self.l_metrics.append([self.l_sliceIndex[i], score] + l_values[i])
                 self.l_SSIM.append(score)
-
-                # print("Thresholding and contouring slice %3d..." % i)
-                self.l_imageThresh.append(cv2.threshold(
-                    self.l_imageDiff[i], 0, 255,
-                    cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
-                )
-                # print("Contouring slice                  %3d..." % i)
-                contour     = cv2.findContours(
-                    self.l_imageThresh[i].copy(),
-                    cv2.RETR_EXTERNAL,
-                    cv2.CHAIN_APPROX_SIMPLE
-                )
-                self.l_imageContour.append(imutils.grab_contours(contour))
+                self.l_imageDiff.append(imageDiff)
+                self.l_imageThresh.append(imageThresh)
+                self.l_boxes.append(boxes)
+                if boxes is not None:
+                    self.l_sliceBoxes.append(boxes.tolist())
+            self.slices_pad(self.sliceStop)
+            self.timer.slices_add(l_latency)
             print("difference, threshold, and contour.")
 
-        return {
-            'status':   b_status,
-            'method':   self.method_name(),
-            'd_stack':  d_prior
+        d_ret = {
+            'status':           b_status,
+            'method':           self.method_name(),
+            'identicalSlices':  sum(self.l_sliceSame),
+            'd_stack':          d_prior
         }
+        if self.cache:
+            d_ret['cacheHits']      = hits
+            d_ret['cacheMisses']    = len(l_todo)
+        return d_ret
 
+    @stage_timed
     def outputs_generate(self, options, d_prior):
         """
         Save all the relevant output images and JSON data.
+
+        Images are handed to the asynchronous writer, so they may still
+        be in flight when this returns; the writer is drained at the end
+        of the run.
         """
         b_status        :   bool    = False
         str_baseoutput  :   str     = ""
+        skipped         :   int     = 0
+        l_latency       :   list    = [0.0] * len(self.l_sliceIndex)
 
         print("\n--->Saving outputs<---")
         if d_prior['status']:
+            b_status    = True
             for str_dir in self.lstr_outputDirs:
                 str_outputPath  = os.path.join(options.outputdir, str_dir)
-                os.makedirs(str_outputPath, exist_ok = True)
+                container       = None
+                if options.str_outputFormat == 'npz':
+                    container       = self.container_get(options, str_dir)
+                    str_outputPath  = container.str_path
+                else:
+                    os.makedirs(str_outputPath, exist_ok = True)
                 print("%-75s" % ("Saving computed image slices for %s... " % str_outputPath), end = "")
-                for i in range(0, len(self.l_imageA)):
-                    b_status                = True
-                    str_outputImageFile     = "%s/slice-%03d.png" % (str_outputPath, i)
-                    if str_dir == 'naive':
+                for i in range(0, len(self.l_sliceIndex)):
+                    tic                     = time.perf_counter()
+                    if container:
+                        str_outputImageFile = "slice-%03d" % self.l_sliceIndex[i]
+                    else:
+                        str_outputImageFile = "%s/slice-%03d.png" % \
+                                                (str_outputPath, self.l_sliceIndex[i])
+                    if not container and self.slice_unchanged(i, str_outputImageFile):
+                        skipped    += 1
+                        continue
+                    if self.l_sliceSame[i] and str_dir == 'naive':
+                        image       = self.slice_sameImage(str_dir, self.l_imageA[i].shape)
+                    elif self.l_sliceSame[i] and str_dir == 'heatmap':
+                        image       = self.slice_sameImage(str_dir, self.l_imageDiff[i].shape)
+                    elif str_dir == 'naive':
                         imageA      = self.l_imageA[i]
                         imageB      = self.l_imageB[i]
+                        if imageA.ndim != imageB.ndim:
+                            imageA  = self.image_toColour(imageA)
+                            imageB  = self.image_toColour(imageB)
                         imageC      = np.abs(imageA - imageB)
-                        heatmap     = cv2.applyColorMap(imageC, cv2.COLORMAP_HOT)
-                        cv2.imwrite(str_outputImageFile, heatmap)
-                    if str_dir == 'heatmap':
-                        image       = self.l_imageDiff[i]
-                        heatmap     = cv2.applyColorMap(image, cv2.COLORMAP_HOT)
-                        cv2.imwrite(str_outputImageFile, heatmap)
+                        image       = cv2.applyColorMap(imageC, cv2.COLORMAP_HOT)
+                    elif str_dir == 'heatmap':
+                        image       = cv2.applyColorMap(self.l_imageDiff[i],
+                                                        cv2.COLORMAP_HOT)
                     if str_dir == 'threshold':
                         image       = self.l_imageThresh[i]
-                        cv2.imwrite(str_outputImageFile, image)
                     if str_dir == 'contourA' or str_dir == 'contourB':
-                        if str_dir == 'contourA':   image   = self.l_imageA[i]
-                        if str_dir == 'contourB':   image   = self.l_imageB[i]
-                        for c in self.l_imageContour[i]:
-                            (x, y, w, h) = cv2.boundingRect(c)
-                            cv2.rectangle(
-                                            image,
-                                            (x, y), (x + w, y + h),
-                                            (0, 0, 255), 2
-                                        )
-                            cv2.imwrite(str_outputImageFile, image)
+                        if str_dir == 'contourA':   source  = self.l_imageA[i]
+                        if str_dir == 'contourB':   source  = self.l_imageB[i]
+                        # Drawn on a copy: the input slices stay as read.
+                        image       = self.image_toColour(source)
+                        if image is source:
+                            image   = image.copy()
+                        boxes_draw(image, self.l_boxes[i], self.slice_outline(i))
+                    # Encoded and written once, off the main thread.
+                    self.writer.submit(str_outputImageFile, image, container)
+                    l_latency[i]           += time.perf_counter() - tic
                 print("done.")
-            with open('%s/SSIN.json' % options.outputdir, 'w')  as jsonfile:
-                json.dump(self.l_SSIM, jsonfile, indent = 4)
-
-        return {
+            self.timer.slices_add(l_latency)
+            if self.sliceStop == self.shardStop:
+                with open('%s/SSIN.json' % options.outputdir, 'w')  as jsonfile:
+                    json.dump(self.l_SSIM, jsonfile, indent = 4)
+                if self.lstr_metrics:
+                    self.metrics_write(options)
+                if 'contours' in self.s_needs:
+                    with open('%s/boxes.json' % options.outputdir, 'w') as jsonfile:
+                        json.dump(self.l_sliceBoxes, jsonfile)
+                if self.cache:
+                    with open('%s/sliceKeys.json' % options.outputdir, 'w') as jsonfile:
+                        json.dump(self.l_sliceKeys, jsonfile, indent = 4)
+
+        d_ret = {
             'status':   b_status,
             'method':   self.method_name(),
             'd_stack':  d_prior
         }
+        if self.cache:
+            d_ret['writeSkipped']   = skipped
+        return d_ret
 
+    def container_get(self, options, str_dir):
+        """
+        The 'npz' container of product <str_dir>, created on first use.
+        """
+        from    heatmap.writer      import SliceContainer
 
-    def run(self, options):
+        if str_dir not in self.d_containers:
+            self.d_containers[str_dir]  = SliceContainer(
+                                            os.path.join(options.outputdir, str_dir + '.npz'),
+                                            options.pngCompression)
+        return self.d_containers[str_dir]
+
+    def metrics_write(self, options):
         """
-        Define the code to be run by this plugin app.
+        Write the per-slice metrics table, one row per slice and one
+        column per metric, to <outputDir>/metrics.csv.
         """
+        with open('%s/metrics.csv' % options.outputdir, 'w', newline = '') as csvfile:
+            table   = csv.writer(csvfile)
+            table.writerow(['slice', 'ssim'] + self.lstr_metrics)
+            table.writerows(self.l_metrics)
 
-        print(Gstr_title)
-        print('Version: %s' % self.get_version())
+    def slice_outline(self, i):
+        """
+        The box outline of slice pair <i> of the window, found once and
+        shared by both contour products, if its boxes are many and dense
+        enough to be worth finding all at once; otherwise None, for them
+        to be drawn one by one.
+        """
+        boxes       = self.l_boxes[i]
+        if len(boxes) < BOXES_BATCH:
+            return None
+        (x0, y0)    = boxes[:, :2].min(0).tolist()
+        (x1, y1)    = (boxes[:, :2] + boxes[:, 2:]).max(0).tolist()
+        if (x1 - x0 + 3) * (y1 - y0 + 3) > BOXES_AREA * len(boxes):
+            return None
+        if i not in self.d_outline:
+            self.d_outline[i]   = boxes_outline(self.l_boxes[i], self.l_imageA[i].shape)
+        return self.d_outline[i]
+
+    def slice_key(self, options, i, str_cacheKey) -> str:
+        """
+        The key of the output images of slice <i> of the window: its
+        cache key, extended by the colour slices if the outputs draw on
+        them and by the options that change the written files.
+        """
+        l_images    :   list    = []
+        if 'images' in self.s_needs:
+            l_images    = [self.l_imageA[i], self.l_imageB[i]]
+        return self.cache.key(l_images, str_cacheKey, options.pngCompression)
 
-        d_options = vars(options)
-        for k,v in d_options.items():
-            print("%20s: %-40s" % (k, v))
-        print("")
+    def slice_unchanged(self, i, str_outputImageFile) -> bool:
+        """
+        Is the output file for slice <i> of the window already on disk
+        from an earlier run over exactly the same slice pair, written
+        the same way?
+        """
+        slice   :   int     = self.l_sliceIndex[i]
+        if not self.cache or slice >= len(self.lstr_priorKeys):
+            return False
+        return self.lstr_priorKeys[slice] == self.l_sliceKeys[slice] and \
+                os.path.isfile(str_outputImageFile)
 
-        # For future expansion, if reading mgz files,
-        # skip the image file reading (obviously) and
-        # use and mgz appropriate method to read in the
-        # volume. Then, store each "slice" of the volume
-        # into the
-        #
-        #           self.l_image[A|B]gray
-        #
-        # appropriately. The grayScale "list" of slices
-        # is the core driver of the difference map. It
-        # might be necessary to convert the mgz slice to
-        # an appropriate cv2 image structure:
-        #
-        #  img_cv  = cv2.resize(<mgzSlice_as_np>,(256,256))
-        #
-        # Most likely entry method to refactor is the
-        #           self.imageSlices_populate()
-        #
+    def slice_same(self, i) -> bool:
+        """
+        Are the slices of pair <i> of the window byte-identical? Colour
+        slices kept for the outputs must match as well as their
+        grayscale versions.
+        """
+        (imageA, imageB)    = (self.l_imageA[i], self.l_imageB[i])
+        return np.array_equal(self.l_imageAgray[i], self.l_imageBgray[i]) and \
+                (imageA is None or np.array_equal(imageA, imageB))
 
-        d_run                   :   dict    = {}
+    def slice_constant(self, str_name, shape, func):
+        """
+        The constant image <str_name> of <shape>, made by <func> the
+        first time it is asked for and shared from then on. It must not
+        be modified.
+        """
+        if (str_name, shape) not in self.d_constant:
+            self.d_constant[(str_name, shape)]  = func()
+        return self.d_constant[(str_name, shape)]
+
+    def slice_sameResult(self, shape) -> tuple:
+        """
+        The comparison result of an identical pair of slices of <shape>,
+        exactly as a full comparison would find it: a score of 1, a
+        difference map that is 255 (no difference) everywhere, an empty
+        threshold and no contour boxes.
+        """
+        imageDiff           = None
+        imageThresh         = None
+        boxes               = None
+        if 'diff' in self.s_needs:
+            imageDiff       = self.slice_constant('diff', shape,
+                                lambda: np.full(shape, 255, np.uint8))
+        if 'thresh' in self.s_needs:
+            imageThresh     = self.slice_constant('thresh', shape,
+                                lambda: np.zeros(shape, np.uint8))
+        if 'contours' in self.s_needs:
+            boxes           = np.zeros((0, 4), np.int32)
+        return (1.0, imageDiff, imageThresh, boxes)
+
+    def slice_sameImage(self, str_dir, shape):
+        """
+        The (constant) 'naive' or 'heatmap' output image of an identical
+        pair of slices, given the shape of its source image.
+        """
+        if str_dir == 'naive':
+            return self.slice_constant('naive', shape,
+                    lambda: cv2.applyColorMap(np.zeros(shape, np.uint8),
+                                              cv2.COLORMAP_HOT))
+        return self.slice_constant('heatmap', shape,
+                    lambda: cv2.applyColorMap(np.full(shape, 255, np.uint8),
+                                              cv2.COLORMAP_HOT))
+
+    def products_select(self, options) -> list:
+        """
+        The output products requested by ``--outputs``, in canonical
+        order. The pseudo product 'scores' (or nothing at all) selects
+        no images, only SSIN.json.
+        """
+        lstr_outputs    :   list    = [ str_output.strip()
+                                        for str_output in options.str_outputs.split(',')
+                                        if str_output.strip()]
+        lstr_unknown    :   list    = [ str_output for str_output in lstr_outputs
+                                        if str_output not in Gl_PRODUCTS + ['scores']]
+        if lstr_unknown:
+            raise ValueError("Unknown output product(s) %s, choose from %s" %
+                                (', '.join(lstr_unknown), ', '.join(Gl_PRODUCTS + ['scores'])))
+        return [str_product for str_product in Gl_PRODUCTS if str_product in lstr_outputs]
+
+    def slices_map(self, func, *l_args):
+        """
+        Map <func> over the per-slice argument lists, on the process
+        pool (started on first use) if there is more than one worker.
+        Results always come back in slice order. The CPU time and peak
+        memory of the workers are added to the current stage's timer as
+        the results are taken.
+        """
+        if self.workers > 1 and not self.pool:
+            self.pool           = self.pool_start()
+        if not self.pool:
+            return map(func, *l_args)
+        return self.timer.workers_add(self.pool.map(partial(worker_timed, func), *l_args,
+                    chunksize = max(1, len(l_args[0]) // (4 * self.workers))))
+
+    def pool_start(self):
+        """
+        A process pool of ``self.workers`` workers: a new one for this
+        run, or the one of that size kept in ``self.d_pools`` across the
+        runs of a server.
+        """
+        if self.d_pools is None:
+            return ProcessPoolExecutor(max_workers = self.workers)
+        if self.workers not in self.d_pools:
+            self.d_pools[self.workers]  = ProcessPoolExecutor(max_workers = self.workers)
+        return self.d_pools[self.workers]
+
+    def slices_pad(self, stop):
+        """
+        Record the slices before slice number <stop> that were left
+        without a result -- those a preview did not select -- as None in
+        the per-slice results accumulated over the shard.
+        """
+        while len(self.l_SSIM) < stop - self.shardStart:
+            self.l_SSIM.append(None)
+            if 'contours' in self.s_needs:
+                self.l_sliceBoxes.append(None)
+        if self.cache:
+            self.l_sliceKeys.extend([None] * (stop - len(self.l_sliceKeys)))
+
+    def slices_stackable(self, l_images) -> bool:
+        """
+        Check that the grayscale slices <l_images> all share one shape
+        and can be stacked for the batched SSIM engine.
+        """
+        return len({image.shape for image in l_images}) == 1
+
+    def slices_release(self):
+        """
+        Drop all per-slice image data held for the current window. The
+        SSIM scores are kept since they accumulate over the whole stack.
+        """
+        for l_slices in [   self.l_imageA,      self.l_imageB,
+                            self.l_imageAgray,  self.l_imageBgray,
+                            self.l_imageDiff,   self.l_imageThresh,
+                            self.l_boxes,       self.l_sliceSame,
+                            self.l_sliceIndex]:
+            l_slices.clear()
+        self.d_outline.clear()
+
+    def stack_accumulate(self, d_total, d_window) -> dict:
+        """
+        Fold the status stack of one streamed window into the running
+        total so that the final stack reads as if the whole image set
+        had been processed in one pass: statuses are and'ed, counts are
+        summed and the shared innermost stack is kept as is.
+        """
+        if not d_total or d_total is d_window:
+            return d_window
+        if d_window.get('method') == 'slices_preview':
+            return self.preview_accumulate(d_total, d_window)
+        for k, v in d_window.items():
+            if k == 'status':
+                d_total[k]  = d_total[k] and v
+            elif k == 'd_stack':
+                d_total[k]  = self.stack_accumulate(d_total[k], v)
+            elif isinstance(v, int) and not isinstance(v, bool):
+                d_total[k] += v
+        return d_total
+
+    def preview_accumulate(self, d_total, d_shard) -> dict:
+        """
+        Fold the preview stage of one shard into the running total. The
+        shards must have previewed alike: their scores are concatenated
+        in slice order and ranked again as a whole, and the slices they
+        selected (numbered over the whole stack already) are joined.
+        """
+        for (k, str_option) in [('factor',    '--preview'),
+                                ('top',       '--previewTop'),
+                                ('threshold', '--previewThreshold')]:
+            if d_total.get(k) != d_shard.get(k):
+                raise ValueError("Shards previewed with different %s values: %s and %s" %
+                                    (str_option, d_total.get(k), d_shard.get(k)))
+        d_total['status']   = d_total['status'] and d_shard['status']
+        d_total['scores']  += d_shard['scores']
+        # The merged shards cover the stack from slice 0.
+        d_total['ranking']  = preview.slices_rank(d_total['scores'])
+        d_total['selected'] = sorted(set(d_total['selected']) | set(d_shard['selected']))
+        d_total['d_stack']  = self.stack_accumulate(d_total['d_stack'], d_shard['d_stack'])
+        return d_total
+
+    def stack_timingAdd(self, d_stack):
+        """
+        Attach the accumulated timing of each stage to its entry in the
+        status stack. Output writing happens on the writer threads, so
+        its own statistics are reported with the outputs stage.
+        """
+        while d_stack:
+            if d_stack.get('method') in self.d_timers:
+                d_stack['timing']   = self.d_timers[d_stack['method']].summary()
+            if d_stack.get('method') == 'outputs_generate':
+                d_stack['timing']['writer'] = {
+                    'threads':      self.writer.threads,
+                    'busyTime':     sum(self.writer.l_latency),
+                    'imageLatency': latency_summary(self.writer.l_latency)
+                }
+            d_stack = d_stack.get('d_stack')
+
+    def memory_plan(self, options):
+        """
+        Fit the run into its memory budget (``--memoryBudget``, or else
+        the container's memory limit), as estimated from the size of the
+        first slice pair and the products asked for: the streaming window
+        is narrowed, and if need be workers are dropped, until the
+        estimate fits. The plan is reported in run.json.
+        """
+        limit       :   int     = options.memoryBudget * budget.MIB
+        count       :   int     = self.shardStop - self.shardStart
+        workers     :   int     = 1 if options.tileSize else self.workers
+
+        if options.memoryBudget == 0:
+            limit   = budget.memory_limit()
+        if limit <= 0 or not count:
+            return
+        l_shapes    = []
+        for (volume, lstr_files) in [(self.vol_A, self.lstr_imageAfiles),
+                                     (self.vol_B, self.lstr_imageBfiles)]:
+            if volume:
+                l_shapes.append(volume.slice(self.shardStart).shape)
+            else:
+                l_shapes.append(self.image_read(lstr_files[self.shardStart]).shape)
+        pixels      = max(shape[0] * shape[1] for shape in l_shapes)
+        channels    = max(shape[2] if len(shape) == 3 else 1 for shape in l_shapes)
+
+        perSlice    = budget.slice_footprint(pixels, channels, self.s_needs)
+        if options.str_ssimEngine == 'stack' and not options.tileSize:
+            perSlice   += budget.STACK_BYTES * pixels
+        perCompare  = budget.compare_footprint(pixels, options.str_ssimEngine, options.tileSize)
+        # This process, and its output
+        perOutput   = budget.output_footprint(pixels, self.s_needs, options.writeThreads,
+                                              options.str_outputFormat, bool(self.cache))
+        fixed       = budget.PROCESS_BYTES + perOutput
+        (window, workers)   = budget.memory_schedule(limit, count, perSlice,
+                                                     perCompare, fixed, workers)
+        if self.sliceWindow:
+            window  = min(window, self.sliceWindow)
+        self.sliceWindow    = 0 if window >= count else window
+        if not options.tileSize:
+            self.workers    = workers
+        estimate    = budget.memory_estimate(window, workers, perSlice, perCompare, fixed)
+        self.d_memory       = {
+            'budget':           limit / budget.MIB,
+            'sliceFootprint':   perSlice / budget.MIB,
+            'compareFootprint': perCompare / budget.MIB,
+            'outputFootprint':  perOutput / budget.MIB,
+            'estimate':         estimate / budget.MIB,
+            'fits':             estimate <= limit,
+            'sliceWindow':      self.sliceWindow,
+            'workers':          self.workers
+        }
+        print("%-75s" % "Memory plan... ", end = "")
+        print("%d slice window, %d workers, ~%d of %d MiB%s" % (
+                window, self.workers, estimate // budget.MIB, limit // budget.MIB,
+                '' if estimate <= limit else ' (over budget)'))
+
+    def slices_stream(self, options, d_prior) -> dict:
+        """
+        Run the per-slice stages over consecutive windows of
+        ``self.sliceWindow`` slice pairs. Each window is read,
+        converted, compared and written before its images are released
+        and the next window is read.
+        """
+        d_run       :   dict    = {}
+        start       :   int     = 0
+
+        for start in range(self.shardStart, max(self.shardStop, self.shardStart + 1),
+                           self.sliceWindow):
+            self.sliceStart     = start
+            self.sliceStop      = min(start + self.sliceWindow, self.shardStop)
+            d_window = self.outputs_generate(options,
+                            self.grayScale_slicesProcess(options,
+                                self.imageSlices_toGrayScale(options,
+                                    self.imageSlices_populate(options, d_prior)
+                                )
+                            )
+                        )
+            d_run = self.stack_accumulate(d_run, d_window)
+            self.slices_release()
+        return d_run
+
+    def shards_merge(self, options) -> dict:
+        """
+        Combine the outputs of the ``--shard`` runs found in the
+        subdirectories of <inputDir> into <outputDir>, as if they were a
+        single run. Nothing is recomputed: scores and slice keys are
+        concatenated in slice order, the (globally numbered) output images
+        are linked or copied (or their containers' slices combined), and
+        the status stacks are folded together.
+        Each shard's own range and timing is listed under 'shards'.
+        """
+        l_shards        :   list    = []
+        l_info          :   list    = []
+        l_keys          :   list    = []
+        d_run           :   dict    = {}
+        merged          :   int     = 0
+        stop            :   int     = 0
+
+        print("\n--->Merging shards<---")
+        for entry in sorted(os.scandir(options.inputdir), key=lambda e: e.name):
+            try:
+                with open(os.path.join(entry.path, 'run.json')) as jsonrun:
+                    d_shard = json.load(jsonrun)
+            except (OSError, ValueError):
+                continue
+            if 'shard' in d_shard:
+                l_shards.append((entry, d_shard))
+        l_shards.sort(key = lambda t: t[1]['shard']['sliceStart'])
+        for (entry, d_shard) in l_shards:
+            if d_shard['shard']['sliceStart'] != stop or \
+                    d_shard['shard']['sliceCount'] != l_shards[0][1]['shard']['sliceCount']:
+                raise ValueError("Shard %s does not continue from slice %d of %d" %
+                    (entry.name, stop, l_shards[0][1]['shard']['sliceCount']))
+            stop        = d_shard['shard']['sliceStop']
+        if not l_shards or stop != l_shards[0][1]['shard']['sliceCount']:
+            raise ValueError("The shards under %s do not cover the whole stack" %
+                                options.inputdir)
+
+        for (entry, d_shard) in l_shards:
+            print("%-75s" % ("Merging shard %s... " % entry.name), end = "")
+            d_info              = d_shard.pop('shard')
+            d_info['directory'] = entry.name
+            d_info['timing']    = {}
+            with open(os.path.join(entry.path, 'SSIN.json')) as jsonfile:
+                self.l_SSIM.extend(json.load(jsonfile))
+            if os.path.isfile(os.path.join(entry.path, 'boxes.json')):
+                with open(os.path.join(entry.path, 'boxes.json')) as jsonfile:
+                    self.l_sliceBoxes.extend(json.load(jsonfile))
+            if os.path.isfile(os.path.join(entry.path, 'metrics.csv')):
+                with open(os.path.join(entry.path, 'metrics.csv'), newline = '') as csvfile:
+                    l_rows  = list(csv.reader(csvfile))
+                self.lstr_metrics   = l_rows[0][2:]
+                self.l_metrics.extend(l_rows[1:])
+            if l_keys is not None:
+                try:
+                    with open(os.path.join(entry.path, 'sliceKeys.json')) as jsonfile:
+                        l_keys.extend(json.load(jsonfile)[d_info['sliceStart']:])
+                except (OSError, ValueError):
+                    l_keys      = None
+            for str_dir in Gl_PRODUCTS:
+                str_inputPath   = os.path.join(entry.path, str_dir)
+                if os.path.isfile(str_inputPath + '.npz'):
+                    merged     += self.container_get(options, str_dir).members_add(
+                                                                str_inputPath + '.npz')
+                if not os.path.isdir(str_inputPath):
+                    continue
+                str_outputPath  = os.path.join(options.outputdir, str_dir)
+                os.makedirs(str_outputPath, exist_ok = True)
+                for image in os.scandir(str_inputPath):
+                    str_outputImageFile = os.path.join(str_outputPath, image.name)
+                    try:
+                        os.link(image.path, str_outputImageFile)
+                    except OSError:
+                        shutil.copy2(image.path, str_outputImageFile)
+                    merged     += 1
+            # Per-shard timing moves to the shard list; the innermost
+            # (file determination) stack is common to all the shards.
+            d_stack     = d_shard
+            while 'd_stack' in d_stack:
+                d_info['timing'][d_stack['method']] = d_stack.pop('timing', None)
+                d_inner = d_stack
+                d_stack = d_stack['d_stack']
+            d_info['timing'][d_stack['method']]     = d_stack.pop('timing', None)
+            if d_run:
+                d_common            = d_run
+                while 'd_stack' in d_common:
+                    d_common        = d_common['d_stack']
+                d_common['status']  = d_common['status'] and d_stack['status']
+                d_inner['d_stack']  = d_common
+            d_run       = self.stack_accumulate(d_run, d_shard)
+            l_info.append(d_info)
+            print("done.")
+
+        with open('%s/SSIN.json' % options.outputdir, 'w') as jsonfile:
+            json.dump(self.l_SSIM, jsonfile, indent = 4)
+        if self.l_metrics:
+            self.metrics_write(options)
+        if self.l_sliceBoxes:
+            with open('%s/boxes.json' % options.outputdir, 'w') as jsonfile:
+                json.dump(self.l_sliceBoxes, jsonfile)
+        if l_keys is not None:
+            with open('%s/sliceKeys.json' % options.outputdir, 'w') as jsonfile:
+                json.dump(l_keys, jsonfile, indent = 4)
+        d_run['imagesMerged']   = merged
+        d_run['shards']         = l_info
+        return d_run
+
+    def run_prepare(self, options):
+        """
+        Set up the data structures and the worker resources (process
+        pool, image writer, cache, profiler) of a run.
+        """
+        from    heatmap.cache       import SliceCache
+        from    heatmap.writer      import ImageWriter
 
         # Image A data structures -- input 1:
+        self.vol_A                          = None
         self.lstr_imageAfiles   :   list    = []
         self.l_imageA           :   list    = []
         self.l_imageAgray       :   list    = []
 
         # Image B data structures -- input 2:
+        self.vol_B                          = None
         self.lstr_imageBfiles   :   list    = []
         self.l_imageB           :   list    = []
         self.l_imageBgray       :   list    = []
@@ -475,21 +1815,156 @@ class Heatmap(ChrisApp):
         self.lstr_imageOutfiles :   list    = []
         self.l_imageDiff        :   list    = []
         self.l_imageThresh      :   list    = []
-        self.l_imageContour     :   list    = []
+        self.l_boxes            :   list    = []
         self.l_SSIM             :   list    = []
+        # Contour boxes of every slice, as lists, for boxes.json; and the
+        # box outlines of the window, drawn on first use:
+        self.l_sliceBoxes       :   list    = []
+        self.d_outline          :   dict    = {}
+
+        # Identical slice pairs of the window, and the constant results
+        # and images they share:
+        self.l_sliceSame        :   list    = []
+        self.d_constant         :   dict    = {}
+
+        self.lstr_outputDirs    :   list    = self.products_select(options)
+        self.lstr_metrics       :   list    = metrics.metrics_select(options.str_metrics)
+        self.s_needs            :   frozenset   = products_resolve(
+                                        self.lstr_outputDirs +
+                                        metrics.metrics_needs(self.lstr_metrics))
+        # Rows of the per-slice metrics table (slice, ssim, <metrics>):
+        self.l_metrics          :   list    = []
+
+        # Slice window -- the range of slice pairs currently in memory,
+        # and the slice number of each pair held:
+        self.sliceStart         :   int     = 0
+        self.sliceStop          :   int     = 0
+        self.sliceCount         :   int     = 0
+        self.l_sliceIndex       :   list    = []
+
+        # Slices selected by a preview for full resolution comparison
+        # (a flag per slice), or None to compare every slice:
+        self.l_selected                     = None
+
+        # Shard -- the range of slice pairs this run is responsible for:
+        self.shardStart         :   int     = 0
+        self.shardStop          :   int     = 0
+
+        # Per-stage instrumentation, and optional profiler:
+        self.d_timers           :   dict    = {}
+        self.profiler                       = None
+        if options.b_profile:
+            self.profiler       = cProfile.Profile()
+            self.profiler.enable()
+
+        # Slice result cache, and the slice keys of any earlier run into
+        # the same output directory:
+        self.cache                          = None
+        self.l_sliceKeys        :   list    = []
+        self.lstr_priorKeys     :   list    = []
+        if options.str_cacheDir:
+            self.cache          = SliceCache(options.str_cacheDir,
+                                             options.cacheSize * 1024 * 1024)
+            try:
+                with open('%s/sliceKeys.json' % options.outputdir) as jsonfile:
+                    self.lstr_priorKeys = json.load(jsonfile)
+            except (OSError, ValueError):
+                pass
+
+        # Asynchronous output image writer, and the per-product
+        # containers it writes to in 'npz' format:
+        if options.str_outputFormat not in ['png', 'npz']:
+            raise ValueError("Unknown output format %s, choose from png, npz" %
+                                options.str_outputFormat)
+        self.writer             = ImageWriter(  threads     = options.writeThreads,
+                                                compression = options.pngCompression)
+        self.d_containers       :   dict    = {}
+
+        # Slice comparison process pool, started on first use, and the
+        # streaming window; either may be cut back by memory_plan():
+        if options.str_ssimEngine not in ['slice', 'stack']:
+            raise ValueError("Unknown SSIM engine %s, choose from slice, stack" %
+                                options.str_ssimEngine)
+        self.workers            :   int     = options.workers or cpu_count()
+        self.pool                           = None
+        self.sliceWindow        :   int     = options.sliceWindow
+        self.d_memory           :   dict    = {}
+
+    def run_finish(self, options):
+        """
+        Wait for outstanding output and release the worker resources of
+        a run.
+        """
+        try:
+            self.writer.close()
+        finally:
+            for container in self.d_containers.values():
+                container.close()
+        if self.pool and self.d_pools is None:
+            self.pool.shutdown()
+        for volume in [self.vol_A, self.vol_B]:
+            if volume:
+                volume.close()
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats('%s/heatmap.prof' % options.outputdir)
 
-        self.lstr_outputDirs    :   list    = ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']
-        d_run = self.outputs_generate(options,
-                    self.grayScale_slicesProcess(options,
-                        self.imageSlices_toGrayScale(options,
-                            self.imageSlices_populate(options,
-                                self.imageFileNames_determine(options)
+    def run(self, options):
+        """
+        Define the code to be run by this plugin app. The status stack
+        written to run.json is also returned.
+        """
+
+        print(Gstr_title)
+        print('Version: %s' % self.get_version())
+
+        d_options = vars(options)
+        for k,v in d_options.items():
+            print("%20s: %-40s" % (k, v))
+        print("")
+
+        d_run                   :   dict    = {}
+
+        self.run_prepare(options)
+        if options.b_merge:
+            try:
+                d_run           = self.shards_merge(options)
+            finally:
+                self.run_finish(options)
+            with open('%s/run.json' % options.outputdir, 'w') as jsonrun:
+                json.dump(d_run, jsonrun, indent = 4)
+            return d_run
+        try:
+            d_files             = self.imageFileNames_determine(options)
+            if d_files['status']:
+                self.memory_plan(options)
+            if options.preview:
+                d_files         = self.slices_preview(options, d_files)
+            if self.sliceWindow > 0:
+                d_run = self.slices_stream(options, d_files)
+            else:
+                d_run = self.outputs_generate(options,
+                            self.grayScale_slicesProcess(options,
+                                self.imageSlices_toGrayScale(options,
+                                    self.imageSlices_populate(options, d_files)
+                                )
                             )
                         )
-                    )
-                )
+        finally:
+            self.run_finish(options)
+        self.stack_timingAdd(d_run)
+        if self.d_memory:
+            d_run['memory']     = self.d_memory
+        if options.str_shard:
+            d_run['shard']      = {
+                'shard':        options.str_shard,
+                'sliceStart':   self.shardStart,
+                'sliceStop':    self.shardStop,
+                'sliceCount':   self.sliceCount
+            }
         with open('%s/run.json' % options.outputdir, 'w') as jsonrun:
             json.dump(d_run, jsonrun, indent = 4)
+        return d_run
 
     def show_man_page(self):
         """
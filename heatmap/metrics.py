@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Per-slice similarity metrics beyond SSIM.
+
+Metrics are registered by name with the ``metric`` decorator, along
+with the intermediate results (as in ``Gd_DEPENDS``) that they need.
+Each is a function of a ``SlicePair``, which computes the intermediates
+shared between metrics (float views of the slices, and the sums and
+sums of products over them) once, on first use, so that however many
+metrics are selected each slice pair is only passed over once or twice.
+"""
+
+import  math
+from    functools           import cached_property
+
+import  numpy                               as np
+
+# name -> (function, intermediate results it needs), in table order
+Gd_METRICS      :   dict    = {}
+
+
+def metric(str_name, l_needs = ()):
+    """
+    Register the decorated function of a SlicePair as metric <str_name>.
+    """
+    def register(func):
+        Gd_METRICS[str_name] = (func, list(l_needs))
+        return func
+    return register
+
+def metrics_select(str_metrics) -> list:
+    """
+    The metric names in the comma separated <str_metrics>, in table
+    order; 'all' selects every metric.
+    """
+    lstr_metrics    :   list    = [ str_metric.strip()
+                                    for str_metric in str_metrics.split(',')
+                                    if str_metric.strip()]
+    if 'all' in lstr_metrics:
+        return list(Gd_METRICS)
+    lstr_unknown    :   list    = [ str_metric for str_metric in lstr_metrics
+                                    if str_metric not in Gd_METRICS]
+    if lstr_unknown:
+        raise ValueError("Unknown metric(s) %s, choose from %s" %
+                            (', '.join(lstr_unknown), ', '.join(list(Gd_METRICS) + ['all'])))
+    return [str_metric for str_metric in Gd_METRICS if str_metric in lstr_metrics]
+
+def metrics_needs(lstr_metrics) -> list:
+    """
+    The intermediate results the metrics <lstr_metrics> depend upon.
+    """
+    return sorted({str_need for str_metric in lstr_metrics
+                            for str_need in Gd_METRICS[str_metric][1]})
+
+def metrics_compute(lstr_metrics, imageAgray, imageBgray,
+                    imageThresh = None, boxes = None) -> list:
+    """
+    The values of the metrics <lstr_metrics> for one slice pair, given
+    its threshold and contour <boxes> if they are needed.
+    """
+    pair    = SlicePair(imageAgray, imageBgray, imageThresh, boxes)
+    return [Gd_METRICS[str_metric][0](pair) for str_metric in lstr_metrics]
+
+
+class SlicePair:
+    """
+    A grayscale slice pair and its intermediate results, each computed
+    on first use. Sums over the 8-bit pixels are taken as float64 dot
+    products, which are exact at any practical slice size, and then
+    combined as integers.
+    """
+
+    def __init__(self, imageAgray, imageBgray, imageThresh = None, boxes = None):
+        self.imageAgray             = imageAgray
+        self.imageBgray             = imageBgray
+        self.imageThresh            = imageThresh
+        self.boxes                  = boxes
+        self.size       :   int     = imageAgray.size
+
+    @cached_property
+    def a(self):
+        return self.imageAgray.astype(np.float64).ravel()
+
+    @cached_property
+    def b(self):
+        return self.imageBgray.astype(np.float64).ravel()
+
+    @cached_property
+    def sums(self) -> tuple:
+        """
+        Sum of A, of B, of A^2, of B^2 and of AB.
+        """
+        return tuple(int(total) for total in (
+                        self.a.sum(), self.b.sum(),
+                        self.a @ self.a, self.b @ self.b, self.a @ self.b))
+
+    @cached_property
+    def squaredError(self) -> int:
+        (sumA, sumB, sumAA, sumBB, sumAB) = self.sums
+        return sumAA + sumBB - 2 * sumAB
+
+    @cached_property
+    def areas(self):
+        return self.boxes[:, 2].astype(np.int64) * self.boxes[:, 3]
+
+
+@metric('mse')
+def metric_mse(pair) -> float:
+    """
+    Mean squared error of the pixel values.
+    """
+    return pair.squaredError / pair.size
+
+@metric('psnr')
+def metric_psnr(pair) -> float:
+    """
+    Peak signal to noise ratio in dB (infinite for identical slices).
+    """
+    if not pair.squaredError:
+        return math.inf
+    return 10 * math.log10(255 ** 2 * pair.size / pair.squaredError)
+
+@metric('ncc')
+def metric_ncc(pair) -> float:
+    """
+    Normalized cross-correlation (Pearson correlation) of the pixel
+    values; undefined (nan) if either slice is constant.
+    """
+    (sumA, sumB, sumAA, sumBB, sumAB) = pair.sums
+    n       = pair.size
+    varA    = n * sumAA - sumA * sumA
+    varB    = n * sumBB - sumB * sumB
+    if varA <= 0 or varB <= 0:
+        return math.nan
+    return (n * sumAB - sumA * sumB) / math.sqrt(varA * varB)
+
+@metric('changed', ['thresh'])
+def metric_changed(pair) -> float:
+    """
+    Fraction of the pixels flagged as changed by the threshold.
+    """
+    return np.count_nonzero(pair.imageThresh) / pair.size
+
+@metric('contourCount', ['contours'])
+def metric_contourCount(pair) -> int:
+    return len(pair.boxes)
+
+@metric('contourArea', ['contours'])
+def metric_contourArea(pair) -> int:
+    """
+    Total area of the contours' bounding boxes, in pixels.
+    """
+    return int(pair.areas.sum())
+
+@metric('contourAreaMax', ['contours'])
+def metric_contourAreaMax(pair) -> int:
+    """
+    Area of the largest contour bounding box, in pixels.
+    """
+    return int(pair.areas.max(initial = 0))
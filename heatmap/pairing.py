@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Pairing of the files of two image sets.
+
+By default the files of the two sets are paired by position in name
+order, so that one missing or stray file shifts every later pair.
+Instead, they can be paired by a key taken from each file name -- its
+stem, or the part of it matched by a regular expression -- in which
+case files without a partner are left out of the comparison and
+reported rather than misaligning it.
+
+Directory listings can be kept in a cache directory, each stored with
+the modification time of its directory (which changes whenever an entry
+is added, removed or renamed), so that repeated runs over very large
+directories reuse the sorted listing instead of reading it again.
+"""
+
+import  os
+import  re
+import  json
+import  hashlib
+
+
+def listing_read(str_path, str_cacheDir = '') -> list:
+    """
+    The sorted entry names of directory <str_path>, taken from the
+    listing cached in <str_cacheDir> if the directory has not changed
+    since.
+    """
+    if not str_cacheDir:
+        return sorted(entry.name for entry in os.scandir(str_path))
+
+    str_path        = os.path.abspath(str_path)
+    mtime   :   int = os.stat(str_path).st_mtime_ns
+    str_listing     = os.path.join(str_cacheDir, 'listings',
+                        hashlib.sha256(str_path.encode()).hexdigest() + '.json')
+    try:
+        with open(str_listing) as jsonfile:
+            d_listing   = json.load(jsonfile)
+        if d_listing['path'] == str_path and d_listing['mtime'] == mtime:
+            return d_listing['names']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    lstr_names      = sorted(entry.name for entry in os.scandir(str_path))
+    os.makedirs(os.path.dirname(str_listing), exist_ok = True)
+    # Written aside and renamed, so that concurrent runs never read a
+    # partial listing.
+    str_temp        = '%s.%d' % (str_listing, os.getpid())
+    with open(str_temp, 'w') as jsonfile:
+        json.dump({'path': str_path, 'mtime': mtime, 'names': lstr_names}, jsonfile)
+    os.replace(str_temp, str_listing)
+    return lstr_names
+
+def pairKey_compile(str_pairKey):
+    """
+    The function giving the pairing key of a file name under
+    <str_pairKey>: 'stem', or a regular expression whose first group
+    (or whole match, if it has none) is the key. Keys made of digits
+    are compared as numbers. Names without a key -- no match, or a first
+    group that took no part in it -- give None.
+    """
+    if str_pairKey == 'stem':
+        return lambda str_name: os.path.splitext(str_name)[0]
+    try:
+        pattern     = re.compile(str_pairKey)
+    except re.error as e:
+        raise ValueError("Invalid pair key %s: %s" % (str_pairKey, e))
+
+    def key(str_name):
+        match       = pattern.search(str_name)
+        if not match:
+            return None
+        str_key     = match.group(1 if pattern.groups else 0)
+        if str_key is None:
+            return None
+        return int(str_key) if str_key.isdigit() else str_key
+    return key
+
+def key_order(key) -> tuple:
+    """
+    Sort order of pairing keys: numbers (numerically) before strings.
+    """
+    return (isinstance(key, str), key)
+
+def pairs_index(lstr_namesA, lstr_namesB, str_pairKey = 'position') -> tuple:
+    """
+    Pair the file names <lstr_namesA> and <lstr_namesB> (each in name
+    order) by <str_pairKey>, returning the (nameA, nameB) pairs in key
+    order and the names of either set left without a partner. By
+    position, the unpaired names are those past the end of the shorter
+    set.
+    """
+    if str_pairKey == 'position':
+        count       = min(len(lstr_namesA), len(lstr_namesB))
+        return (list(zip(lstr_namesA, lstr_namesB)),
+                lstr_namesA[count:], lstr_namesB[count:])
+
+    key             = pairKey_compile(str_pairKey)
+    l_index         = []
+    l_unmatched     = []
+    for lstr_names in [lstr_namesA, lstr_namesB]:
+        d_index     = {}
+        lstr_none   = []
+        for str_name in lstr_names:
+            k       = key(str_name)
+            if k is None:
+                lstr_none.append(str_name)
+            elif k in d_index:
+                raise ValueError("Pair key %s of %s is also that of %s" %
+                                    (repr(k), str_name, d_index[k]))
+            else:
+                d_index[k]  = str_name
+        l_index.append(d_index)
+        l_unmatched.append(lstr_none)
+
+    (d_indexA, d_indexB)    = l_index
+    l_pairs         = [(d_indexA[k], d_indexB[k])
+                        for k in sorted(d_indexA.keys() & d_indexB.keys(), key = key_order)]
+    for (d_index, d_other, lstr_none) in [(d_indexA, d_indexB, l_unmatched[0]),
+                                          (d_indexB, d_indexA, l_unmatched[1])]:
+        lstr_none  += [str_name for (k, str_name) in d_index.items() if k not in d_other]
+        lstr_none.sort()
+    return (l_pairs, l_unmatched[0], l_unmatched[1])
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Reduced resolution preview of a comparison, for triage.
+
+Slices are downsampled by an integer factor (by area averaging, as one
+level of an image pyramid further down would be), scored at that
+resolution and ranked from the most to the least dissimilar, and the
+slices worth comparing at full resolution are selected from the
+ranking.
+"""
+
+import  numpy                               as np
+import  cv2
+
+# The smallest side that the 7x7 SSIM window still fits into.
+PREVIEW_MIN     :   int     = 7
+
+
+def slice_downsample(image, factor):
+    """
+    <image> reduced <factor> times in each direction, but not below the
+    SSIM window size.
+    """
+    (height, width) = image.shape[:2]
+    size            = ( max(PREVIEW_MIN, width  // factor),
+                        max(PREVIEW_MIN, height // factor))
+    if factor <= 1 or size == (width, height):
+        return image
+    return cv2.resize(image, size, interpolation = cv2.INTER_AREA)
+
+def slices_rank(l_scores) -> list:
+    """
+    The positions of <l_scores> from the lowest (most dissimilar) score
+    to the highest; ties keep slice order.
+    """
+    return np.argsort(np.asarray(l_scores, dtype = np.float64), kind = 'stable').tolist()
+
+def slices_select(l_scores, top = 0, threshold = 0.0) -> list:
+    """
+    The positions, in order, of the <top> lowest of <l_scores> and of
+    any below <threshold>.
+    """
+    s_selected      = set(slices_rank(l_scores)[:top])
+    s_selected     |= {i for (i, score) in enumerate(l_scores) if score < threshold}
+    return sorted(s_selected)
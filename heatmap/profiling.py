@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Lightweight instrumentation of the pipeline stages: wall and CPU time,
+peak resident memory and per-slice latency percentiles, accumulated
+over every call of a stage (a streamed run calls each stage once per
+window). The CPU time and peak memory of the work a stage hands to a
+process pool are measured in the workers and added in as the results
+come back.
+"""
+
+import  time
+import  resource
+import  functools
+import  contextlib
+
+
+def rss_reset() -> bool:
+    """
+    Reset the peak resident set size of this process to its current
+    size, so that rss_peak() reads the peak from now on. This needs
+    Linux's /proc/self/clear_refs; return whether it was possible.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        return False
+    return True
+
+def rss_peak() -> float:
+    """
+    Peak resident set size of this process, in MiB: since the last
+    rss_reset(), or over the life of the process where that is not
+    possible.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            for str_line in fp:
+                if str_line.startswith('VmHWM:'):
+                    return int(str_line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def cpu_time() -> float:
+    """
+    CPU time used by this process and by its reaped children. Work
+    done in a process pool is only included once the pool has exited.
+    """
+    self        = resource.getrusage(resource.RUSAGE_SELF)
+    children    = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime
+
+def latency_summary(l_seconds) -> dict:
+    """
+    Count, mean and percentiles of a list of latencies, in seconds.
+    """
+    import  numpy                           as np
+
+    if not len(l_seconds):
+        return {'count': 0}
+    v_seconds   = np.asarray(l_seconds, dtype = np.float64)
+    (p50, p90, p99) = np.percentile(v_seconds, [50, 90, 99])
+    return {
+        'count':    len(v_seconds),
+        'mean':     float(v_seconds.mean()),
+        'p50':      float(p50),
+        'p90':      float(p90),
+        'p99':      float(p99),
+        'max':      float(v_seconds.max())
+    }
+
+def slice_timed(func, *args) -> tuple:
+    """
+    Call <func> on <args> and return (seconds taken, result). This is a
+    module level function so that it can run in a process pool.
+    """
+    tic     = time.perf_counter()
+    result  = func(*args)
+    return (time.perf_counter() - tic, result)
+
+def worker_timed(func, *args) -> tuple:
+    """
+    Call <func> on <args> in a pool worker and return (result, CPU
+    seconds taken, peak resident set size of the worker meanwhile in
+    MiB), for the stage that handed out the work to add in.
+    """
+    rss_reset()
+    cpu     = time.process_time()
+    result  = func(*args)
+    return (result, time.process_time() - cpu, rss_peak())
+
+
+class StageTimer:
+    """
+    Accumulated timing of one pipeline stage.
+    """
+
+    def __init__(self):
+        self.calls          :   int     = 0
+        self.wallTime       :   float   = 0.0
+        self.cpuTime        :   float   = 0.0
+        self.peakRSS        :   float   = 0.0
+        self.workerCpuTime  :   float   = 0.0
+        self.workerPeakRSS  :   float   = 0.0
+        self.l_slice        :   list    = []
+
+    def __enter__(self):
+        rss_reset()
+        self.tic        = time.perf_counter()
+        self.cpu        = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.calls     += 1
+        self.wallTime  += time.perf_counter() - self.tic
+        self.cpuTime   += time.process_time() - self.cpu
+        self.peakRSS    = max(self.peakRSS, rss_peak())
+        return False
+
+    def workers_add(self, results):
+        """
+        Yield the results of worker_timed() tasks, adding in the CPU time
+        and peak memory of each.
+        """
+        for (result, cpuTime, peakRSS) in results:
+            self.cpuTime       += cpuTime
+            self.workerCpuTime += cpuTime
+            self.workerPeakRSS  = max(self.workerPeakRSS, peakRSS)
+            yield result
+
+    @contextlib.contextmanager
+    def slice(self):
+        """
+        Time the work done on one slice.
+        """
+        tic     = time.perf_counter()
+        yield
+        self.l_slice.append(time.perf_counter() - tic)
+
+    def slices_add(self, l_seconds):
+        self.l_slice.extend(l_seconds)
+
+    def summary(self) -> dict:
+        return {
+            'calls':            self.calls,
+            'wallTime':         self.wallTime,
+            'cpuTime':          self.cpuTime,
+            'peakRSS':          self.peakRSS,
+            'workerCpuTime':    self.workerCpuTime,
+            'workerPeakRSS':    self.workerPeakRSS,
+            'sliceLatency':     latency_summary(self.l_slice)
+        }
+
+
+def stage_timed(method):
+    """
+    Decorate a pipeline stage method so that each call is timed into
+    the object's ``d_timers[<method name>]``, which is also available
+    to the method body as ``self.timer``.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.timer  = self.d_timers.setdefault(method.__name__, StageTimer())
+        with self.timer:
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+A long running ``heatmap`` server, for many small comparisons.
+
+The server loads the heavy imaging modules and builds the plugin's
+argument parser once, then accepts jobs over a local Unix socket. A job
+is one line of JSON holding the command line arguments ``heatmap`` would
+be given:
+
+    {"args": ["/in", "/out", "--inputSubDir1", "dir1", "--inputSubDir2", "dir2"]}
+
+and is answered by one line of JSON: the job's ``run.json`` result and
+timing, or the error that stopped it. A connection may send any number
+of jobs. Each connection is served on its own thread, but jobs are run
+one at a time, through the same ``Heatmap`` stages as a command line
+run, sharing one process pool for the life of the server.
+
+The socket is only open to its owner. By default it is made in the
+user's runtime directory, or else in a private directory of the system
+temporary directory; a server refuses to take over a socket that
+another server is still listening on.
+
+    heatmap-server &
+    heatmap-server --submit -- /in /out --inputSubDir1 dir1 ...
+"""
+
+import  os
+import  sys
+import  json
+import  stat
+import  time
+import  errno
+import  signal
+import  socket
+import  argparse
+import  tempfile
+import  traceback
+import  threading
+import  contextlib
+import  socketserver
+
+from    heatmap.heatmap     import Heatmap, modules_load
+
+Gstr_socket     :   str     = os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or
+    os.path.join(tempfile.gettempdir(), 'heatmap-%d' % os.getuid()), 'heatmap.sock')
+
+
+def socket_dirPrivate(str_socket):
+    """
+    Make sure the directory of <str_socket> exists and, if it is the
+    default one, that it is open to its owner only.
+    """
+    str_dir     = os.path.dirname(os.path.abspath(str_socket))
+    if str_dir != os.path.dirname(Gstr_socket):
+        return
+    os.makedirs(str_dir, mode = 0o700, exist_ok = True)
+    st          = os.stat(str_dir)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError("Socket directory %s is not private to this user" % str_dir)
+
+def socket_listening(str_socket) -> bool:
+    """
+    Is a server listening on the Unix socket <str_socket>?
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str_socket)
+        except OSError:
+            return False
+    return True
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Run each JSON job line of a connection and answer it.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                d_job   = json.loads(line)
+                d_reply = self.server.job_run(d_job['args'])
+            except (ValueError, KeyError, TypeError) as e:
+                d_reply = {'status': False, 'error': 'Bad job: %s' % e}
+            self.wfile.write((json.dumps(d_reply) + '\n').encode())
+            self.wfile.flush()
+
+
+class HeatmapServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serve ``heatmap`` jobs on the Unix socket <str_socket>.
+    """
+    daemon_threads  = True
+
+    def __init__(self, str_socket = Gstr_socket, b_quiet = False):
+        socket_dirPrivate(str_socket)
+        if os.path.lexists(str_socket):
+            # Only a stale socket, left by a server that died, is removed.
+            if not stat.S_ISSOCK(os.lstat(str_socket).st_mode):
+                raise FileExistsError(errno.EEXIST, "Not a socket", str_socket)
+            if socket_listening(str_socket):
+                raise OSError(errno.EADDRINUSE, "A server is already listening", str_socket)
+            os.remove(str_socket)
+        # Bound with owner only permissions from the start.
+        umask       = os.umask(0o177)
+        try:
+            super().__init__(str_socket, JobHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(str_socket, 0o600)
+        self.str_socket     :   str     = str_socket
+        self.b_quiet        :   bool    = b_quiet
+        self.jobs           :   int     = 0
+        # Jobs share one (warm) app and its process pools, and run one at
+        # a time; the imaging stack is imported now rather than by the
+        # first job.
+        self.app                        = Heatmap()
+        self.app.d_pools                = {}
+        self.lock                       = threading.Lock()
+        modules_load()
+
+    def job_run(self, l_args) -> dict:
+        """
+        Run one job with the command line arguments <l_args>, as the
+        ``heatmap`` script would, and return its result.
+        """
+        with self.lock:
+            self.jobs  += 1
+            d_reply     = {'job': self.jobs, 'status': False}
+            tic         = time.perf_counter()
+            try:
+                with contextlib.ExitStack() as stack:
+                    if self.b_quiet:
+                        stack.enter_context(contextlib.redirect_stdout(
+                            stack.enter_context(open(os.devnull, 'w'))))
+                    options = self.app.parse_args([str(arg) for arg in l_args])
+                    if options.saveinputmeta:
+                        self.app.options    = options
+                        self.app.save_input_meta()
+                    d_run   = self.app.run(options)
+                    if options.saveoutputmeta:
+                        self.app.options    = options
+                        self.app.save_output_meta()
+                d_reply['status']   = bool(d_run['status'])
+                d_reply['run']      = d_run
+            except SystemExit as e:
+                # argparse exits on bad arguments (having said why on stderr)
+                d_reply['error']    = 'Invalid arguments (exit status %s)' % e.code
+            except Exception as e:
+                d_reply['error']    = '%s: %s' % (type(e).__name__, e)
+                traceback.print_exc()
+                # A failed job may have broken a pool; the next starts afresh.
+                self.pools_shutdown()
+            d_reply['seconds']  = time.perf_counter() - tic
+            return d_reply
+
+    def pools_shutdown(self):
+        for pool in self.app.d_pools.values():
+            pool.shutdown()
+        self.app.d_pools.clear()
+
+    def server_close(self):
+        super().server_close()
+        self.pools_shutdown()
+        with contextlib.suppress(OSError):
+            os.remove(self.str_socket)
+
+
+def job_submit(l_args, str_socket = Gstr_socket) -> dict:
+    """
+    Submit one job to the server listening on <str_socket> and wait for
+    its result.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str_socket)
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps({'args': list(l_args)}) + '\n').encode())
+            stream.flush()
+            return json.loads(stream.readline())
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = 'Serve heatmap comparison jobs over a Unix socket, or submit one.'
+    )
+    parser.add_argument('--socket',     type = str,     default = Gstr_socket,
+                        help = 'path of the server socket (default %s)' % Gstr_socket)
+    parser.add_argument('--quiet',      action = 'store_true',
+                        help = "discard the jobs' progress output")
+    parser.add_argument('--submit',     action = 'store_true',
+                        help = 'submit the heatmap arguments after -- as a job and '
+                               'print its result, instead of serving')
+    parser.add_argument('heatmapArgs',  nargs = argparse.REMAINDER,
+                        help = 'arguments of the job to submit, after --')
+    args    = parser.parse_args(argv)
+
+    if args.submit:
+        d_reply = job_submit([a for a in args.heatmapArgs if a != '--'], args.socket)
+        json.dump(d_reply, sys.stdout, indent = 4)
+        print()
+        sys.exit(0 if d_reply['status'] else 1)
+
+    server  = HeatmapServer(args.socket, args.quiet)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('heatmap server listening on %s' % args.socket, file = sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
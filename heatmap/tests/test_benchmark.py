@@ -0,0 +1,58 @@
+import  os
+import  shutil
+import  tempfile
+
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+
+from heatmap.benchmark import stacks_generate, benchmark_run, startup_measure, Gl_STARTUP
+
+
+class BenchmarkTests(TestCase):
+    """
+    Test the synthetic stack generator and the benchmark harness.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def test_generate(self):
+        """
+        Stacks are deterministic and differ by about the asked density.
+        """
+        for str_run in ['a', 'b']:
+            stacks_generate(os.path.join(self.str_tmp, str_run),
+                            slices = 2, height = 64, width = 48,
+                            channels = 3, density = 0.1)
+        for str_dir in ['dir1', 'dir2']:
+            for str_file in os.listdir(os.path.join(self.str_tmp, 'a', str_dir)):
+                self.assertTrue(np.array_equal(
+                    cv2.imread(os.path.join(self.str_tmp, 'a', str_dir, str_file)),
+                    cv2.imread(os.path.join(self.str_tmp, 'b', str_dir, str_file))
+                ))
+        imageA  = cv2.imread(os.path.join(self.str_tmp, 'a', 'dir1', 'slice-0000.png'))
+        imageB  = cv2.imread(os.path.join(self.str_tmp, 'a', 'dir2', 'slice-0000.png'))
+        self.assertEqual(imageA.shape, (64, 48, 3))
+        changed = np.any(imageA != imageB, axis = 2).mean()
+        self.assertGreater(changed, 0.05)
+        self.assertLess(changed, 0.3)
+
+    def test_benchmark(self):
+        d_bench = benchmark_run({'slices': 4, 'height': 32, 'width': 32},
+                                ['--outputs', 'heatmap'],
+                                ['grayScale_slicesProcess'])
+        self.assertEqual(d_bench['pipeline']['slices'], 4)
+        self.assertGreater(d_bench['pipeline']['slicesPerSecond'], 0)
+        self.assertGreater(d_bench['stages']['grayScale_slicesProcess']['peakRSS'], 0)
+        self.assertEqual(set(d_bench['startup']), set(Gl_STARTUP))
+
+    def test_startup(self):
+        """
+        Metadata and help calls do not import the imaging stack.
+        """
+        for str_flag in Gl_STARTUP:
+            self.assertEqual(startup_measure(str_flag)['heavyModules'], [], str_flag)
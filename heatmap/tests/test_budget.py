@@ -0,0 +1,34 @@
+from unittest import TestCase
+
+from heatmap.budget import slice_footprint, compare_footprint, output_footprint, \
+                           memory_schedule, memory_estimate, PROCESS_BYTES, CHUNK_BYTES, MIB
+
+
+class BudgetTests(TestCase):
+    """
+    Test the memory footprint estimates and the window/worker schedule.
+    """
+    def test_footprint(self):
+        self.assertEqual(slice_footprint(100, 3, frozenset()), 200)
+        self.assertEqual(slice_footprint(100, 3, frozenset(['images', 'diff'])), 900)
+        self.assertEqual(slice_footprint(100, 1, frozenset(['images', 'diff', 'thresh'])), 400)
+        self.assertLess(compare_footprint(10 ** 8, tileSize = 512),
+                        compare_footprint(10 ** 8) / 100)
+        self.assertEqual(output_footprint(100, frozenset(), 2), 2400)
+        # Writer thread copies in 'npz' format, outlines, a cache entry
+        self.assertEqual(output_footprint(100, frozenset(['contours']), 2, 'npz', True),
+                         2400 + 1200 + 500 + CHUNK_BYTES)
+
+    def test_schedule(self):
+        (perSlice, perCompare, fixed) = (10 * MIB, 50 * MIB, 100 * MIB)
+        # Plenty: the whole stack with every worker
+        self.assertEqual(memory_schedule(100000 * MIB, 64, perSlice, perCompare, fixed, 4), (64, 4))
+        # A window narrowed to fit, still with every worker
+        budget  = fixed + 4 * (PROCESS_BYTES + perCompare) + 20 * perSlice
+        self.assertEqual(memory_schedule(budget, 64, perSlice, perCompare, fixed, 4), (20, 4))
+        self.assertLessEqual(memory_estimate(20, 4, perSlice, perCompare, fixed), budget)
+        # Workers traded for a window of at least one slice each
+        budget  = fixed + perCompare + 3 * perSlice
+        self.assertEqual(memory_schedule(budget, 64, perSlice, perCompare, fixed, 4), (3, 1))
+        # Nothing fits: one slice at a time
+        self.assertEqual(memory_schedule(fixed, 64, perSlice, perCompare, fixed, 4), (1, 1))
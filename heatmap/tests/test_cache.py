@@ -0,0 +1,56 @@
+import  os
+import  shutil
+import  tempfile
+
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+
+from heatmap.cache import SliceCache
+from heatmap.heatmap import contours_toBoxes
+
+
+class SliceCacheTests(TestCase):
+    """
+    Test the per-slice result cache.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def entry(self, seed):
+        rng     = np.random.default_rng(seed)
+        image   = rng.integers(0, 256, (32, 32), dtype = np.uint8)
+        return (image, image.copy())
+
+    def test_roundtrip(self):
+        cache           = SliceCache(self.str_tmp, 1 << 30)
+        (imageA, imageB) = self.entry(0)
+        imageThresh     = np.zeros((32, 32), np.uint8)
+        imageThresh[4:10, 6:20] = 255
+        contours        = cv2.findContours(imageThresh, cv2.RETR_EXTERNAL,
+                                           cv2.CHAIN_APPROX_SIMPLE)[0]
+        key             = cache.key([imageA, imageB], 'slice')
+        self.assertNotEqual(key, cache.key([imageA, imageB], 'stack'))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, 0.5, imageA, imageThresh, contours_toBoxes(contours))
+
+        (score, imageDiff, thresh, boxes) = SliceCache(self.str_tmp, 1 << 30).get(key)
+        self.assertEqual(score, 0.5)
+        self.assertTrue(np.array_equal(imageDiff, imageA))
+        self.assertEqual(boxes.tolist(), [[6, 4, 14, 6]])
+
+    def test_lru_eviction(self):
+        (imageA, imageB) = self.entry(0)
+        cache           = SliceCache(self.str_tmp, 1 << 30)
+        cache.put('a', 1.0, imageA, imageB, None)
+        entrySize       = cache.size
+        cache           = SliceCache(self.str_tmp, int(2.5 * entrySize))
+        cache.put('b', 1.0, imageA, imageB, None)
+        cache.get('a')
+        cache.put('c', 1.0, imageA, imageB, None)
+        self.assertEqual(sorted(cache.d_entries), ['a', 'c'])
+        self.assertFalse(os.path.exists(cache.path('b')))
@@ -0,0 +1,173 @@
+import  os
+import  sys
+import  json
+import  shutil
+import  tempfile
+import  subprocess
+import  importlib.util
+
+from unittest import TestCase, skipUnless
+
+import  numpy   as np
+
+from heatmap.heatmap import Heatmap
+from heatmap.dicom import DicomSeries, dicom_check
+
+pydicom = importlib.util.find_spec('pydicom')
+
+
+def series_write(str_dir, data, str_seriesUID = '1.2.3.4', window = None, positions = None):
+    """
+    Write the (rows, columns, slices) <data> as a DICOM series to
+    <str_dir>, slice k at position <positions>[k] along an oblique slice
+    normal, with file names and instance numbers that run against the
+    slice order.
+    """
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    os.makedirs(str_dir, exist_ok = True)
+    (rows, columns, count)  = data.shape
+    # Rows along x, columns along z, so that the slice normal is -y
+    orientation = [1, 0, 0, 0, 0, 1]
+    for k in range(count):
+        position            = positions[k] if positions else k
+        meta                = FileMetaDataset()
+        meta.MediaStorageSOPClassUID    = '1.2.840.10008.5.1.4.1.1.4'
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID          = ExplicitVRLittleEndian
+        ds                  = Dataset()
+        ds.file_meta        = meta
+        ds.SOPClassUID      = meta.MediaStorageSOPClassUID
+        ds.SOPInstanceUID   = meta.MediaStorageSOPInstanceUID
+        ds.SeriesInstanceUID        = str_seriesUID
+        ds.InstanceNumber           = count - k
+        ds.ImageOrientationPatient  = orientation
+        ds.ImagePositionPatient     = [0.0, -2.5 * position, 0.0]
+        ds.Rows                     = rows
+        ds.Columns                  = columns
+        ds.SamplesPerPixel          = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated            = 16
+        ds.BitsStored               = 16
+        ds.HighBit                  = 15
+        ds.PixelRepresentation      = 1
+        ds.RescaleSlope             = 2
+        ds.RescaleIntercept         = -100
+        if window:
+            (ds.WindowCenter, ds.WindowWidth)   = window
+        ds.PixelData                = np.ascontiguousarray(data[:, :, k], '<i2').tobytes()
+        ds.save_as(os.path.join(str_dir, 'im%03d.dcm' % (count - k)), enforce_file_format = True)
+
+
+class DicomImportTests(TestCase):
+    def test_check_without_pydicom(self):
+        """
+        Checking for a DICOM series, and loading the imaging stack, leave
+        pydicom unimported.
+        """
+        str_code    = ('import sys\n'
+                       'from heatmap.heatmap import modules_load\n'
+                       'from heatmap.dicom import dicom_check\n'
+                       'modules_load()\n'
+                       'dicom_check(%r)\n'
+                       'print("pydicom" in sys.modules)\n' % os.path.dirname(__file__))
+        self.assertEqual(subprocess.run([sys.executable, '-c', str_code], check = True,
+                                        capture_output = True, text = True).stdout.strip(),
+                         'False')
+
+
+@skipUnless(pydicom, 'pydicom is not installed')
+class DicomTests(TestCase):
+    """
+    Test DICOM series input.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+        rng             = np.random.default_rng(0)
+        self.data       = rng.integers(0, 1000, (40, 48, 6)).astype(np.int16)
+
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def test_series(self):
+        """
+        Slices come in geometric order, windowed into 8 bits.
+        """
+        str_dir     = os.path.join(self.str_tmp, 'series')
+        series_write(str_dir, self.data, window = (900, 1000))
+        self.assertTrue(dicom_check(str_dir))
+        with open(os.path.join(str_dir, 'zz-notes.txt'), 'w') as fp:
+            fp.write('not a DICOM file')
+        # Given a listing, its first file is the one looked at.
+        self.assertTrue(dicom_check(str_dir, sorted(os.listdir(str_dir))))
+        self.assertFalse(dicom_check(str_dir, ['zz-notes.txt']))
+        self.assertFalse(dicom_check(os.path.join(str_dir, 'zz-notes.txt')))
+
+        series      = DicomSeries(str_dir)
+        self.assertEqual(len(series), 6)
+        self.assertEqual(series.range(), (400.0, 1400.0))
+        for (k, image) in enumerate(series.slices(range(6))):
+            expected    = ((self.data[:, :, k] * 2.0 - 100) - 400) * (255.0 / 1000)
+            self.assertTrue(np.array_equal(image, np.clip(expected, 0, 255).astype(np.uint8)))
+        # Without a display window, the range of the modality values
+        series.headerWindow = ()
+        self.assertEqual(series.range(), (self.data.min() * 2.0 - 100, self.data.max() * 2.0 - 100))
+
+    def test_order(self):
+        """
+        Geometry, not file name or instance number, orders the slices.
+        """
+        str_dir     = os.path.join(self.str_tmp, 'series')
+        series_write(str_dir, self.data, positions = [3, 0, 5, 1, 4, 2])
+        series      = DicomSeries(str_dir)
+        self.assertEqual(series.lstr_files, [os.path.join(str_dir, 'im%03d.dcm' % (6 - k))
+                                             for k in [1, 3, 5, 0, 4, 2]])
+
+    def test_series_mixed(self):
+        str_dir     = os.path.join(self.str_tmp, 'series')
+        series_write(str_dir, self.data[:, :, :2], '1.2.3.4')
+        series_write(os.path.join(str_dir, 'other'), self.data[:, :, :2], '1.2.3.5')
+        for str_name in os.listdir(os.path.join(str_dir, 'other')):
+            os.rename(os.path.join(str_dir, 'other', str_name),
+                      os.path.join(str_dir, 'x' + str_name))
+        with self.assertRaises(ValueError):
+            DicomSeries(str_dir)
+
+    def test_run(self):
+        """
+        Two DICOM series are compared slice by slice without image files.
+        """
+        dataB                   = self.data.copy()
+        dataB[10:20, 10:20, 3]  = 999
+        series_write(os.path.join(self.str_tmp, 'in', 'a'), self.data)
+        series_write(os.path.join(self.str_tmp, 'in', 'b'), dataB)
+        os.makedirs(os.path.join(self.str_tmp, 'out'))
+
+        app     = Heatmap()
+        options = app.parse_args([  os.path.join(self.str_tmp, 'in'),
+                                    os.path.join(self.str_tmp, 'out'),
+                                    '--inputSubDir1', 'a',
+                                    '--inputSubDir2', 'b'])
+        app.run(options)
+        with open(os.path.join(self.str_tmp, 'out', 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        self.assertEqual(len(l_SSIM), 6)
+        self.assertAlmostEqual(l_SSIM[0], 1.0)
+        self.assertLess(l_SSIM[3], 1.0)
+        self.assertEqual(len(os.listdir(os.path.join(self.str_tmp, 'out', 'contourA'))), 6)
+
+        # A preview decodes the series a window at a time.
+        os.makedirs(os.path.join(self.str_tmp, 'preview'))
+        options = app.parse_args([  os.path.join(self.str_tmp, 'in'),
+                                    os.path.join(self.str_tmp, 'preview'),
+                                    '--inputSubDir1', 'a',
+                                    '--inputSubDir2', 'b',
+                                    '--preview', '2', '--previewTop', '1',
+                                    '--sliceWindow', '4'])
+        app.run(options)
+        with open(os.path.join(self.str_tmp, 'preview', 'run.json')) as fp:
+            d_run   = json.load(fp)
+        while 'selected' not in d_run:
+            d_run   = d_run['d_stack']
+        self.assertEqual(d_run['selected'], [3])
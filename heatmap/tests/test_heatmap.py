@@ -1,7 +1,57 @@
+import  os
+import  json
+import  time
+import  shutil
+import  tempfile
 
 from unittest import TestCase
 from unittest import mock
-from heatmap.heatmap import Heatmap
+
+import  numpy   as np
+import  cv2
+
+from heatmap.heatmap import Heatmap, contours_toBoxes, slice_compare, boxes_outline, boxes_draw
+
+
+def stacks_generate(str_inputdir, slices = 4, size = 64):
+    """
+    Write two small, deterministic PNG image sets to ``dir1`` and
+    ``dir2`` of <str_inputdir>. Set B is set A with a bright square
+    pasted into every other slice.
+    """
+    rng     = np.random.default_rng(0)
+    for str_dir in ['dir1', 'dir2']:
+        os.makedirs(os.path.join(str_inputdir, str_dir), exist_ok = True)
+    for i in range(slices):
+        imageA  = rng.integers(0, 128, (size, size, 3), dtype = np.uint8)
+        imageA  = cv2.GaussianBlur(imageA, (5, 5), 0)
+        imageB  = imageA.copy()
+        if i % 2:
+            imageB[size // 4 : size // 2, size // 4 : size // 2] = 250
+        cv2.imwrite(os.path.join(str_inputdir, 'dir1', 'img-%03d.png' % i), imageA)
+        cv2.imwrite(os.path.join(str_inputdir, 'dir2', 'img-%03d.png' % i), imageB)
+
+
+def slice_compareBusy(*args, **kwargs):
+    """
+    slice_compare() after a quarter of a second of CPU work, at module
+    level so that it can run in a process pool.
+    """
+    cpu     = time.process_time()
+    while time.process_time() - cpu < 0.25:
+        pass
+    return slice_compare(*args, **kwargs)
+
+
+def stack_untimed(d_stack):
+    """
+    A copy of a run.json status stack without its (run to run varying)
+    timing entries.
+    """
+    d_copy  = {k: v for (k, v) in d_stack.items() if k != 'timing'}
+    if isinstance(d_copy.get('d_stack'), dict):
+        d_copy['d_stack']   = stack_untimed(d_copy['d_stack'])
+    return d_copy
 
 
 class HeatmapTests(TestCase):
@@ -9,25 +59,578 @@ class HeatmapTests(TestCase):
     Test Heatmap.
     """
     def setUp(self):
-        self.app = Heatmap()
+        self.app        = Heatmap()
+        self.str_tmp    = tempfile.mkdtemp()
+        self.inputdir   = os.path.join(self.str_tmp, 'in')
+        stacks_generate(self.inputdir)
 
-    def test_run(self):
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def app_run(self, str_outputdir, *extra):
         """
-        Test the run code.
+        Run the app over the synthetic stacks into <str_outputdir>.
         """
         args = []
         if self.app.TYPE == 'ds':
-            args.append('inputdir') # you may want to change this inputdir mock
-        args.append('outputdir')  # you may want to change this outputdir mock
-
-        # you may want to add more of your custom defined optional arguments to test
-        # your app with
-        # eg.
-        # args.append('--custom-int')
-        # args.append(10)
+            args.append(self.inputdir)
+        args.append(str_outputdir)
+        args += ['--inputSubDir1', 'dir1', '--inputSubDir2', 'dir2']
+        args += list(extra)
 
         options = self.app.parse_args(args)
         self.app.run(options)
+        return options
+
+    def test_run(self):
+        """
+        Test the run code.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        options     = self.app_run(outputdir)
+
+        self.assertEqual(options.outputdir, outputdir)
+        with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        self.assertEqual(len(l_SSIM), 4)
+        self.assertGreater(l_SSIM[0], l_SSIM[1])
+        with open(os.path.join(outputdir, 'boxes.json')) as fp:
+            l_boxes = json.load(fp)
+        self.assertEqual(len(l_boxes), 4)
+        # A box around the square pasted into slice 1
+        self.assertTrue(any(x <= 16 and y <= 16 and x + w >= 32 and y + h >= 32
+                            for (x, y, w, h) in l_boxes[1]))
+        # The contour products are drawn on copies of the input slices.
+        self.assertFalse((self.app.l_imageA[1] == (0, 0, 255)).all(axis = -1).any())
+        # Boxes drawn all at once come out as those drawn one by one.
+        batchdir    = os.path.join(self.str_tmp, 'batch')
+        os.makedirs(batchdir)
+        with mock.patch('heatmap.heatmap.BOXES_BATCH', 1), \
+                mock.patch('heatmap.heatmap.BOXES_AREA', 1 << 20):
+            self.app_run(batchdir)
+        for str_dir in ['contourA', 'contourB']:
+            for str_file in os.listdir(os.path.join(outputdir, str_dir)):
+                self.assertTrue(np.array_equal(
+                    cv2.imread(os.path.join(outputdir, str_dir, str_file)),
+                    cv2.imread(os.path.join(batchdir,  str_dir, str_file))))
+        for str_dir in ['naive', 'heatmap', 'threshold']:
+            self.assertEqual(
+                len(os.listdir(os.path.join(outputdir, str_dir))), 4
+            )
+
+    def test_run_streaming(self):
+        """
+        A streamed run gives the same outputs and run.json as a full one.
+        """
+        d_out   = {}
+        for str_mode, extra in [('full', []), ('stream', ['--sliceWindow', '3'])]:
+            outputdir   = os.path.join(self.str_tmp, str_mode)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, *extra)
+            d_out[str_mode] = outputdir
+
+        for str_file in ['SSIN.json', 'run.json']:
+            with open(os.path.join(d_out['full'], str_file)) as fp:
+                full    = json.load(fp)
+            with open(os.path.join(d_out['stream'], str_file)) as fp:
+                stream  = json.load(fp)
+            if str_file == 'run.json':
+                (full, stream)  = (stack_untimed(full), stack_untimed(stream))
+            self.assertEqual(full, stream)
+        for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']:
+            l_files = sorted(os.listdir(os.path.join(d_out['full'], str_dir)))
+            self.assertEqual(
+                l_files, sorted(os.listdir(os.path.join(d_out['stream'], str_dir)))
+            )
+            for str_file in l_files:
+                self.assertTrue(np.array_equal(
+                    cv2.imread(os.path.join(d_out['full'],   str_dir, str_file)),
+                    cv2.imread(os.path.join(d_out['stream'], str_dir, str_file))
+                ))
+
+    def test_run_shards(self):
+        """
+        Shard runs merge into the outputs and run.json of a single run.
+        """
+        fulldir     = os.path.join(self.str_tmp, 'full')
+        sharddir    = os.path.join(self.str_tmp, 'shards')
+        mergedir    = os.path.join(self.str_tmp, 'merged')
+        os.makedirs(fulldir)
+        self.app_run(fulldir)
+        for (str_shard, extra) in [('1/3', []), ('2/3', []), ('3/3', ['--sliceWindow', '1'])]:
+            outputdir   = os.path.join(sharddir, 'shard%s' % str_shard[0])
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--shard', str_shard, *extra)
+        self.assertEqual(sorted(os.listdir(os.path.join(sharddir, 'shard3', 'heatmap'))),
+                         ['slice-002.png', 'slice-003.png'])
+
+        os.makedirs(mergedir)
+        self.inputdir   = sharddir
+        self.app_run(mergedir, '--merge')
+        for str_file in ['SSIN.json', 'boxes.json', 'run.json']:
+            with open(os.path.join(fulldir, str_file)) as fp:
+                full    = json.load(fp)
+            with open(os.path.join(mergedir, str_file)) as fp:
+                merged  = json.load(fp)
+            if str_file == 'run.json':
+                self.assertEqual([d['sliceStart'] for d in merged.pop('shards')], [0, 1, 2])
+                self.assertEqual(merged.pop('imagesMerged'), 20)
+                (full, merged)  = (stack_untimed(full), stack_untimed(merged))
+            self.assertEqual(full, merged)
+        for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']:
+            self.assertEqual(sorted(os.listdir(os.path.join(fulldir, str_dir))),
+                             sorted(os.listdir(os.path.join(mergedir, str_dir))))
+
+        # Shards that leave out slices are refused.
+        shutil.rmtree(os.path.join(sharddir, 'shard2'))
+        with self.assertRaises(ValueError):
+            self.app_run(mergedir, '--merge')
+
+    def test_run_shards_preview(self):
+        """
+        Merged preview shards rank the whole stack's scores, and select
+        the slices each shard compared.
+        """
+        fulldir     = os.path.join(self.str_tmp, 'full')
+        sharddir    = os.path.join(self.str_tmp, 'shards')
+        mergedir    = os.path.join(self.str_tmp, 'merged')
+        os.makedirs(fulldir)
+        self.app_run(fulldir, '--preview', '2', '--previewTop', '1')
+        for str_shard in ['1/3', '2/3', '3/3']:
+            outputdir   = os.path.join(sharddir, 'shard%s' % str_shard[0])
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--shard', str_shard, '--preview', '2', '--previewTop', '1')
+
+        os.makedirs(mergedir)
+        self.inputdir   = sharddir
+        self.app_run(mergedir, '--merge')
+        l_stack     = []
+        for str_dir in [fulldir, mergedir]:
+            with open(os.path.join(str_dir, 'run.json')) as fp:
+                d_stack = json.load(fp)
+            while d_stack['method'] != 'slices_preview':
+                d_stack = d_stack['d_stack']
+            l_stack.append(d_stack)
+        with open(os.path.join(mergedir, 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        (d_full, d_merged)  = l_stack
+        self.assertEqual(d_merged['factor'], 2)
+        self.assertEqual(d_merged['scores'], d_full['scores'])
+        self.assertEqual(d_merged['ranking'], d_full['ranking'])
+        self.assertEqual(len(d_merged['selected']), 3)
+        self.assertEqual(d_merged['selected'],
+                         [i for (i, score) in enumerate(l_SSIM) if score is not None])
+
+        # Shards previewed differently are refused.
+        outputdir   = os.path.join(sharddir, 'shard3')
+        shutil.rmtree(outputdir)
+        os.makedirs(outputdir)
+        self.inputdir   = os.path.join(self.str_tmp, 'in')
+        self.app_run(outputdir, '--shard', '3/3', '--preview', '4', '--previewTop', '1')
+        self.inputdir   = sharddir
+        mergedir    = os.path.join(self.str_tmp, 'refused')
+        os.makedirs(mergedir)
+        with self.assertRaises(ValueError):
+            self.app_run(mergedir, '--merge')
+
+    def test_run_workers(self):
+        """
+        A process pool gives the same, identically ordered, scores.
+        """
+        l_SSIM  = []
+        for workers in ['1', '2']:
+            outputdir   = os.path.join(self.str_tmp, 'out%s' % workers)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--workers', workers)
+            with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                l_SSIM.append(json.load(fp))
+        self.assertEqual(l_SSIM[0], l_SSIM[1])
+
+    def test_run_stack_engine(self):
+        """
+        The batched SSIM engine reproduces the per-slice scores.
+        """
+        l_SSIM  = []
+        for str_engine in ['slice', 'stack']:
+            outputdir   = os.path.join(self.str_tmp, str_engine)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--ssimEngine', str_engine)
+            with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                l_SSIM.append(json.load(fp))
+        np.testing.assert_allclose(l_SSIM[0], l_SSIM[1], atol = 1e-4)
+
+        # An unknown engine is refused rather than run as 'slice'.
+        with self.assertRaises(ValueError):
+            self.app_run(os.path.join(self.str_tmp, 'slice'), '--ssimEngine', 'stacked')
+
+    def test_run_tiled(self):
+        """
+        Tiled comparison reproduces the whole-slice scores and outputs.
+        """
+        l_SSIM  = []
+        for str_tile in ['0', '16']:
+            outputdir   = os.path.join(self.str_tmp, 'tile' + str_tile)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--tileSize', str_tile)
+            with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                l_SSIM.append(json.load(fp))
+        np.testing.assert_allclose(l_SSIM[0], l_SSIM[1], atol = 1e-12)
+        for str_dir in ['heatmap', 'threshold', 'contourA']:
+            self.assertEqual(sorted(os.listdir(os.path.join(self.str_tmp, 'tile0', str_dir))),
+                             sorted(os.listdir(os.path.join(self.str_tmp, 'tile16', str_dir))))
+
+    def test_run_cache(self):
+        """
+        A rerun over one changed slice only recomputes and rewrites it.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        cachedir    = os.path.join(self.str_tmp, 'cache')
+        os.makedirs(outputdir)
+        self.app_run(outputdir, '--cacheDir', cachedir)
+        with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        unchanged   = len([ str_file
+                            for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']
+                            for str_file in os.listdir(os.path.join(outputdir, str_dir))
+                            if str_file != 'slice-002.png'])
+
+        str_slice   = os.path.join(self.inputdir, 'dir2', 'img-002.png')
+        image       = cv2.imread(str_slice)
+        image[:8, :8] = 0
+        cv2.imwrite(str_slice, image)
+        self.app_run(outputdir, '--cacheDir', cachedir)
+
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_run   = json.load(fp)
+        self.assertEqual(d_run['writeSkipped'], unchanged)
+        # Identical slice 0 bypasses the cache altogether.
+        self.assertEqual(d_run['d_stack']['identicalSlices'], 1)
+        self.assertEqual(d_run['d_stack']['cacheHits'], 2)
+        self.assertEqual(d_run['d_stack']['cacheMisses'], 1)
+        with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+            l_rerun = json.load(fp)
+        self.assertEqual([l_SSIM[i] for i in (0, 1, 3)], [l_rerun[i] for i in (0, 1, 3)])
+        self.assertNotEqual(l_SSIM[2], l_rerun[2])
+
+        # Other output options rewrite every file, from cached results.
+        self.app_run(outputdir, '--cacheDir', cachedir, '--pngCompression', '9')
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_run   = json.load(fp)
+        self.assertEqual(d_run['writeSkipped'], 0)
+        self.assertEqual(d_run['d_stack']['cacheHits'], 3)
+
+    def test_run_outputs(self):
+        """
+        Only the selected products are written, with unchanged scores.
+        """
+        l_SSIM  = []
+        for (str_outputs, l_dirs) in [  ('scores',              []),
+                                        ('heatmap',             ['heatmap']),
+                                        ('contourB,threshold',  ['threshold', 'contourB'])]:
+            outputdir   = os.path.join(self.str_tmp, str_outputs)
+            os.makedirs(outputdir)
+            for str_engine in ['slice', 'stack']:
+                self.app_run(outputdir, '--outputs', str_outputs, '--ssimEngine', str_engine)
+                with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                    l_SSIM.append(json.load(fp))
+            self.assertEqual(
+                sorted(str_dir for str_dir in os.listdir(outputdir)
+                       if os.path.isdir(os.path.join(outputdir, str_dir))),
+                sorted(l_dirs)
+            )
+        for l_scores in l_SSIM[2::2]:
+            self.assertEqual(l_scores, l_SSIM[0])
+        for l_scores in l_SSIM[1::2]:
+            np.testing.assert_allclose(l_scores, l_SSIM[0], atol = 1e-4)
+
+    def test_run_identical(self):
+        """
+        Identical slice pairs skip the comparison but give exactly the
+        outputs that comparing them would.
+        """
+        d_out   = {}
+        for str_mode in ['fast', 'full']:
+            outputdir   = os.path.join(self.str_tmp, str_mode)
+            os.makedirs(outputdir)
+            if str_mode == 'fast':
+                self.app_run(outputdir)
+            else:
+                with mock.patch.object(Heatmap, 'slice_same', return_value = False):
+                    self.app_run(outputdir)
+            d_out[str_mode] = outputdir
+
+        for (str_mode, identical) in [('fast', 2), ('full', 0)]:
+            with open(os.path.join(d_out[str_mode], 'run.json')) as fp:
+                self.assertEqual(json.load(fp)['d_stack']['identicalSlices'], identical)
+        with open(os.path.join(d_out['fast'], 'SSIN.json')) as fp:
+            l_fast  = json.load(fp)
+        with open(os.path.join(d_out['full'], 'SSIN.json')) as fp:
+            self.assertEqual(l_fast, json.load(fp))
+        self.assertEqual([l_fast[0], l_fast[2]], [1.0, 1.0])
+        for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']:
+            for str_file in os.listdir(os.path.join(d_out['full'], str_dir)):
+                self.assertTrue(np.array_equal(
+                    cv2.imread(os.path.join(d_out['fast'], str_dir, str_file)),
+                    cv2.imread(os.path.join(d_out['full'], str_dir, str_file))
+                ), "%s/%s differs" % (str_dir, str_file))
+
+    def test_run_npz(self):
+        """
+        Container output holds the same slices as PNG output, also when
+        merged from shards.
+        """
+        pngdir      = os.path.join(self.str_tmp, 'png')
+        npzdir      = os.path.join(self.str_tmp, 'npz')
+        sharddir    = os.path.join(self.str_tmp, 'shards')
+        for str_dir in [pngdir, npzdir, os.path.join(sharddir, 'a'), os.path.join(sharddir, 'b')]:
+            os.makedirs(str_dir)
+        self.app_run(pngdir)
+        self.app_run(npzdir, '--outputFormat', 'npz', '--sliceWindow', '3')
+        for (str_shard, str_dir) in [('1/2', 'a'), ('2/2', 'b')]:
+            self.app_run(os.path.join(sharddir, str_dir), '--outputFormat', 'npz',
+                         '--shard', str_shard)
+        self.inputdir   = sharddir
+        mergedir    = os.path.join(self.str_tmp, 'merged')
+        os.makedirs(mergedir)
+        self.app_run(mergedir, '--merge')
+
+        for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']:
+            for str_outputdir in [npzdir, mergedir]:
+                self.assertFalse(os.path.exists(os.path.join(str_outputdir, str_dir)))
+                with np.load(os.path.join(str_outputdir, str_dir + '.npz')) as npz:
+                    self.assertEqual(sorted(npz.files), ['slice-%03d' % i for i in range(4)])
+                    for i in range(4):
+                        self.assertTrue(np.array_equal(
+                            cv2.imread(os.path.join(pngdir, str_dir, 'slice-%03d.png' % i),
+                                       cv2.IMREAD_UNCHANGED),
+                            npz['slice-%03d' % i]
+                        ), "%s slice %d differs" % (str_dir, i))
+
+    def test_run_memory_budget(self):
+        """
+        A tight memory budget drops workers rather than running over.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        self.app_run(outputdir, '--memoryBudget', '102', '--workers', '4')
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_memory    = json.load(fp)['memory']
+        self.assertEqual((d_memory['workers'], d_memory['sliceWindow']), (1, 0))
+        self.assertTrue(d_memory['fits'])
+        self.assertEqual(len(os.listdir(os.path.join(outputdir, 'heatmap'))), 4)
+
+    def test_run_pairing(self):
+        """
+        Pairing by name skips a stray file instead of shifting every
+        later pair, and reports the files left without a partner.
+        """
+        os.rename(os.path.join(self.inputdir, 'dir2', 'img-001.png'),
+                  os.path.join(self.inputdir, 'dir2', 'img-009.png'))
+        d_SSIM  = {}
+        for str_pairKey in ['position', 'stem']:
+            outputdir   = os.path.join(self.str_tmp, str_pairKey)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--pairKey', str_pairKey)
+            with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                d_SSIM[str_pairKey] = json.load(fp)
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_files = json.load(fp)
+        while 'd_stack' in d_files:
+            d_files = d_files['d_stack']
+        self.assertEqual((d_files['pairCount'], d_files['unmatchedA'], d_files['unmatchedB']),
+                         (3, ['img-001.png'], ['img-009.png']))
+        # Slices 0 and 2 are unchanged between A and B, 3 is not
+        self.assertEqual(d_SSIM['stem'][:2], [1.0, 1.0])
+        self.assertLess(d_SSIM['stem'][2], 1.0)
+        self.assertLess(d_SSIM['position'][1], 1.0)
+
+    def test_run_listing_cache(self):
+        """
+        With a warm listing cache, the image directories are not listed
+        again, not even to look for a DICOM series.
+        """
+        cachedir    = os.path.join(self.str_tmp, 'cache')
+        for str_run in ['cold', 'warm']:
+            outputdir   = os.path.join(self.str_tmp, str_run)
+            os.makedirs(outputdir)
+            with mock.patch('os.listdir', wraps = os.listdir) as listdir, \
+                    mock.patch('os.scandir', wraps = os.scandir) as scandir:
+                self.app_run(outputdir, '--cacheDir', cachedir)
+            l_listed    = [os.path.basename(call.args[0]) for call in
+                           listdir.call_args_list + scandir.call_args_list if call.args]
+        self.assertNotIn('dir1', l_listed)
+        self.assertNotIn('dir2', l_listed)
 
-        # write your own assertions
-        self.assertEqual(options.outputdir, 'outputdir')
+    def test_run_preview(self):
+        """
+        A preview compares only the slices it selects at full resolution,
+        and the scores of those match a full run's.
+        """
+        fulldir     = os.path.join(self.str_tmp, 'full')
+        os.makedirs(fulldir)
+        self.app_run(fulldir)
+        with open(os.path.join(fulldir, 'SSIN.json')) as fp:
+            l_full  = json.load(fp)
+        for (str_mode, extra, l_selected) in [
+                ('top',       ['--previewTop', '1'], [1]),
+                ('threshold', ['--previewThreshold', '0.99', '--sliceWindow', '1',
+                               '--cacheDir', os.path.join(self.str_tmp, 'cache')], [1, 3])]:
+            outputdir   = os.path.join(self.str_tmp, str_mode)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--preview', '4', *extra)
+            with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+                l_SSIM  = json.load(fp)
+            with open(os.path.join(outputdir, 'run.json')) as fp:
+                d_stack = json.load(fp)
+            while d_stack['method'] != 'slices_preview':
+                d_stack = d_stack['d_stack']
+            self.assertEqual(len(d_stack['scores']), 4)
+            self.assertEqual(d_stack['selected'], l_selected)
+            self.assertEqual(sorted(d_stack['ranking'][:len(l_selected)]), l_selected)
+            self.assertEqual(l_SSIM, [l_full[i] if i in l_selected else None for i in range(4)])
+            self.assertEqual(sorted(os.listdir(os.path.join(outputdir, 'heatmap'))),
+                             ['slice-%03d.png' % i for i in l_selected])
+
+    def test_run_metrics(self):
+        """
+        The metrics table has a row per slice that agrees with SSIN.json.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        self.app_run(outputdir, '--outputs', 'scores', '--metrics', 'mse,psnr,contourCount')
+        with open(os.path.join(outputdir, 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        with open(os.path.join(outputdir, 'metrics.csv')) as fp:
+            l_rows  = [line.strip().split(',') for line in fp]
+        self.assertEqual(l_rows[0], ['slice', 'ssim', 'mse', 'psnr', 'contourCount'])
+        self.assertEqual([int(row[0]) for row in l_rows[1:]], [0, 1, 2, 3])
+        self.assertEqual([float(row[1]) for row in l_rows[1:]], l_SSIM)
+        # Even slices are identical, odd ones have one changed square.
+        self.assertEqual([row[3] for row in l_rows[1::2]], ['inf', 'inf'])
+        self.assertTrue(all(float(row[2]) > 0 and int(row[4]) >= 1 for row in l_rows[2::2]))
+        self.assertFalse(os.path.exists(os.path.join(outputdir, 'heatmap')))
+
+        # Measured on the workers, by every engine and from the cache,
+        # the metrics are the same.
+        for (str_mode, extra) in [  ('workers', ['--workers', '2']),
+                                    ('stack',   ['--ssimEngine', 'stack']),
+                                    ('tiled',   ['--tileSize', '16']),
+                                    ('cache',   ['--cacheDir', os.path.join(self.str_tmp, 'cache')]),
+                                    ('cached',  ['--cacheDir', os.path.join(self.str_tmp, 'cache')])]:
+            outputdir   = os.path.join(self.str_tmp, str_mode)
+            os.makedirs(outputdir)
+            self.app_run(outputdir, '--outputs', 'scores', '--metrics', 'mse,psnr,contourCount',
+                         *extra)
+            with open(os.path.join(outputdir, 'metrics.csv')) as fp:
+                l_mode  = [line.strip().split(',') for line in fp]
+            l_columns   = slice(2, 4) if str_mode == 'stack' else slice(2, None)
+            self.assertEqual([row[l_columns] for row in l_mode],
+                             [row[l_columns] for row in l_rows])
+
+    def test_run_grayscale(self):
+        """
+        Grayscale sources give the same outputs as their BGR versions.
+        """
+        str_grayInput   = os.path.join(self.str_tmp, 'gray')
+        for str_dir in ['dir1', 'dir2']:
+            os.makedirs(os.path.join(str_grayInput, str_dir))
+            for str_file in os.listdir(os.path.join(self.inputdir, str_dir)):
+                image   = cv2.imread(os.path.join(self.inputdir, str_dir, str_file))
+                image   = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                cv2.imwrite(os.path.join(str_grayInput, str_dir, str_file), image)
+                cv2.imwrite(os.path.join(self.inputdir, str_dir, str_file),
+                            cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+
+        d_out       = {}
+        for (str_mode, str_input) in [('bgr', self.inputdir), ('gray', str_grayInput)]:
+            outputdir   = os.path.join(self.str_tmp, 'out-' + str_mode)
+            os.makedirs(outputdir)
+            self.inputdir   = str_input
+            self.app_run(outputdir)
+            d_out[str_mode] = outputdir
+        self.assertEqual(self.app.l_imageA[0].ndim, 2)
+        for str_dir in ['naive', 'heatmap', 'threshold', 'contourA', 'contourB']:
+            for str_file in os.listdir(os.path.join(d_out['bgr'], str_dir)):
+                self.assertTrue(np.array_equal(
+                    cv2.imread(os.path.join(d_out['bgr'],  str_dir, str_file)),
+                    cv2.imread(os.path.join(d_out['gray'], str_dir, str_file))
+                ), "%s/%s differs" % (str_dir, str_file))
+
+    def test_run_timing(self):
+        """
+        Every stage reports its timing, and --profile dumps a profile.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        self.app_run(outputdir, '--profile', '--sliceWindow', '3')
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_stack = json.load(fp)
+        l_methods   = []
+        while d_stack:
+            l_methods.append(d_stack['method'])
+            self.assertGreaterEqual(d_stack['timing']['wallTime'], 0)
+            self.assertGreater(d_stack['timing']['peakRSS'], 0)
+            if d_stack['method'] != 'imageFileNames_determine':
+                self.assertEqual(d_stack['timing']['calls'], 2)
+                self.assertEqual(d_stack['timing']['sliceLatency']['count'], 4)
+            d_stack = d_stack.get('d_stack')
+        self.assertEqual(len(l_methods), 5)
+        self.assertTrue(os.path.getsize(os.path.join(outputdir, 'heatmap.prof')))
+
+    def test_run_timing_workers(self):
+        """
+        The CPU time of a stage includes that of its pool workers.
+        """
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        with mock.patch('heatmap.heatmap.slice_compare', slice_compareBusy):
+            self.app_run(outputdir, '--workers', '2')
+        with open(os.path.join(outputdir, 'run.json')) as fp:
+            d_stack = json.load(fp)
+        while d_stack['method'] != 'grayScale_slicesProcess':
+            d_stack = d_stack['d_stack']
+        # Only the two differing slice pairs are compared.
+        self.assertGreaterEqual(d_stack['timing']['cpuTime'], 2 * 0.25)
+        self.assertGreaterEqual(d_stack['timing']['cpuTime'], d_stack['timing']['workerCpuTime'])
+        self.assertGreaterEqual(d_stack['timing']['workerCpuTime'], 2 * 0.25)
+        self.assertGreater(d_stack['timing']['workerPeakRSS'], 0)
+
+
+class BoxesOutlineTests(TestCase):
+    """
+    Test finding and drawing contour boxes.
+    """
+    def test_boxes(self):
+        rng         = np.random.default_rng(1)
+        image       = (rng.random((64, 64)) > 0.7).astype(np.uint8) * 255
+        contours    = cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+        self.assertGreater(len(contours), 10)
+        self.assertEqual(contours_toBoxes(contours).tolist(),
+                         [list(cv2.boundingRect(c)) for c in contours])
+        self.assertEqual(contours_toBoxes([]).shape, (0, 4))
+
+    def test_matches_rectangle(self):
+        rng     = np.random.default_rng(6)
+        for shape in [(64, 80), (7, 5)]:
+            boxes   = np.stack([rng.integers(0, shape[1], 50), rng.integers(0, shape[0], 50),
+                                rng.integers(1, 20, 50), rng.integers(1, 20, 50)], 1)
+            boxes[:, 2] = np.minimum(boxes[:, 2], shape[1] - boxes[:, 0])
+            boxes[:, 3] = np.minimum(boxes[:, 3], shape[0] - boxes[:, 1])
+            image   = np.zeros(shape + (3,), np.uint8)
+            for (x, y, w, h) in boxes.tolist():
+                cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            for outline in [None, boxes_outline(boxes, shape)]:
+                self.assertTrue(np.array_equal(
+                    boxes_draw(np.zeros(shape + (3,), np.uint8), boxes, outline), image))
+        empty   = np.zeros((0, 4), np.int32)
+        self.assertFalse(boxes_draw(np.zeros((8, 8, 3), np.uint8), empty,
+                                    boxes_outline(empty, (8, 8))).any())
+
+    def test_bounding_area(self):
+        """
+        The outline covers only the boxes' bounding area.
+        """
+        boxes   = np.array([[100, 200, 10, 5], [130, 220, 4, 4]], np.int32)
+        (top, left, mask) = boxes_outline(boxes, (4000, 4000))
+        self.assertEqual((top, left, mask.shape), (199, 99, (27, 37)))
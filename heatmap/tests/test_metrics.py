@@ -0,0 +1,53 @@
+import  math
+
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+from    skimage.metrics import mean_squared_error, peak_signal_noise_ratio
+
+from heatmap.heatmap import slice_compare
+from heatmap.metrics import metrics_select, metrics_needs, metrics_compute, Gd_METRICS
+
+
+class MetricsTests(TestCase):
+    """
+    Test the per-slice metrics against reference implementations.
+    """
+    def setUp(self):
+        rng             = np.random.default_rng(5)
+        self.imageA     = cv2.GaussianBlur(rng.integers(0, 256, (70, 90), dtype = np.uint8), (5, 5), 0)
+        self.imageB     = self.imageA.copy()
+        self.imageB[10:30, 20:50]   = 240
+        self.imageB[50:60, 5:15]    = 0
+
+    def test_values(self):
+        (score, imageDiff, imageThresh, boxes) = slice_compare(self.imageA, self.imageB)
+        contours    = cv2.findContours(imageThresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+        l_values    = metrics_compute(list(Gd_METRICS), self.imageA, self.imageB,
+                                      imageThresh, boxes)
+        d_values    = dict(zip(Gd_METRICS, l_values))
+        self.assertAlmostEqual(d_values['mse'], mean_squared_error(self.imageA, self.imageB))
+        self.assertAlmostEqual(d_values['psnr'], peak_signal_noise_ratio(self.imageA, self.imageB))
+        self.assertAlmostEqual(d_values['ncc'], np.corrcoef(self.imageA.ravel(),
+                                                            self.imageB.ravel())[0, 1])
+        self.assertAlmostEqual(d_values['changed'], (imageThresh > 0).mean())
+        self.assertEqual(d_values['contourCount'], len(contours))
+        l_areas     = [w * h for (x, y, w, h) in map(cv2.boundingRect, contours)]
+        self.assertEqual(d_values['contourArea'], sum(l_areas))
+        self.assertEqual(d_values['contourAreaMax'], max(l_areas))
+
+    def test_identical(self):
+        (mse, psnr, ncc) = metrics_compute(['mse', 'psnr', 'ncc'], self.imageA, self.imageA)
+        self.assertEqual((mse, psnr), (0.0, math.inf))
+        self.assertAlmostEqual(ncc, 1.0)
+        constant    = np.full((8, 8), 7, np.uint8)
+        self.assertTrue(math.isnan(metrics_compute(['ncc'], constant, constant)[0]))
+
+    def test_select(self):
+        self.assertEqual(metrics_select('psnr, mse'), ['mse', 'psnr'])
+        self.assertEqual(metrics_select('all'), list(Gd_METRICS))
+        self.assertEqual(metrics_select(''), [])
+        self.assertEqual(metrics_needs(['mse', 'changed', 'contourArea']), ['contours', 'thresh'])
+        with self.assertRaises(ValueError):
+            metrics_select('mse,nonsense')
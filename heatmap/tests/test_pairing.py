@@ -0,0 +1,54 @@
+import  os
+import  shutil
+import  tempfile
+
+from unittest import TestCase
+from unittest import mock
+
+from heatmap.pairing import pairs_index, listing_read
+
+
+class PairingTests(TestCase):
+    """
+    Test the pairing index and the cached directory listings.
+    """
+    def test_position(self):
+        (l_pairs, lstr_A, lstr_B) = pairs_index(['a1', 'a2', 'a3'], ['b1', 'b2'])
+        self.assertEqual(l_pairs, [('a1', 'b1'), ('a2', 'b2')])
+        self.assertEqual((lstr_A, lstr_B), (['a3'], []))
+
+    def test_keys(self):
+        lstr_A  = ['s-1.png', 's-2.png', 's-10.png', 'notes.txt']
+        lstr_B  = ['s-1.jpg', 's-10.jpg', 's-11.jpg']
+        (l_pairs, unmatchedA, unmatchedB) = pairs_index(lstr_A, lstr_B, r's-(\d+)')
+        # Numeric keys pair in numeric, not name, order
+        self.assertEqual(l_pairs, [('s-1.png', 's-1.jpg'), ('s-10.png', 's-10.jpg')])
+        self.assertEqual((unmatchedA, unmatchedB), (['notes.txt', 's-2.png'], ['s-11.jpg']))
+        (l_pairs, unmatchedA, unmatchedB) = pairs_index(['x.png', 'y.png'], ['y.jpg'], 'stem')
+        self.assertEqual((l_pairs, unmatchedA, unmatchedB), ([('y.png', 'y.jpg')], ['x.png'], []))
+        with self.assertRaises(ValueError):
+            pairs_index(['s-01.png', 's-1.png'], [], r's-(\d+)')
+        # A name matched without the key group has no key.
+        (l_pairs, unmatchedA, unmatchedB) = pairs_index(['1.png', 'x.png'], ['1.jpg'],
+                                                        r'(\d+)?\.')
+        self.assertEqual((l_pairs, unmatchedA, unmatchedB), ([('1.png', '1.jpg')], ['x.png'], []))
+
+    def test_listing_cache(self):
+        str_tmp     = tempfile.mkdtemp()
+        try:
+            str_dir     = os.path.join(str_tmp, 'images')
+            str_cache   = os.path.join(str_tmp, 'cache')
+            os.makedirs(str_dir)
+            for str_name in ['b', 'a']:
+                open(os.path.join(str_dir, str_name), 'w').close()
+            self.assertEqual(listing_read(str_dir, str_cache), ['a', 'b'])
+            # A cached listing is used while the directory is unchanged...
+            with mock.patch('heatmap.pairing.os.scandir') as scandir:
+                self.assertEqual(listing_read(str_dir, str_cache), ['a', 'b'])
+                self.assertFalse(scandir.called)
+            # ...and read again once it changes
+            open(os.path.join(str_dir, 'c'), 'w').close()
+            self.assertEqual(listing_read(str_dir, str_cache), ['a', 'b', 'c'])
+        finally:
+            shutil.rmtree(str_tmp)
+
@@ -0,0 +1,24 @@
+from unittest import TestCase
+
+import  numpy   as np
+
+from heatmap.preview import slice_downsample, slices_rank, slices_select
+
+
+class PreviewTests(TestCase):
+    """
+    Test the preview downsampling and slice selection.
+    """
+    def test_downsample(self):
+        image   = np.arange(64 * 48, dtype = np.uint8).reshape(48, 64)
+        self.assertEqual(slice_downsample(image, 4).shape, (12, 16))
+        # Never below the SSIM window size
+        self.assertEqual(slice_downsample(image, 16).shape, (7, 7))
+        self.assertIs(slice_downsample(image, 1), image)
+
+    def test_select(self):
+        l_scores    = [0.5, 0.2, 0.9, 0.2]
+        self.assertEqual(slices_rank(l_scores), [1, 3, 0, 2])
+        self.assertEqual(slices_select(l_scores, top = 1), [1])
+        self.assertEqual(slices_select(l_scores, top = 1, threshold = 0.6), [0, 1, 3])
+        self.assertEqual(slices_select(l_scores), [])
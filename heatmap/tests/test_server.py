@@ -0,0 +1,87 @@
+import  os
+import  stat
+import  shutil
+import  socket
+import  tempfile
+import  threading
+
+from unittest import TestCase
+
+from heatmap.server import HeatmapServer, job_submit
+from heatmap.tests.test_heatmap import stacks_generate
+
+
+class HeatmapServerTests(TestCase):
+    """
+    Test running jobs through the server.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+        self.inputdir   = os.path.join(self.str_tmp, 'in')
+        self.str_socket = os.path.join(self.str_tmp, 'heatmap.sock')
+        stacks_generate(self.inputdir)
+        self.server     = HeatmapServer(self.str_socket, b_quiet = True)
+        self.thread     = threading.Thread(target = self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.str_tmp)
+
+    def test_jobs(self):
+        for i in range(2):
+            outputdir   = os.path.join(self.str_tmp, 'out%d' % i)
+            os.makedirs(outputdir)
+            d_reply     = job_submit([self.inputdir, outputdir,
+                                      '--inputSubDir1', 'dir1', '--inputSubDir2', 'dir2',
+                                      '--outputs', 'heatmap'], self.str_socket)
+            self.assertTrue(d_reply['status'])
+            self.assertEqual(d_reply['job'], i + 1)
+            self.assertEqual(d_reply['run']['method'], 'outputs_generate')
+            self.assertEqual(len(os.listdir(os.path.join(outputdir, 'heatmap'))), 4)
+
+    def test_clients(self):
+        """
+        An idle client does not hold up another, and jobs share one pool.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as idle:
+            idle.connect(self.str_socket)
+            l_pools = []
+            for i in range(2):
+                outputdir   = os.path.join(self.str_tmp, 'out%d' % i)
+                os.makedirs(outputdir)
+                d_reply     = job_submit([self.inputdir, outputdir,
+                                          '--inputSubDir1', 'dir1', '--inputSubDir2', 'dir2',
+                                          '--outputs', 'scores', '--workers', '2'],
+                                         self.str_socket)
+                self.assertTrue(d_reply['status'])
+                l_pools.append(self.server.app.d_pools[2])
+        self.assertIs(l_pools[0], l_pools[1])
+
+    def test_socket(self):
+        """
+        The socket is private, and a live one is never taken over.
+        """
+        self.assertEqual(stat.S_IMODE(os.stat(self.str_socket).st_mode), 0o600)
+        with self.assertRaises(OSError):
+            HeatmapServer(self.str_socket)
+        # A stale socket, with no server behind it, is replaced.
+        str_stale   = os.path.join(self.str_tmp, 'stale.sock')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(str_stale)
+        server      = HeatmapServer(str_stale, b_quiet = True)
+        server.server_close()
+
+    def test_job_errors(self):
+        outputdir   = os.path.join(self.str_tmp, 'out')
+        os.makedirs(outputdir)
+        d_reply     = job_submit([self.inputdir, outputdir,
+                                  '--inputSubDir1', 'dir1', '--inputSubDir2', 'dir2',
+                                  '--outputs', 'nonsense'], self.str_socket)
+        self.assertFalse(d_reply['status'])
+        self.assertIn('ValueError', d_reply['error'])
+        d_reply     = job_submit([self.inputdir], self.str_socket)
+        self.assertFalse(d_reply['status'])
+        self.assertIn('Invalid arguments', d_reply['error'])
@@ -0,0 +1,35 @@
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+from    skimage.metrics import structural_similarity    as ssim
+
+from heatmap.stackssim import ssim_stack, SCORE_TOLERANCE, DIFF_TOLERANCE
+
+
+class StackSSIMTests(TestCase):
+    """
+    Test the batched SSIM engine against scikit-image.
+    """
+    def test_matches_skimage(self):
+        rng     = np.random.default_rng(1)
+        stackA  = np.stack([
+            cv2.GaussianBlur(rng.integers(0, 256, (96, 80), dtype = np.uint8), (5, 5), 0)
+            for i in range(5)
+        ])
+        stackB  = stackA.copy()
+        stackB[:, 20:40, 30:60]  = 255
+        stackB[2]                = rng.integers(0, 256, (96, 80))
+        stackB[3]                = stackA[3]
+
+        (scores, S) = ssim_stack(stackA, stackB)
+        for i in range(len(stackA)):
+            (score, imdiff) = ssim(stackA[i], stackB[i], full = True)
+            self.assertAlmostEqual(scores[i], score, delta = SCORE_TOLERANCE)
+            l_diff  = [(im * 255).astype("uint8").astype(int) for im in (imdiff, S[i])]
+            self.assertLessEqual(np.abs(l_diff[0] - l_diff[1]).max(), DIFF_TOLERANCE)
+        self.assertAlmostEqual(scores[3], 1.0, delta = SCORE_TOLERANCE)
+
+    def test_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            ssim_stack(np.zeros((2, 16, 16)), np.zeros((2, 16, 15)))
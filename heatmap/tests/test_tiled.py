@@ -0,0 +1,67 @@
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+
+from heatmap.heatmap import slice_compare, Gd_DEPENDS
+from heatmap.tiled import slice_compareTiled, otsu_threshold, regions_box
+
+
+class TiledTests(TestCase):
+    """
+    Test tiled slice comparison against the whole-slice comparison.
+    """
+    def test_matches_whole_slice(self):
+        rng     = np.random.default_rng(2)
+        imageA  = cv2.GaussianBlur(rng.integers(0, 256, (203, 170), dtype = np.uint8), (0, 0), 2)
+        imageB  = imageA.copy()
+        for (y, x, h, w) in [(5, 5, 30, 40), (60, 90, 50, 60), (150, 20, 40, 12), (30, 160, 9, 10)]:
+            imageB[y : y + h, x : x + w] = rng.integers(0, 256)
+
+        (score, imageDiff, imageThresh, boxes) = slice_compare(imageA, imageB)
+        l_boxes = sorted(map(tuple, cv2.connectedComponentsWithStats(
+                                        imageThresh, connectivity = 8)[2][1:, :4]))
+        for tileSize in [16, 32, 45]:
+            (scoreT, diffT, threshT, boxesT) = slice_compareTiled(
+                imageA, imageB, tileSize, frozenset(Gd_DEPENDS))
+            self.assertAlmostEqual(score, scoreT, places = 12)
+            # S is 1 up to rounding where the slices agree: 254 or 255
+            self.assertLessEqual(np.abs(imageDiff.astype(int) - diffT).max(), 1)
+            self.assertTrue(np.array_equal(imageThresh, threshT))
+            self.assertEqual(sorted(map(tuple, boxesT)), l_boxes)
+
+    def test_scores_only(self):
+        rng     = np.random.default_rng(3)
+        imageA  = rng.integers(0, 256, (40, 50), dtype = np.uint8)
+        (score, imageDiff, imageThresh, boxes) = slice_compareTiled(imageA, imageA, 16)
+        self.assertAlmostEqual(score, 1.0)
+        self.assertEqual((imageDiff, imageThresh, boxes), (None, None, None))
+
+    def test_small_slices(self):
+        # The smallest slice the SSIM window fits into scores as a whole
+        # slice does; smaller ones are refused like skimage refuses them.
+        rng     = np.random.default_rng(5)
+        imageA  = rng.integers(0, 256, (7, 30), dtype = np.uint8)
+        imageB  = rng.integers(0, 256, (7, 30), dtype = np.uint8)
+        self.assertAlmostEqual(slice_compareTiled(imageA, imageB, 16)[0],
+                               slice_compare(imageA, imageB)[0], places = 6)
+        for imageA in [imageA[:6], imageA[:, :6]]:
+            with self.assertRaises(ValueError):
+                slice_compareTiled(imageA, imageA, 16)
+
+    def test_otsu_threshold(self):
+        rng     = np.random.default_rng(4)
+        for i in range(10):
+            image   = (rng.normal(80 + 10 * i, 20, (64, 64)).clip(0, 255)).astype(np.uint8)
+            image[:20]  = 200
+            self.assertEqual(otsu_threshold(np.bincount(image.ravel(), minlength = 256)),
+                             cv2.threshold(image, 0, 255, cv2.THRESH_OTSU)[0])
+
+    def test_regions_merge_across_seams(self):
+        image   = np.zeros((40, 40), np.uint8)
+        # A diagonal line crossing tile corners, and a ring over four tiles
+        for i in range(5, 25):
+            image[i, i]     = 255
+        cv2.rectangle(image, (12, 26), (30, 36), 255, 1)
+        boxes   = regions_box(image, 16)
+        self.assertEqual(sorted(map(tuple, boxes)), [(5, 5, 20, 20), (12, 26, 19, 11)])
@@ -0,0 +1,100 @@
+import  os
+import  gzip
+import  json
+import  shutil
+import  struct
+import  tempfile
+
+from unittest import TestCase
+
+import  numpy   as np
+
+from heatmap.heatmap import Heatmap
+from heatmap.volume import Volume, volume_check
+
+
+def nifti_write(str_path, data):
+    """
+    Write <data> as a minimal little-endian NIfTI-1 file.
+    """
+    header          = bytearray(352)
+    dim             = [data.ndim] + list(data.shape) + [1] * (7 - data.ndim)
+    struct.pack_into('<i',  header, 0,   348)
+    struct.pack_into('<8h', header, 40,  *dim)
+    struct.pack_into('<h',  header, 70,  {np.uint8: 2, np.int16: 4, np.float32: 16}[data.dtype.type])
+    struct.pack_into('<f',  header, 108, 352.0)
+    header[344:348] = b'n+1\0'
+    payload         = bytes(header) + data.astype(data.dtype.newbyteorder('<')).tobytes(order = 'F')
+    opener          = gzip.open if str_path.endswith('.gz') else open
+    with opener(str_path, 'wb') as fp:
+        fp.write(payload)
+
+
+def mgh_write(str_path, data):
+    """
+    Write 3D <data> as a minimal MGH file, gzipped for .mgz.
+    """
+    header          = bytearray(284)
+    struct.pack_into('>7i', header, 0, 1, *data.shape, 1,
+                        {np.uint8: 0, np.int32: 1, np.float32: 3, np.int16: 4}[data.dtype.type], 0)
+    payload         = bytes(header) + data.astype(data.dtype.newbyteorder('>')).tobytes(order = 'F')
+    opener          = gzip.open if str_path.endswith('.mgz') else open
+    with opener(str_path, 'wb') as fp:
+        fp.write(payload)
+
+
+class VolumeTests(TestCase):
+    """
+    Test volume input.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+        rng             = np.random.default_rng(0)
+        self.data       = rng.integers(0, 1000, (40, 48, 6)).astype(np.int16)
+
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def test_formats(self):
+        """
+        Every format gives the same slices along every axis.
+        """
+        for str_name, writer in [   ('v.nii', nifti_write), ('v.nii.gz', nifti_write),
+                                    ('v.mgh', mgh_write),   ('v.mgz',    mgh_write)]:
+            str_path    = os.path.join(self.str_tmp, str_name)
+            writer(str_path, self.data)
+            self.assertTrue(volume_check(str_path))
+            for axis in range(3):
+                volume  = Volume(str_path, axis)
+                self.assertEqual(len(volume), self.data.shape[axis])
+                self.assertEqual(volume.range(), (self.data.min(), self.data.max()))
+                image   = volume.slice(1)
+                self.assertEqual(image.dtype, np.uint8)
+                expected = (np.take(self.data, 1, axis = axis).astype(np.float32)
+                                - self.data.min()) * (255.0 / np.ptp(self.data))
+                self.assertTrue(np.array_equal(image, expected.astype(np.uint8)))
+                volume.close()
+
+    def test_run(self):
+        """
+        Two volumes are compared slice by slice without image files.
+        """
+        dataB                   = self.data.copy()
+        dataB[10:20, 10:20, 3]  = 999
+        os.makedirs(os.path.join(self.str_tmp, 'in'))
+        os.makedirs(os.path.join(self.str_tmp, 'out'))
+        nifti_write(os.path.join(self.str_tmp, 'in', 'a.nii.gz'), self.data)
+        mgh_write(os.path.join(self.str_tmp, 'in', 'b.mgz'), dataB)
+
+        app     = Heatmap()
+        options = app.parse_args([  os.path.join(self.str_tmp, 'in'),
+                                    os.path.join(self.str_tmp, 'out'),
+                                    '--inputSubDir1', 'a.nii.gz',
+                                    '--inputSubDir2', 'b.mgz'])
+        app.run(options)
+        with open(os.path.join(self.str_tmp, 'out', 'SSIN.json')) as fp:
+            l_SSIM  = json.load(fp)
+        self.assertEqual(len(l_SSIM), 6)
+        self.assertAlmostEqual(l_SSIM[0], 1.0)
+        self.assertLess(l_SSIM[3], 1.0)
+        self.assertEqual(len(os.listdir(os.path.join(self.str_tmp, 'out', 'contourA'))), 6)
@@ -0,0 +1,96 @@
+import  os
+import  shutil
+import  zipfile
+import  tempfile
+
+from unittest import TestCase
+
+import  numpy   as np
+import  cv2
+
+from heatmap.writer import ImageWriter, SliceContainer
+
+
+class ImageWriterTests(TestCase):
+    """
+    Test the asynchronous image writer.
+    """
+    def setUp(self):
+        self.str_tmp    = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.str_tmp)
+
+    def test_write(self):
+        writer  = ImageWriter(threads = 2, queueSize = 2, compression = 9)
+        l_images = [np.full((16, 16), i, np.uint8) for i in range(10)]
+        for (i, image) in enumerate(l_images):
+            writer.submit(os.path.join(self.str_tmp, '%d.png' % i), image)
+        writer.close()
+        self.assertEqual(writer.written, 10)
+        for (i, image) in enumerate(l_images):
+            self.assertTrue(np.array_equal(
+                cv2.imread(os.path.join(self.str_tmp, '%d.png' % i), cv2.IMREAD_GRAYSCALE),
+                image
+            ))
+
+    def test_error(self):
+        writer  = ImageWriter(threads = 1)
+        writer.submit(os.path.join(self.str_tmp, 'missing', 'x.png'), np.zeros((4, 4), np.uint8))
+        with self.assertRaises(Exception):
+            writer.close()
+
+    def test_container(self):
+        str_path    = os.path.join(self.str_tmp, 'heatmap.npz')
+        container   = SliceContainer(str_path, compression = 1)
+        writer      = ImageWriter(threads = 4)
+        l_images    = [np.full((8, 6, 3), i, np.uint8) for i in range(12)]
+        for (i, image) in enumerate(l_images):
+            writer.submit('slice-%03d' % i, image, container)
+        writer.close()
+        container.close()
+        self.assertEqual(writer.written, 12)
+        with np.load(str_path) as npz:
+            self.assertEqual(sorted(npz.files), ['slice-%03d' % i for i in range(12)])
+            self.assertTrue(np.array_equal(npz['slice-007'], l_images[7]))
+        # Members are deflated, with the sizes and CRC of their contents.
+        with zipfile.ZipFile(str_path) as archive:
+            self.assertIsNone(archive.testzip())
+            for info in archive.infolist():
+                self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+                self.assertLess(info.compress_size, info.file_size)
+
+        str_merged  = os.path.join(self.str_tmp, 'merged.npz')
+        merged      = SliceContainer(str_merged)
+        self.assertEqual(merged.members_add(str_path), 12)
+        merged.close()
+        with np.load(str_merged) as npz:
+            self.assertTrue(np.array_equal(npz['slice-011'], l_images[11]))
+
+    def test_container_header(self):
+        """
+        Relabelling a stored member as deflated keeps the size of its
+        local header, and the container reads back, CRCs checked.
+        """
+        info        = zipfile.ZipInfo('slice-000.npy', (2021, 1, 1, 0, 0, 0))
+        (info.CRC, info.file_size, info.compress_size) = (0, 10, 10)
+        stored      = info.FileHeader(True)
+        (info.compress_type, info.CRC, info.file_size) = (zipfile.ZIP_DEFLATED, 1234, 1 << 33)
+        self.assertEqual(len(info.FileHeader(True)), len(stored))
+
+        str_path    = os.path.join(self.str_tmp, 'heatmap.npz')
+        container   = SliceContainer(str_path)
+        l_images    = [np.arange(i, i + 300, dtype = np.uint16).reshape(15, 20) for i in range(3)]
+        for (i, image) in enumerate(l_images):
+            container.slice_write('slice-%03d' % i, image)
+        container.close()
+        with zipfile.ZipFile(str_path) as archive:
+            for (i, info) in enumerate(archive.infolist()):
+                # A whole read checks the member's CRC.
+                with archive.open(info) as fp:
+                    self.assertTrue(np.array_equal(np.lib.format.read_array(fp), l_images[i]))
+                    self.assertEqual(fp.read(), b'')
+                self.assertEqual(archive.read(info), archive.read(info.filename))
+        with np.load(str_path) as npz:
+            for (i, image) in enumerate(l_images):
+                self.assertTrue(np.array_equal(npz['slice-%03d' % i], image))
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Tiled comparison of very large slices.
+
+The SSIM map is computed tile by tile, each tile padded by a halo of
+half the SSIM window taken from its neighbours (or mirrored at the image
+border, as the whole-image filter does), so that the stitched map is
+the same as the whole-image one up to floating point rounding. The
+global score is accumulated from the tiles, the Otsu threshold is found
+from an accumulated histogram, and the connected difference regions
+found per tile are merged across tile seams. Difference and threshold
+images are kept in unlinked temporary memory-mapped files, so that
+working memory is proportional to the tile size and not to the image
+size.
+
+One difference to the whole-image path: a region lying entirely inside
+a hole of another region has its own box here, whereas whole-image
+external contouring omits it.
+"""
+
+import  tempfile
+
+import  numpy                               as np
+import  cv2
+from    skimage.metrics import structural_similarity    as ssim
+
+WIN_SIZE        :   int     = 7
+TILE_MIN        :   int     = 2 * WIN_SIZE
+
+
+def tiles(height, width, tileSize):
+    """
+    The (y0, y1, x0, x1) bounds of the tiles covering an image.
+    """
+    for y0 in range(0, height, tileSize):
+        for x0 in range(0, width, tileSize):
+            yield (y0, min(y0 + tileSize, height), x0, min(x0 + tileSize, width))
+
+def tile_halo(image, y0, y1, x0, x1, pad):
+    """
+    The tile [y0:y1, x0:x1] of <image> with <pad> extra pixels all
+    round, mirrored ('symmetric', as scipy's 'reflect') past the image
+    border.
+    """
+    (height, width) = image.shape
+    (ya, yb)        = (max(0, y0 - pad), min(height, y1 + pad))
+    (xa, xb)        = (max(0, x0 - pad), min(width,  x1 + pad))
+    return np.pad(image[ya:yb, xa:xb],
+                  ((pad - (y0 - ya), pad - (yb - y1)),
+                   (pad - (x0 - xa), pad - (xb - x1))),
+                  mode = 'symmetric')
+
+def memmap_temporary(shape):
+    """
+    A uint8 array backed by an anonymous (already unlinked) file.
+    """
+    return np.memmap(tempfile.TemporaryFile(prefix = 'heatmap-'),
+                     dtype = np.uint8, mode = 'w+', shape = shape)
+
+def otsu_threshold(histogram) -> float:
+    """
+    The Otsu threshold of a 256 bin histogram, computed exactly as
+    OpenCV's THRESH_OTSU does for 8-bit images.
+    """
+    scale       :   float   = 1.0 / histogram.sum()
+    mu          :   float   = float(np.dot(np.arange(256), histogram)) * scale
+    mu1         :   float   = 0.0
+    q1          :   float   = 0.0
+    max_sigma   :   float   = 0.0
+    max_val     :   float   = 0.0
+    eps         :   float   = np.finfo(np.float32).eps
+
+    for i in range(256):
+        p_i     = histogram[i] * scale
+        mu1    *= q1
+        q1     += p_i
+        q2      = 1.0 - q1
+        if min(q1, q2) < eps or max(q1, q2) > 1.0 - eps:
+            continue
+        mu1     = (mu1 + i * p_i) / q1
+        mu2     = (mu - q1 * mu1) / q2
+        sigma   = q1 * q2 * (mu1 - mu2) ** 2
+        if sigma > max_sigma:
+            max_sigma   = sigma
+            max_val     = i
+    return max_val
+
+
+class UnionFind:
+    """
+    Disjoint sets over the integers 0..n-1.
+    """
+
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i) -> int:
+        while self.parent[i] != i:
+            self.parent[i]  = self.parent[self.parent[i]]
+            i               = self.parent[i]
+        return i
+
+    def union(self, i, j):
+        (ri, rj)    = (self.find(i), self.find(j))
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+def seam_pairs(a, b, diagonal = True) -> list:
+    """
+    The (label, label) pairs of foreground pixels facing each other
+    across a seam, where <a> and <b> are the global labels (-1 for
+    background) along either side, 8-connected if <diagonal>.
+    """
+    l_pairs     = []
+    for d in ([-1, 0, 1] if diagonal else [0]):
+        (sa, sb)    = (a[max(0, -d) : len(a) - max(0, d)], b[max(0, d) : len(b) - max(0, -d)])
+        mask        = (sa >= 0) & (sb >= 0)
+        l_pairs.extend(zip(sa[mask].tolist(), sb[mask].tolist()))
+    return l_pairs
+
+def regions_box(imageThresh, tileSize):
+    """
+    Bounding boxes, as an (N, 4) array of (x, y, w, h), of the
+    8-connected foreground regions of <imageThresh>, found tile by tile
+    and merged across the tile seams.
+    """
+    l_boxes     :   list    = []
+    d_edges     :   dict    = {}
+    count       :   int     = 0
+
+    for (y0, y1, x0, x1) in tiles(*imageThresh.shape, tileSize):
+        (n, labels, stats, _) = cv2.connectedComponentsWithStats(
+                                    np.ascontiguousarray(imageThresh[y0:y1, x0:x1]),
+                                    connectivity = 8)
+        boxes           = stats[1:, :4].copy()
+        boxes[:, 0]    += x0
+        boxes[:, 1]    += y0
+        l_boxes.append(boxes)
+        # Global labels along the tile edges, -1 for background
+        labels          = np.where(labels > 0, labels - 1 + count, -1)
+        d_edges[(y0 // tileSize, x0 // tileSize)] = (
+            labels[0, :], labels[-1, :], labels[:, 0], labels[:, -1]
+        )
+        count          += n - 1
+
+    if not count:
+        return np.zeros((0, 4), np.int32)
+    boxes       = np.concatenate(l_boxes)
+    regions     = UnionFind(count)
+    l_pairs     = []
+    for ((ti, tj), (top, bottom, left, right)) in d_edges.items():
+        if (ti, tj + 1) in d_edges:
+            l_pairs    += seam_pairs(right, d_edges[(ti, tj + 1)][2])
+        if (ti + 1, tj) in d_edges:
+            l_pairs    += seam_pairs(bottom, d_edges[(ti + 1, tj)][0])
+        if (ti + 1, tj + 1) in d_edges:
+            l_pairs    += seam_pairs(bottom[-1:], d_edges[(ti + 1, tj + 1)][0][:1], False)
+        if (ti + 1, tj - 1) in d_edges:
+            l_pairs    += seam_pairs(bottom[:1], d_edges[(ti + 1, tj - 1)][0][-1:], False)
+    for (i, j) in l_pairs:
+        regions.union(i, j)
+
+    roots       = np.array([regions.find(i) for i in range(count)])
+    (l_root, inverse) = np.unique(roots, return_inverse = True)
+    lo          = np.full((len(l_root), 2), np.iinfo(np.int32).max, np.int64)
+    hi          = np.full((len(l_root), 2), -1, np.int64)
+    np.minimum.at(lo, inverse, boxes[:, :2])
+    np.maximum.at(hi, inverse, boxes[:, :2] + boxes[:, 2:4])
+    merged      = np.concatenate([lo, hi - lo], axis = 1).astype(np.int32)
+    return merged[np.lexsort((merged[:, 0], merged[:, 1]))]
+
+def slice_compareTiled(imageAgray, imageBgray, tileSize = 1024, s_needs = frozenset()) -> tuple:
+    """
+    Compare a pair of (large) grayscale slices tile by tile, returning
+    the SSIM score, the difference image, its threshold and the
+    bounding boxes of the difference regions, as slice_compare() does.
+    The images are memory-mapped. Slices smaller than the SSIM window
+    are refused, as by structural_similarity() itself.
+    """
+    pad             :   int     = (WIN_SIZE - 1) // 2
+    (height, width) = imageAgray.shape
+    if min(height, width) < WIN_SIZE:
+        raise ValueError("win_size exceeds image extent: slices of %dx%d are smaller than "
+                         "the %dx%d SSIM window" % (width, height, WIN_SIZE, WIN_SIZE))
+    tileSize                    = max(tileSize, TILE_MIN)
+    total           :   float   = 0.0
+    histogram                   = np.zeros(256, np.int64)
+    imageDiff                   = None
+    imageThresh                 = None
+    boxes                       = None
+
+    if 'diff' in s_needs:
+        imageDiff   = memmap_temporary((height, width))
+    for (y0, y1, x0, x1) in tiles(height, width, tileSize):
+        (score, S)  = ssim( tile_halo(imageAgray, y0, y1, x0, x1, pad),
+                            tile_halo(imageBgray, y0, y1, x0, x1, pad),
+                            full = True, data_range = 255)
+        S           = S[pad:-pad, pad:-pad]
+        # The score averages S away from the image border only.
+        total      += S[max(pad, y0) - y0 : max(0, min(height - pad, y1) - y0),
+                        max(pad, x0) - x0 : max(0, min(width - pad, x1) - x0)].sum(dtype = np.float64)
+        if imageDiff is not None:
+            # convert normalized float S to integer ranges
+            diff                        = (S * 255).astype("uint8")
+            imageDiff[y0:y1, x0:x1]     = diff
+            histogram                  += np.bincount(diff.ravel(), minlength = 256)
+    score           = total / ((height - 2 * pad) * (width - 2 * pad))
+
+    if 'thresh' in s_needs:
+        thresh      = otsu_threshold(histogram)
+        imageThresh = memmap_temporary((height, width))
+        for (y0, y1, x0, x1) in tiles(height, width, tileSize):
+            imageThresh[y0:y1, x0:x1] = cv2.threshold(
+                np.ascontiguousarray(imageDiff[y0:y1, x0:x1]), thresh, 255,
+                cv2.THRESH_BINARY_INV)[1]
+    if 'contours' in s_needs:
+        boxes       = regions_box(imageThresh, tileSize)
+    return (score, imageDiff, imageThresh, boxes)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Slice access to NIfTI-1 (.nii, .nii.gz) and FreeSurfer MGH (.mgh, .mgz)
+volumes without converting them to image files first.
+
+Uncompressed volumes are memory-mapped in place. Gzipped volumes are
+decompressed in fixed size chunks to a temporary file which is then
+memory-mapped, so that at no point is the whole volume held in memory.
+Slices along any axis are handed out as 8-bit grayscale images, scaled
+by an intensity window that defaults to the volume's own range.
+"""
+
+import  os
+import  gzip
+import  shutil
+import  struct
+import  tempfile
+
+import  numpy                               as np
+
+GZIP_CHUNK      :   int     = 16 * 1024 * 1024
+
+# NIfTI-1 datatype codes
+Gd_NIFTI_DTYPE  :   dict    = {
+    2:      'u1',
+    4:      'i2',
+    8:      'i4',
+    16:     'f4',
+    64:     'f8',
+    256:    'i1',
+    512:    'u2',
+    768:    'u4',
+    1024:   'i8',
+    1280:   'u8',
+}
+
+# MGH datatype codes
+Gd_MGH_DTYPE    :   dict    = {
+    0:      'u1',
+    1:      'i4',
+    3:      'f4',
+    4:      'i2',
+}
+MGH_HEADER_SIZE :   int     = 284
+
+Gl_VOLUME_EXT   :   list    = ['.nii', '.nii.gz', '.mgh', '.mgz']
+
+
+def volume_check(str_path) -> bool:
+    """
+    Is <str_path> a volume file this module can read?
+    """
+    return os.path.isfile(str_path) and \
+        any(str_path.lower().endswith(ext) for ext in Gl_VOLUME_EXT)
+
+
+class Volume:
+    """
+    A memory-mapped NIfTI or MGH volume, sliced along one axis.
+    """
+
+    def __init__(self, str_path, axis = 2):
+        self.str_path   :   str     = str_path
+        self.axis       :   int     = axis
+        self.str_tmpdir :   str     = ""
+        self.window     :   tuple   = ()
+
+        str_data        :   str     = str_path
+        if self.str_path.lower().endswith(('.gz', '.mgz')):
+            str_data    = self.gunzip()
+        with open(str_data, 'rb') as fp:
+            header  = fp.read(540)
+        if self.str_path.lower().endswith(('.mgh', '.mgz')):
+            (dtype, shape, offset)  = self.header_mgh(header)
+        else:
+            (dtype, shape, offset)  = self.header_nifti(header)
+
+        # Both formats store voxels with the first index varying fastest.
+        data            = np.memmap(str_data, dtype = dtype, mode = 'r',
+                                    offset = offset, shape = shape, order = 'F')
+        # Only the first frame of a 4D volume is compared.
+        while data.ndim > 3:
+            data        = data[..., 0]
+        self.data       = data
+        if not 0 <= self.axis < self.data.ndim:
+            raise ValueError("Slice axis %d out of range for volume %s of shape %s" %
+                                (self.axis, self.str_path, self.data.shape))
+
+    def gunzip(self) -> str:
+        """
+        Decompress the volume chunk by chunk to a private temporary
+        file and return its path.
+        """
+        self.str_tmpdir = tempfile.mkdtemp(prefix = 'heatmap-')
+        str_data        = os.path.join(self.str_tmpdir, 'volume')
+        with gzip.open(self.str_path, 'rb') as fin, open(str_data, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, GZIP_CHUNK)
+        return str_data
+
+    def header_nifti(self, header) -> tuple:
+        """
+        Parse a NIfTI-1 header into (dtype, shape, data offset).
+        """
+        str_endian  :   str     = '<'
+        if struct.unpack('<i', header[0:4])[0] != 348:
+            str_endian  = '>'
+            if struct.unpack('>i', header[0:4])[0] != 348:
+                raise ValueError("%s is not a NIfTI-1 volume" % self.str_path)
+        dim         = struct.unpack(str_endian + '8h', header[40:56])
+        datatype    = struct.unpack(str_endian + 'h',  header[70:72])[0]
+        vox_offset  = struct.unpack(str_endian + 'f',  header[108:112])[0]
+        if datatype not in Gd_NIFTI_DTYPE:
+            raise ValueError("Unsupported NIfTI datatype %d in %s" %
+                                (datatype, self.str_path))
+        return (np.dtype(str_endian + Gd_NIFTI_DTYPE[datatype]),
+                tuple(dim[1 : dim[0] + 1]),
+                int(vox_offset))
+
+    def header_mgh(self, header) -> tuple:
+        """
+        Parse an MGH header into (dtype, shape, data offset).
+        """
+        (version, width, height, depth, nframes, datatype) = \
+            struct.unpack('>6i', header[0:24])
+        if version != 1:
+            raise ValueError("%s is not an MGH volume" % self.str_path)
+        if datatype not in Gd_MGH_DTYPE:
+            raise ValueError("Unsupported MGH datatype %d in %s" %
+                                (datatype, self.str_path))
+        return (np.dtype('>' + Gd_MGH_DTYPE[datatype]),
+                (width, height, depth, nframes),
+                MGH_HEADER_SIZE)
+
+    def range(self) -> tuple:
+        """
+        The (min, max) intensity of the volume, found one block of
+        slices at a time.
+        """
+        lo          :   float   = np.inf
+        hi          :   float   = -np.inf
+        last        :   int     = self.data.ndim - 1
+        step        :   int     = max(1, GZIP_CHUNK // (self.data[..., 0].nbytes or 1))
+
+        for i in range(0, self.data.shape[last], step):
+            block   = self.data[..., i : i + step]
+            lo      = min(lo, float(block.min()))
+            hi      = max(hi, float(block.max()))
+        return (lo, hi)
+
+    def __len__(self) -> int:
+        return self.data.shape[self.axis]
+
+    def slice(self, i):
+        """
+        Slice <i> along the volume's axis as an 8-bit grayscale image.
+        """
+        if not self.window:
+            self.window = self.range()
+        (lo, hi)    = self.window
+        image       = np.take(self.data, i, axis = self.axis).astype(np.float32)
+        image      -= lo
+        image      *= 255.0 / ((hi - lo) or 1.0)
+        return np.clip(image, 0, 255, out = image).astype(np.uint8)
+
+    def slices(self, l_index) -> list:
+        """
+        The slices <l_index>, as slice() gives them.
+        """
+        return [self.slice(i) for i in l_index]
+
+    def close(self):
+        """
+        Release the memory map and any decompressed temporary file.
+        """
+        self.data   = None
+        if self.str_tmpdir:
+            shutil.rmtree(self.str_tmpdir, ignore_errors = True)
+            self.str_tmpdir = ""
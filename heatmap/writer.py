@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# heatmap ds ChRIS plugin app
+#
+# (c) 2021 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+"""
+Asynchronous image output: images are encoded and written by a pool of
+threads (OpenCV and zlib release the GIL while compressing), fed through
+a bounded queue so that the pipeline can carry on computing while
+earlier slices are still being written, without the backlog growing
+without limit.
+
+Images go either to their own PNG files or, as slices of one product,
+into a ``SliceContainer``.
+"""
+
+import  io
+import  time
+import  zlib
+import  zipfile
+import  threading
+from    concurrent.futures  import ThreadPoolExecutor, wait
+
+import  numpy                               as np
+import  cv2
+
+
+class SliceContainer:
+    """
+    All the slices of one product in a single .npz file: a zip archive
+    holding each slice as a deflated .npy member named after the slice,
+    so that any one slice can be read back on its own with e.g.
+    ``np.load('heatmap.npz')['slice-007']``. Slices are appended as they
+    are written; the archive is only complete once closed.
+
+    Members are deflated by the writing thread before it takes the
+    archive, so that several threads compress at once and the archive is
+    only held to append the compressed bytes.
+    """
+
+    def __init__(self, str_path, compression = -1):
+        self.str_path       :   str     = str_path
+        self.level          :   int     = compression if compression >= 0 else \
+                                          zlib.Z_DEFAULT_COMPRESSION
+        self.zip                        = zipfile.ZipFile(str_path, 'w')
+        # A zip archive takes one member at a time.
+        self.lock                       = threading.Lock()
+
+    def member_write(self, str_member, data):
+        """
+        Append the bytes <data> as the deflated member <str_member>.
+        """
+        compressor      = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated        = compressor.compress(data) + compressor.flush()
+        info            = zipfile.ZipInfo(str_member, time.localtime()[:6])
+        info.external_attr  = 0o600 << 16
+        crc             = zlib.crc32(data)
+        with self.lock:
+            # The deflated bytes are stored as they are, and the member is
+            # then relabelled as deflated: its entry in the central
+            # directory, written on close, and its local header, which
+            # keeps its size as the sizes are zip64 fields either way.
+            with self.zip.open(info, 'w', force_zip64 = True) as fp:
+                fp.write(deflated)
+            (info.compress_type, info.CRC, info.file_size) = \
+                                    (zipfile.ZIP_DEFLATED, crc, len(data))
+            end         = self.zip.fp.tell()
+            header      = info.FileHeader(True)
+            # Rewritten in place, so it must be the header zipfile wrote.
+            if len(header) != end - len(deflated) - info.header_offset:
+                raise RuntimeError("Member %s of %s: local header changed size" %
+                                    (str_member, self.str_path))
+            self.zip.fp.seek(info.header_offset)
+            self.zip.fp.write(header)
+            self.zip.fp.seek(end)
+
+    def slice_write(self, str_name, image):
+        """
+        Append <image> as the member <str_name> (without '.npy').
+        """
+        buffer          = io.BytesIO()
+        np.lib.format.write_array(buffer, np.ascontiguousarray(image), allow_pickle = False)
+        self.member_write(str_name + '.npy', buffer.getbuffer())
+
+    def members_add(self, str_path) -> int:
+        """
+        Append every member of the container <str_path>, returning how
+        many there were.
+        """
+        with zipfile.ZipFile(str_path) as source:
+            l_members   = source.infolist()
+            for info in l_members:
+                self.member_write(info.filename, source.read(info))
+        return len(l_members)
+
+    def close(self):
+        self.zip.close()
+
+
+class ImageWriter:
+    """
+    A bounded, threaded image writer.
+    """
+
+    def __init__(self, threads = 4, queueSize = 0, compression = -1):
+        self.threads        :   int     = threads
+        self.pool                   = ThreadPoolExecutor(max_workers = threads)
+        self.slots                  = threading.BoundedSemaphore(queueSize or 4 * threads)
+        self.lock                   = threading.Lock()
+        self.s_pending      :   set     = set()
+        self.l_errors       :   list    = []
+        self.l_params       :   list    = []
+        self.written        :   int     = 0
+        # Seconds spent encoding and writing each image
+        self.l_latency      :   list    = []
+        if compression >= 0:
+            self.l_params   = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+
+    def image_write(self, str_path, image, container = None):
+        tic     = time.perf_counter()
+        if container:
+            container.slice_write(str_path, image)
+        elif not cv2.imwrite(str_path, image, self.l_params):
+            raise IOError("Could not write image %s" % str_path)
+        self.l_latency.append(time.perf_counter() - tic)
+
+    def write_done(self, future):
+        with self.lock:
+            self.s_pending.discard(future)
+            if future.exception():
+                self.l_errors.append(future.exception())
+            else:
+                self.written   += 1
+        self.slots.release()
+
+    def submit(self, str_path, image, container = None):
+        """
+        Queue <image> for writing to the file <str_path>, or as the slice
+        <str_path> of <container>, blocking while the queue is full. The
+        caller must not modify <image> afterwards.
+        """
+        self.slots.acquire()
+        future  = self.pool.submit(self.image_write, str_path, image, container)
+        with self.lock:
+            self.s_pending.add(future)
+        future.add_done_callback(self.write_done)
+
+    def drain(self):
+        """
+        Wait for every queued image to be written, raising the first
+        write error if there was one.
+        """
+        with self.lock:
+            l_pending   = list(self.s_pending)
+        wait(l_pending)
+        if self.l_errors:
+            raise self.l_errors[0]
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            self.pool.shutdown()
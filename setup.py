@@ -17,6 +17,7 @@ setup(
     url              = 'http://wiki',
     packages         = ['heatmap'],
     install_requires = ['chrisapp'],
+    extras_require   = {'dicom': ['pydicom']},
     test_suite       = 'nose.collector',
     tests_require    = ['nose'],
     license          = 'MIT',
@@ -24,7 +25,8 @@ setup(
     python_requires  = '>=3.8',
     entry_points     = {
         'console_scripts': [
-            'heatmap = heatmap.__main__:main'
+            'heatmap = heatmap.__main__:main',
+            'heatmap-server = heatmap.server:main'
             ]
         }
 )